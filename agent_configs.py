@@ -7,6 +7,9 @@ load_dotenv()
 
 # Cohere
 COHERE_MODEL = os.getenv("COHERE_MODEL")
+COHERE_API_KEY = os.getenv("COHERE_API_KEY")
+# point this at a local stand-in server (see stub_providers.py) to run offline
+COHERE_BASE_URL = os.getenv("COHERE_BASE_URL")
 COHERE_SYSTEM_PROMPT = """
 You are a helpful assistant for answering questions about statistics.
 """
@@ -14,6 +17,10 @@ You are a helpful assistant for answering questions about statistics.
 
 # Baseten
 BASETEN_MODEL_ID = os.getenv("BASETEN_MODEL_ID")
+BASETEN_API_KEY = os.getenv("BASETEN_API_KEY")
+BASETEN_BASE_URL = os.getenv(
+    "BASETEN_BASE_URL", f"https://model-{BASETEN_MODEL_ID}.api.baseten.co"
+)
 BASETEN_SYSTEM_PROMPT = """
 
 You are a helpful assistant for answering questions about statistics.
@@ -37,9 +44,315 @@ and recommend a test/procedure in JSON format.
 """
 
 
+# LLM backends (llm_backends.py)
+# Which backend each role talks to: cohere, baseten, openai (any OpenAI
+# compatible /chat/completions endpoint) or mock (local, no network, for
+# load tests). HSAGE_LLM_BACKEND sets every role, HSAGE_LLM_<ROLE> one of them.
+LLM_BACKEND = os.getenv("HSAGE_LLM_BACKEND")
+
+
+def _llm_backend(role, default):
+    return os.getenv(f"HSAGE_LLM_{role.upper()}", LLM_BACKEND or default)
+
+
+LLM_BACKENDS = {
+    # explain and the context step of test_example (chat)
+    "explain": _llm_backend("explain", "cohere"),
+    # structured JSON generation
+    "find_test": _llm_backend("find_test", "baseten"),
+    "test_example": _llm_backend("test_example", "baseten"),
+    # the workflow's tool-calling router
+    "router": _llm_backend("router", "cohere"),
+    # the ReActAgent behind `hsage_cli.py ask`
+    "agent": _llm_backend("agent", "cohere"),
+}
+OPENAI_BASE_URL = os.getenv("HSAGE_OPENAI_BASE_URL", "https://api.openai.com/v1")
+OPENAI_API_KEY = os.getenv("HSAGE_OPENAI_API_KEY", os.getenv("OPENAI_API_KEY"))
+OPENAI_MODEL = os.getenv("HSAGE_OPENAI_MODEL", "gpt-4o-mini")
+# seconds the mock backend sleeps per call, to stand in for provider latency
+MOCK_LLM_LATENCY = float(os.getenv("HSAGE_MOCK_LLM_LATENCY", 0))
+
+
 # Pinecone
+PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 STATWIKI_INDEX = os.getenv("STATWIKI_INDEX")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
 TOP_K = int(os.getenv("TOP_K"))
+# optional host overrides, e.g. for a local stand-in server.
+# PINECONE_HOST covers the control plane and inference, PINECONE_INDEX_HOST the index.
+PINECONE_HOST = os.getenv("PINECONE_HOST")
+PINECONE_INDEX_HOST = os.getenv("PINECONE_INDEX_HOST")
 
 # llamaindex specifics
+
+
+# Rate limits
+# Every provider call goes through rate_limiter.py, so these are shared by
+# hsage.py, the workflow and the ingestion scripts.
+# rps = requests per second, burst = bucket size, concurrency = max in flight,
+# tpm = optional tokens per minute (only the embedding endpoint uses it today).
+def _provider_limit(name, rps, burst, concurrency, tpm=None):
+    prefix = f"HSAGE_{name.upper()}"
+    return {
+        "rps": float(os.getenv(f"{prefix}_RPS", rps)),
+        "burst": float(os.getenv(f"{prefix}_BURST", burst)),
+        "concurrency": int(os.getenv(f"{prefix}_CONCURRENCY", concurrency)),
+        "tpm": (
+            float(os.getenv(f"{prefix}_TPM", tpm))
+            if os.getenv(f"{prefix}_TPM", tpm) is not None
+            else None
+        ),
+    }
+
+
+PROVIDER_LIMITS = {
+    "pinecone_inference": _provider_limit(
+        "pinecone_inference", rps=5, burst=10, concurrency=4, tpm=250000
+    ),
+    "pinecone_index": _provider_limit(
+        "pinecone_index", rps=20, burst=40, concurrency=10
+    ),
+    "cohere": _provider_limit("cohere", rps=2, burst=5, concurrency=4),
+    "baseten": _provider_limit("baseten", rps=2, burst=5, concurrency=4),
+    "openai": _provider_limit("openai", rps=5, burst=10, concurrency=8),
+}
+# how many times to retry a call that came back with a 429
+RATE_LIMIT_RETRIES = int(os.getenv("HSAGE_RATE_LIMIT_RETRIES", 4))
+# if set, queue depth and wait time metrics are dumped here as JSON on exit
+LIMITER_METRICS_FILE = os.getenv("HSAGE_LIMITER_METRICS_FILE")
+
+
+# Tracing and metrics
+# Phoenix is only used when an API key is set. Local exporters are picked with
+# HSAGE_METRICS_EXPORTER, a comma separated list of: jsonl, prometheus, otlp
+PHOENIX_API_KEY = os.getenv("PHOENIX_API_KEY")
+PHOENIX_ENDPOINT = os.getenv("PHOENIX_ENDPOINT", "https://llamatrace.com/v1/traces")
+METRICS_EXPORTERS = [
+    e.strip() for e in os.getenv("HSAGE_METRICS_EXPORTER", "").split(",") if e.strip()
+]
+METRICS_JSONL_PATH = os.getenv("HSAGE_METRICS_JSONL", "hsage_metrics.jsonl")
+PROMETHEUS_PORT = int(os.getenv("HSAGE_PROMETHEUS_PORT", 9464))
+OTLP_ENDPOINT = os.getenv("HSAGE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+
+
+# Usage accounting
+# Prices are in dollars per million tokens, leave unset to skip cost estimates.
+def _provider_price(name):
+    prefix = f"HSAGE_PRICE_{name.upper()}"
+    return {
+        "input": float(os.getenv(f"{prefix}_INPUT", 0)),
+        "output": float(os.getenv(f"{prefix}_OUTPUT", 0)),
+    }
+
+
+PROVIDER_PRICES = {
+    provider: _provider_price(provider)
+    for provider in (
+        "pinecone_inference",
+        "pinecone_index",
+        "cohere",
+        "baseten",
+        "openai",
+    )
+}
+# every finished request ledger is appended here as JSON, for batch reports
+USAGE_LOG_PATH = os.getenv("HSAGE_USAGE_LOG")
+# batch_report() covers the last this many requests, so a long-lived
+# server doesn't keep every report in memory
+USAGE_REPORTS_KEPT = int(os.getenv("HSAGE_USAGE_REPORTS_KEPT", 1000))
+
+
+# Context assembly
+# Retrieved chunks are deduped, ordered by score and trimmed to this many
+# tokens before they go into a prompt.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("HSAGE_CONTEXT_TOKEN_BUDGET", 1500))
+# keep only the sentences that overlap the query, instead of whole chunks
+CONTEXT_EXTRACT_SENTENCES = os.getenv("HSAGE_CONTEXT_EXTRACT_SENTENCES") == "true"
+
+
+# Lexical retrieval
+# BM25 index built by chunk_wikipedia.py, searched alongside Pinecone in query_db
+# and fused by reciprocal rank. Skipped if the file doesn't exist.
+LEXICAL_INDEX_PATH = os.getenv("HSAGE_LEXICAL_INDEX", "bm25_index.json.gz")
+LEXICAL_TOP_K = int(os.getenv("HSAGE_LEXICAL_TOP_K", TOP_K))
+# when the query is just an article's name, answer from the lexical hit alone
+# with this many chunks and skip the embedding + vector search
+EXACT_MATCH_TOP_K = int(os.getenv("HSAGE_EXACT_MATCH_TOP_K", 2))
+
+
+# Metadata filters
+# Article titles matching this are dropped at ingest (chunk_wikipedia.py and
+# upsert_and_embed_pinecone.py), so a freshly built index has none of them.
+JUNK_TITLE_REGEX = os.getenv(
+    "HSAGE_JUNK_TITLE_REGEX",
+    r"^(Template|Talk|Category|Portal|Help|Wikipedia|File|User|Module|Draft)"
+    r"( talk)?:",
+)
+# regex filters can't run in Pinecone, so fetch this many times TOP_K
+# and filter on our side
+FILTER_OVERFETCH = int(os.getenv("HSAGE_FILTER_OVERFETCH", 3))
+# also filter them out of every query, only needed for an index built before
+# ingest dropped them. Costs an over-fetch per Pinecone query.
+FILTER_JUNK_AT_QUERY = os.getenv("HSAGE_FILTER_JUNK_AT_QUERY", "0") == "1"
+
+
+# Local vector index
+# "pinecone" searches the hosted index, "local" searches the int8 quantized
+# index in LOCAL_VECTOR_INDEX_PATH (built with local_vector_index.py)
+VECTOR_BACKEND = os.getenv("HSAGE_VECTOR_BACKEND", "pinecone")
+LOCAL_VECTOR_INDEX_PATH = os.getenv("HSAGE_LOCAL_VECTOR_INDEX", "local_index")
+# candidates per result that get rescored against the float32 vectors
+RESCORE_FACTOR = int(os.getenv("HSAGE_RESCORE_FACTOR", 4))
+
+
+# Reranking
+# "none", "cohere" (Cohere rerank endpoint) or "cross-encoder" (local, on CPU)
+RERANKER = os.getenv("HSAGE_RERANKER", "none")
+RERANK_MODEL = os.getenv(
+    "HSAGE_RERANK_MODEL",
+    (
+        "rerank-english-v3.0"
+        if RERANKER == "cohere"
+        else "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    ),
+)
+# fetch this many candidates cheaply, send the best RERANK_TOP_N to the LLM
+RERANK_CANDIDATES = int(os.getenv("HSAGE_RERANK_CANDIDATES", 50))
+RERANK_TOP_N = int(os.getenv("HSAGE_RERANK_TOP_N", 5))
+RERANK_BATCH_SIZE = int(os.getenv("HSAGE_RERANK_BATCH_SIZE", 16))
+RERANK_CACHE_SIZE = int(os.getenv("HSAGE_RERANK_CACHE_SIZE", 1024))
+
+
+# Query embedding micro-batching
+# Concurrent query_db calls wait up to this long to share one embed request
+# (the endpoint takes up to 96 inputs). 0 turns batching off.
+EMBED_BATCH_WINDOW_MS = float(os.getenv("HSAGE_EMBED_BATCH_WINDOW_MS", 5))
+EMBED_MAX_BATCH = int(os.getenv("HSAGE_EMBED_MAX_BATCH", 96))
+# batches allowed in flight at once, the rate limiter still has the final say
+EMBED_BATCH_WORKERS = int(os.getenv("HSAGE_EMBED_BATCH_WORKERS", 4))
+
+
+# Speculative retrieval
+# The workflow starts query_db on the raw query while the router decides which
+# tool to run. A tool reuses it when its own query shares this much of its words.
+SPECULATIVE_RETRIEVAL = os.getenv("HSAGE_SPECULATIVE_RETRIEVAL", "1") != "0"
+SPECULATIVE_MIN_OVERLAP = float(os.getenv("HSAGE_SPECULATIVE_MIN_OVERLAP", 0.5))
+
+
+# Test catalog
+# find_test answers from the precomputed catalog (python stat_catalog.py build)
+# when a test agrees with at least this share of what the scenario describes,
+# otherwise it asks Baseten as before.
+TEST_CATALOG_PATH = os.getenv("HSAGE_TEST_CATALOG_PATH", "test_catalog.db")
+CATALOG_MIN_SCORE = float(os.getenv("HSAGE_CATALOG_MIN_SCORE", 0.75))
+
+
+# Embedding checkpoint
+# upsert_and_embed_pinecone.py writes vectors here batch by batch and resumes
+# from it, delete the directory to start a run from scratch.
+EMBED_CHECKPOINT_PATH = os.getenv("HSAGE_EMBED_CHECKPOINT_PATH", "embedding_checkpoint")
+
+
+# Streaming upsert
+# Pinecone takes at most 2MB and 1000 vectors per upsert request,
+# batches are cut by estimated payload size to stay under both.
+UPSERT_MAX_BYTES = int(os.getenv("HSAGE_UPSERT_MAX_BYTES", 1_500_000))
+UPSERT_MAX_VECTORS = int(os.getenv("HSAGE_UPSERT_MAX_VECTORS", 1000))
+UPSERT_WORKERS = int(os.getenv("HSAGE_UPSERT_WORKERS", 8))
+# use the gRPC client (pip install "pinecone[grpc]")
+UPSERT_GRPC = os.getenv("HSAGE_UPSERT_GRPC", "0") == "1"
+
+
+# Near-duplicate chunks
+# chunk_wikipedia.py drops chunks whose estimated Jaccard similarity (over
+# 5-word shingles) to an earlier chunk is at least DEDUP_THRESHOLD.
+# num_perm / bands rows per band, 128 / 16 = 8 puts the LSH candidate
+# threshold around 0.7, below the check so few real duplicates are missed.
+DEDUP_THRESHOLD = float(os.getenv("HSAGE_DEDUP_THRESHOLD", 0.85))
+DEDUP_NUM_PERM = int(os.getenv("HSAGE_DEDUP_NUM_PERM", 128))
+DEDUP_BANDS = int(os.getenv("HSAGE_DEDUP_BANDS", 16))
+
+
+# HTTP server (hsage_server.py)
+SERVER_HOST = os.getenv("HSAGE_SERVER_HOST", "127.0.0.1")
+SERVER_PORT = int(os.getenv("HSAGE_SERVER_PORT", 8000))
+
+
+# Chunking
+# Chunks are sized in the embedding model's own tokens. multilingual-e5-large
+# reads 512 (including 2 special tokens), the rest is dropped by truncate: END,
+# so the default leaves a little headroom below that.
+CHUNK_TOKENIZER = os.getenv("HSAGE_CHUNK_TOKENIZER", "intfloat/multilingual-e5-large")
+EMBED_MAX_TOKENS = int(os.getenv("HSAGE_EMBED_MAX_TOKENS", 512))
+CHUNK_MAX_TOKENS = int(os.getenv("HSAGE_CHUNK_MAX_TOKENS", 480))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("HSAGE_CHUNK_OVERLAP_TOKENS", 64))
+
+
+# Job queue (job_queue.py)
+# Background find_test / test_example / workflow jobs live in this SQLite file.
+# A worker holds a job for JOB_LEASE_SECONDS (renewed while it runs), failed
+# jobs are retried after JOB_RETRY_BACKOFF * 2^(attempt - 1) seconds.
+JOB_QUEUE_PATH = os.getenv("HSAGE_JOB_QUEUE_PATH", "hsage_jobs.db")
+JOB_WORKERS = int(os.getenv("HSAGE_JOB_WORKERS", 4))
+JOB_MAX_ATTEMPTS = int(os.getenv("HSAGE_JOB_MAX_ATTEMPTS", 3))
+JOB_LEASE_SECONDS = float(os.getenv("HSAGE_JOB_LEASE_SECONDS", 600))
+JOB_RETRY_BACKOFF = float(os.getenv("HSAGE_JOB_RETRY_BACKOFF", 30))
+JOB_POLL_INTERVAL = float(os.getenv("HSAGE_JOB_POLL_INTERVAL", 1.0))
+
+
+# Workflow step store (step_store.py)
+# StatisticsWorkflow saves the router's decision and every tool call's result
+# here as soon as it finishes, keyed by the run and the call's inputs. Every
+# run gets a new id; passing it back as resume_id replays the finished steps
+# and only re-runs the ones that failed or never finished. Steps older than
+# WORKFLOW_STORE_TTL seconds are ignored. Set the path to "" to turn it off.
+WORKFLOW_STORE_PATH = os.getenv("HSAGE_WORKFLOW_STORE_PATH", "hsage_steps.db")
+WORKFLOW_STORE_TTL = float(os.getenv("HSAGE_WORKFLOW_STORE_TTL", 86400))
+
+# Profiling (--profile)
+# Profiles are written to PROFILE_DIR. The stack sampler looks at every thread
+# each PROFILE_SAMPLE_INTERVAL seconds, and the summary lists the top N functions.
+PROFILE_DIR = os.getenv("HSAGE_PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("HSAGE_PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_TOP_N = int(os.getenv("HSAGE_PROFILE_TOP_N", 15))
+
+
+# Adaptive retrieval depth
+# Each tool that builds a prompt from query_db (explain, find_test,
+# test_example) retrieves up to top_k chunks, then stops where the similarity drops
+# by more than max_gap from one chunk to the next (never below min_k chunks).
+# Definitional explain queries need a few chunks, find_test wants more
+# candidates. With a reranker the cut runs on rerank scores instead, with
+# rerank_max_gap: it is on Cohere's 0-1 relevance scale and multiplied by
+# RERANK_GAP_SCALE for the cross-encoder, whose scores are logits.
+# Override with HSAGE_RETRIEVAL_<TOOL>_TOP_K / _MIN_K / _MAX_GAP / _RERANK_MAX_GAP,
+# HSAGE_ADAPTIVE_RETRIEVAL=0 goes back to TOP_K (or RERANK_TOP_N) everywhere.
+ADAPTIVE_RETRIEVAL = os.getenv("HSAGE_ADAPTIVE_RETRIEVAL", "1") != "0"
+RERANK_GAP_SCALE = float(
+    os.getenv("HSAGE_RERANK_GAP_SCALE", 10.0 if RERANKER == "cross-encoder" else 1.0)
+)
+
+
+def _retrieval_profile(tool, top_k, min_k, max_gap, rerank_max_gap):
+    prefix = f"HSAGE_RETRIEVAL_{tool.upper()}"
+    return {
+        "top_k": int(os.getenv(f"{prefix}_TOP_K", top_k)),
+        "min_k": int(os.getenv(f"{prefix}_MIN_K", min_k)),
+        "max_gap": float(os.getenv(f"{prefix}_MAX_GAP", max_gap)),
+        "rerank_max_gap": float(
+            os.getenv(f"{prefix}_RERANK_MAX_GAP", rerank_max_gap * RERANK_GAP_SCALE)
+        ),
+    }
+
+
+RETRIEVAL_PROFILES = {
+    "explain": _retrieval_profile(
+        "explain", top_k=4, min_k=1, max_gap=0.04, rerank_max_gap=0.15
+    ),
+    "find_test": _retrieval_profile(
+        "find_test", top_k=10, min_k=4, max_gap=0.08, rerank_max_gap=0.25
+    ),
+    "test_example": _retrieval_profile(
+        "test_example", top_k=5, min_k=2, max_gap=0.05, rerank_max_gap=0.2
+    ),
+}
@@ -0,0 +1,397 @@
+# This file contains the offline benchmark harness.
+# It starts the stand-in providers from stub_providers.py, points every client
+# at them, and drives each CLI command and the StatisticsWorkflow at fixed
+# concurrency levels. Provider latency is injected, so what we measure on top
+# of it is our own orchestration overhead.
+#
+# python benchmark.py --concurrency 1,4,16 --requests 32 --output bench.json
+# python benchmark.py --baseline bench.json   # fails if overhead regressed
+# python benchmark.py --retrieval fixed,adaptive   # retrieval depth before/after
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import typer
+from pydantic import BaseModel
+from rich.console import Console
+from rich.table import Table
+from rich.text import Text
+
+from stub_providers import (
+    RECORDINGS_PATH,
+    parse_latency,
+    start_stub_server,
+    stub_environment,
+)
+
+# queries chosen to hit each recorded path in bench_recordings.json
+QUERIES = {
+    "query": "What is the difference between Type I and Type II errors?",
+    "explain": "What is the central limit theorem?",
+    "find_test": "I want to compare the effectiveness of three different "
+    "teaching methods on student test scores",
+    "test_example": ("t-test", "Comparing mean heights of two groups"),
+    "workflow": [
+        "which test should I use to compare three teaching methods?",
+        "make me a bunch of examples for applying statistical tests "
+        "to Youtube Videos on a given channel",
+        "what is the central limit theorem?",
+    ],
+}
+
+DEFAULT_LATENCY = (
+    "pinecone_inference=0.05,pinecone_index=0.05,cohere=0.4,baseten=1.0,openai=0.4"
+)
+
+# dummy settings so the clients can be built without real credentials
+OFFLINE_ENVIRONMENT = {
+    "PINECONE_API_KEY": "offline",
+    "COHERE_API_KEY": "offline",
+    "BASETEN_API_KEY": "offline",
+    "COHERE_MODEL": "command-r-plus",
+    "BASETEN_MODEL_ID": "offline",
+    "STATWIKI_INDEX": "statwiki",
+    "EMBEDDING_MODEL": "multilingual-e5-large",
+    "TOP_K": "5",
+}
+
+
+class BenchResult(BaseModel):
+    """
+    Throughput and latency distribution for one target at one concurrency level.
+    overhead is wall time minus time spent in provider calls.
+    error_kinds counts the failed requests by exception type and message.
+    """
+
+    target: str
+    concurrency: int
+    # "adaptive" (per-tool retrieval profiles) or "fixed" (TOP_K everywhere)
+    retrieval: str = "adaptive"
+    requests: int
+    errors: int
+    error_kinds: Dict[str, int] = {}
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+    mean: float
+    overhead_p50: float
+    overhead_p95: float
+    chunks_per_prompt: float = 0.0
+
+
+def _percentile(samples, q):
+    # imported lazily, telemetry reads the environment we set up in main()
+    from telemetry import percentile
+
+    return percentile(sorted(samples), q)
+
+
+def _chunks_per_prompt(reports):
+    prompts = sum(report.context_prompts for report in reports)
+    chunks = sum(report.context_chunks for report in reports)
+    return chunks / prompts if prompts else 0.0
+
+
+def _record_error(target, errors, e):
+    """
+    Keep the failure's type and message, and print the first one in full.
+    """
+    if not errors:
+        typer.echo(f"{target}: first error", err=True)
+        traceback.print_exception(type(e), e, e.__traceback__, file=sys.stderr)
+    errors.append(f"{type(e).__name__}: {e}")
+
+
+def _summarize(target, concurrency, latencies, overheads, errors, elapsed, reports):
+    return BenchResult(
+        target=target,
+        concurrency=concurrency,
+        requests=len(latencies) + len(errors),
+        errors=len(errors),
+        error_kinds=dict(Counter(errors).most_common()),
+        throughput=len(latencies) / elapsed if elapsed else 0.0,
+        p50=_percentile(latencies, 0.5),
+        p95=_percentile(latencies, 0.95),
+        p99=_percentile(latencies, 0.99),
+        mean=sum(latencies) / len(latencies) if latencies else 0.0,
+        overhead_p50=_percentile(overheads, 0.5),
+        overhead_p95=_percentile(overheads, 0.95),
+        chunks_per_prompt=_chunks_per_prompt(reports),
+    )
+
+
+def _provider_time(report):
+    return sum(call.wall_time for call in report.calls)
+
+
+def cli_targets():
+    """
+    The Typer command functions, called directly so rendering is included.
+    """
+    import hsage_cli
+
+    return {
+        "query": lambda: hsage_cli.query(QUERIES["query"]),
+        "explain": lambda: hsage_cli.explain_this(QUERIES["explain"]),
+        "find_test": lambda: hsage_cli.find_best_test(QUERIES["find_test"]),
+        "test_example": lambda: hsage_cli.make_example(*QUERIES["test_example"]),
+    }
+
+
+def bench_cli_target(target, fn, concurrency, requests) -> BenchResult:
+    from usage_ledger import request_ledger
+
+    latencies, overheads, errors, reports = [], [], [], []
+
+    def one(_):
+        with request_ledger(target) as ledger:
+            start = time.perf_counter()
+            fn()
+            wall = time.perf_counter() - start
+        report = ledger.report()
+        reports.append(report)
+        return wall, max(0.0, wall - _provider_time(report))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(one, i) for i in range(requests)]
+        for future in futures:
+            try:
+                wall, overhead = future.result()
+                latencies.append(wall)
+                overheads.append(overhead)
+            except Exception as e:
+                _record_error(target, errors, e)
+    elapsed = time.perf_counter() - start
+    return _summarize(
+        target, concurrency, latencies, overheads, errors, elapsed, reports
+    )
+
+
+async def bench_workflow(concurrency, requests) -> BenchResult:
+    from hsage_workflow import StatisticsWorkflow
+
+    latencies, overheads, errors, reports = [], [], [], []
+    semaphore = asyncio.Semaphore(concurrency)
+    queries = QUERIES["workflow"]
+
+    async def one(i):
+        async with semaphore:
+            w = StatisticsWorkflow(timeout=240, verbose=False)
+            start = time.perf_counter()
+            try:
+                result = await w.run(query=queries[i % len(queries)])
+            except Exception as e:
+                _record_error("workflow", errors, e)
+                return
+            wall = time.perf_counter() - start
+            latencies.append(wall)
+            reports.append(result.usage)
+            overheads.append(max(0.0, wall - _provider_time(result.usage)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    return _summarize(
+        "workflow", concurrency, latencies, overheads, errors, elapsed, reports
+    )
+
+
+def print_results(results: List[BenchResult]):
+    console = Console()
+    table = Table(title="Offline benchmark", show_header=True)
+    table.add_column("Target", style="cyan")
+    table.add_column("Concurrency", justify="right")
+    table.add_column("Retrieval")
+    table.add_column("Requests", justify="right")
+    table.add_column("Errors", justify="right", style="red")
+    table.add_column("Req/s", justify="right", style="green")
+    table.add_column("p50", justify="right")
+    table.add_column("p95", justify="right")
+    table.add_column("p99", justify="right")
+    table.add_column("Overhead p50", justify="right", style="magenta")
+    table.add_column("Overhead p95", justify="right", style="magenta")
+    table.add_column("Chunks/prompt", justify="right")
+    for r in results:
+        table.add_row(
+            r.target,
+            str(r.concurrency),
+            r.retrieval,
+            str(r.requests),
+            str(r.errors),
+            f"{r.throughput:.2f}",
+            f"{r.p50:.3f}s",
+            f"{r.p95:.3f}s",
+            f"{r.p99:.3f}s",
+            f"{r.overhead_p50 * 1000:.1f}ms",
+            f"{r.overhead_p95 * 1000:.1f}ms",
+            f"{r.chunks_per_prompt:.1f}",
+        )
+    console.print(table)
+    for r in results:
+        for kind, count in r.error_kinds.items():
+            # error messages may contain [brackets], so no markup
+            console.print(
+                Text.assemble(
+                    (f"{r.target} @ {r.concurrency} ({r.retrieval}): ", "red"),
+                    f"{count} x {kind}",
+                )
+            )
+
+
+def print_retrieval_comparison(results: List[BenchResult]):
+    """
+    Fixed TOP_K vs adaptive retrieval depth, per target and concurrency.
+    """
+    by_key = {(r.target, r.concurrency, r.retrieval): r for r in results}
+    table = Table(title="Retrieval depth: fixed -> adaptive", show_header=True)
+    table.add_column("Target", style="cyan")
+    table.add_column("Concurrency", justify="right")
+    table.add_column("Chunks/prompt", justify="right")
+    table.add_column("Mean latency", justify="right")
+    table.add_column("p95", justify="right")
+    for (target, concurrency, retrieval), fixed in by_key.items():
+        adaptive = by_key.get((target, concurrency, "adaptive"))
+        if retrieval != "fixed" or adaptive is None:
+            continue
+        table.add_row(
+            target,
+            str(concurrency),
+            f"{fixed.chunks_per_prompt:.1f} -> {adaptive.chunks_per_prompt:.1f}",
+            f"{fixed.mean:.3f}s -> {adaptive.mean:.3f}s",
+            f"{fixed.p95:.3f}s -> {adaptive.p95:.3f}s",
+        )
+    Console().print(table)
+
+
+def find_regressions(
+    results: List[BenchResult], baseline: List[BenchResult], tolerance: float
+):
+    """
+    Compare overhead p95 against a previous run. A small absolute floor keeps
+    millisecond-level noise from failing the check.
+    """
+    previous = {(r.target, r.concurrency, r.retrieval): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get((r.target, r.concurrency, r.retrieval))
+        if old is None:
+            continue
+        allowed = max(old.overhead_p95 * (1 + tolerance), old.overhead_p95 + 0.005)
+        if r.overhead_p95 > allowed:
+            regressions.append((r, old))
+    return regressions
+
+
+def use_offline_environment(server, governed=False, llm=None):
+    """
+    Point every client at the stand-in server. Has to run before hsage
+    (or anything reading agent_configs) is imported. llm picks the LLM
+    backend for every role, e.g. "openai" (answered by the stand-in server)
+    or "mock" (no HTTP at all).
+    """
+    os.environ.update(stub_environment(server))
+    if llm:
+        os.environ["HSAGE_LLM_BACKEND"] = llm
+    for key, value in OFFLINE_ENVIRONMENT.items():
+        os.environ.setdefault(key, value)
+    if not governed:
+        # measure our overhead, not the rate limiter's queueing
+        for provider in (
+            "pinecone_inference",
+            "pinecone_index",
+            "cohere",
+            "baseten",
+            "openai",
+        ):
+            os.environ[f"HSAGE_{provider.upper()}_RPS"] = "100000"
+            os.environ[f"HSAGE_{provider.upper()}_BURST"] = "100000"
+            os.environ[f"HSAGE_{provider.upper()}_CONCURRENCY"] = "1000"
+            os.environ.pop(f"HSAGE_{provider.upper()}_TPM", None)
+
+
+def main(
+    targets: str = typer.Option(
+        "query,explain,find_test,test_example,workflow", help="Comma separated."
+    ),
+    concurrency: str = typer.Option("1,4,16", help="Comma separated levels."),
+    requests: int = typer.Option(32, help="Requests per target per level."),
+    latency: str = typer.Option(
+        DEFAULT_LATENCY, help="Injected seconds per provider, e.g. cohere=0.4"
+    ),
+    jitter: float = typer.Option(0.1, help="+/- fraction of random latency jitter."),
+    recordings: str = RECORDINGS_PATH,
+    governed: bool = typer.Option(
+        False, help="Keep the configured rate limits instead of lifting them."
+    ),
+    retrieval: str = typer.Option(
+        "adaptive",
+        help="Comma separated: adaptive, fixed. Both compares the two.",
+    ),
+    llm: Optional[str] = typer.Option(
+        None, help="LLM backend for every role: cohere, baseten, openai or mock."
+    ),
+    output: Optional[str] = typer.Option(None, help="Write results as JSON."),
+    baseline: Optional[str] = typer.Option(None, help="Previous results JSON."),
+    tolerance: float = typer.Option(0.2, help="Allowed overhead p95 regression."),
+):
+    """
+    Benchmark the CLI commands and workflow against local stand-in providers.
+    """
+    server = start_stub_server(0, parse_latency(latency), jitter, recordings)
+    use_offline_environment(server, governed, llm)
+
+    import hsage
+
+    selected = [t.strip() for t in targets.split(",") if t.strip()]
+    levels = [int(c) for c in concurrency.split(",") if c.strip()]
+    modes = [m.strip() for m in retrieval.split(",") if m.strip()]
+    results = []
+    # the commands render with Rich, send that to /dev/null and keep our table
+    with open(os.devnull, "w") as devnull:
+        for mode in modes:
+            hsage.adaptive_retrieval = mode == "adaptive"
+            for level in levels:
+                for target in selected:
+                    with contextlib.redirect_stdout(devnull):
+                        if target == "workflow":
+                            result = asyncio.run(bench_workflow(level, requests))
+                        else:
+                            result = bench_cli_target(
+                                target, cli_targets()[target], level, requests
+                            )
+                    result.retrieval = mode
+                    results.append(result)
+    server.shutdown()
+
+    print_results(results)
+    if len(modes) > 1:
+        print_retrieval_comparison(results)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump([r.model_dump() for r in results], f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            previous = [BenchResult.model_validate(r) for r in json.load(f)]
+        regressions = find_regressions(results, previous, tolerance)
+        for new, old in regressions:
+            typer.echo(
+                f"REGRESSION {new.target} @ {new.concurrency}: overhead p95 "
+                f"{old.overhead_p95 * 1000:.1f}ms -> {new.overhead_p95 * 1000:.1f}ms"
+            )
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -1,60 +1,155 @@
 import json
+from functools import lru_cache
+
 import pandas as pd
 from tqdm import tqdm
-
-
-# Function to count tokens (approximation)
-def count_tokens(text):
-    return len(text.split())
+from lexical_index import BM25Index
+from retrieval_filters import is_junk_title
+from near_dedup import find_near_duplicates, savings_report
+from text_utils import SENTENCE_SPLIT
+from agent_configs import (
+    LEXICAL_INDEX_PATH,
+    CHUNK_TOKENIZER,
+    CHUNK_MAX_TOKENS,
+    CHUNK_OVERLAP_TOKENS,
+    EMBED_MAX_TOKENS,
+)
+
+
+# Function to count tokens with the embedding model's own tokenizer.
+# multilingual-e5-large only reads 512 tokens, anything past that is truncated
+# by the embed call, so chunks are sized in its tokens, not in words.
+@lru_cache(maxsize=1)
+def embedding_tokenizer():
+    try:
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError(
+            "Tokenizer-accurate chunking needs transformers installed"
+        ) from e
+    return AutoTokenizer.from_pretrained(CHUNK_TOKENIZER)
+
+
+def token_counts(texts):
+    if not texts:
+        return []
+    encoded = embedding_tokenizer()(texts, add_special_tokens=False)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+# The old chunker, split every 1024 whitespace words.
+# Only kept to report how much it lost to truncation.
+def chunk_text_words(text, max_words=1024):
+    words = text.split()
+    return [" ".join(words[i : i + max_words]) for i in range(0, len(words), max_words)]
+
+
+def _pieces(text, max_tokens):
+    """
+    (sentence, tokens) pairs. A sentence that is too long for a chunk on its
+    own is cut into runs of whole words that fit.
+    """
+    sentences = [s for s in SENTENCE_SPLIT.split(text) if s.strip()]
+    pieces = []
+    for sentence, tokens in zip(sentences, token_counts(sentences)):
+        if tokens <= max_tokens:
+            pieces.append((sentence, tokens))
+            continue
+        words = sentence.split()
+        run, run_tokens = [], 0
+        for word, word_tokens in zip(words, token_counts(words)):
+            if run and run_tokens + word_tokens > max_tokens:
+                pieces.append((" ".join(run), run_tokens))
+                run, run_tokens = [], 0
+            run.append(word)
+            run_tokens += word_tokens
+        if run:
+            pieces.append((" ".join(run), run_tokens))
+    return pieces
 
 
 # Function to chunk text into sections
-def chunk_text(text, max_tokens=1024):
-    words = text.split()
+def chunk_text(text, max_tokens=CHUNK_MAX_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    """
+    Pack whole sentences into chunks of at most max_tokens model tokens.
+    Each chunk starts with up to `overlap` tokens of trailing sentences
+    from the one before, so an idea split across a boundary is in both.
+    """
     chunks = []
-    current_chunk = []
-
-    for word in words:
-        current_chunk.append(word)
-        if count_tokens(" ".join(current_chunk)) >= max_tokens:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = []  # Reset for the next chunk
-
-    # Add any remaining words as a final chunk
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
+    current, current_tokens = [], 0
+
+    for piece, tokens in _pieces(text, max_tokens):
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(" ".join(p for p, _ in current))
+            # carry the tail of the chunk over as overlap
+            carried, carried_tokens = [], 0
+            for p, t in reversed(current):
+                if carried_tokens + t > overlap:
+                    break
+                carried.insert(0, (p, t))
+                carried_tokens += t
+            while carried and carried_tokens + tokens > max_tokens:
+                carried_tokens -= carried.pop(0)[1]
+            current, current_tokens = carried, carried_tokens
+        current.append((piece, tokens))
+        current_tokens += tokens
+
+    # Add any remaining sentences as a final chunk
+    if current:
+        chunks.append(" ".join(p for p, _ in current))
 
     return chunks
 
 
 # Function to chunk an article
-def chunk_article(article, max_tokens=1024):
+def chunk_article(article, chunker=chunk_text):
+    """
+    (section title, chunk) pairs. Sections are chunked separately,
+    so a chunk never spans two sections.
+    """
     chunks = []
 
     # Chunk the summary
     if "summary" in article:
-        chunks.extend(chunk_text(article["summary"], max_tokens))
+        chunks.extend((None, chunk) for chunk in chunker(article["summary"]))
 
     # Chunk the sections
     if "sections" in article:
-        for _, section_text in article["sections"].items():
-            chunks.extend(chunk_text(section_text, max_tokens))
+        for section, section_text in article["sections"].items():
+            chunks.extend((section, chunk) for chunk in chunker(section_text))
 
     return chunks
 
 
-# write a function that checks the file for how many chunks can be in it
-# print this number
+def truncation_report(chunks, limit=EMBED_MAX_TOKENS):
+    """
+    How many tokens the embed call would drop (truncate: END) from these chunks.
+    The model's limit includes its two special tokens.
+    """
+    usable = limit - 2
+    counts = token_counts(chunks)
+    wasted = sum(max(0, n - usable) for n in counts)
+    return {
+        "chunks": len(chunks),
+        "tokens": sum(counts),
+        "truncated_chunks": sum(n > usable for n in counts),
+        "truncated_tokens": wasted,
+        "truncated_share": wasted / sum(counts) if counts else 0.0,
+        "max_tokens": max(counts, default=0),
+    }
+
+
+# write a function that checks the file for how many chunks can be in it,
+# and how many tokens the old and new chunkers lose to truncation
 def check_file(file):
-    count = 0
-    total_tokens = 0
+    before, after = [], []
     for line in tqdm(file):
         article = json.loads(line)
-        article_chunks = chunk_article(article)
-        count += len(article_chunks)
-        for chunk in article_chunks:
-            total_tokens += count_tokens(chunk)
-    return count, total_tokens
+        if is_junk_title(article["title"]):
+            continue
+        before.extend(chunk for _, chunk in chunk_article(article, chunk_text_words))
+        after.extend(chunk for _, chunk in chunk_article(article))
+    return {"before": truncation_report(before), "after": truncation_report(after)}
 
 
 # Example usage
@@ -64,30 +159,37 @@ if __name__ == "__main__":
     with open("wikipedia_articles.jsonl", "r") as file:
         # print diagnostics of token and chunk count with descriptors
         print("Checking file...")
-        chunk_count, total_tokens = check_file(file)  # Store results
-        print("Number of chunks: ", chunk_count)
-        print("Total tokens: ", total_tokens)
+        waste = check_file(file)  # Store results
+        for name, label in (("before", "1024-word chunks"), ("after", "Token chunks")):
+            report = waste[name]
+            print(
+                f"{label}: {report['chunks']} chunks, {report['tokens']} tokens, "
+                f"{report['truncated_tokens']} truncated "
+                f"({report['truncated_share']:.1%}, "
+                f"{report['truncated_chunks']} chunks over the limit)"
+            )
 
         # Reset file pointer to the beginning for further processing
         file.seek(0)  # Reset file pointer
 
         # Initialize an empty list to store the data
         data = []
+        dropped = 0
 
         for line in tqdm(file):
             article = json.loads(line)
+            # Template, talk, category etc. pages are junk for retrieval,
+            # drop them before they are ever embedded
+            if is_junk_title(article["title"]):
+                dropped += 1
+                continue
             # Chunk the article
             article_chunks = chunk_article(article)
 
             # Iterate over each chunk and its index within the article
-            for chunk_index, chunk in enumerate(article_chunks, start=1):
-                # Extract section title if available
-                section_title = None
-                for section, content in article.get("sections", {}).items():
-                    if chunk in content:
-                        section_title = section
-                        break
-
+            for chunk_index, (section_title, chunk) in enumerate(
+                article_chunks, start=1
+            ):
                 # Append the data to the list
                 data.append(
                     {
@@ -98,7 +200,41 @@ if __name__ == "__main__":
                     }
                 )
 
+        print("Dropped template/talk pages: ", dropped)
+
         # Convert the list to a pandas dataframe
         df = pd.DataFrame(data)
 
+        # Related articles repeat each other's summaries,
+        # drop near-duplicate chunks before anyone pays to embed them
+        print("Removing near-duplicate chunks...")
+        texts = df["Chunk Content"].tolist()
+        kept, duplicates = find_near_duplicates(texts)
+        report = savings_report(texts, duplicates)
+        print("Near-duplicates dropped: ", report["dropped"])
+        print("Embedding tokens saved: ", report["embedding_tokens_saved"])
+        print(f"Embedding cost saved: ${report['embedding_cost_saved']:.4f}")
+        print(f"Index size saved: {report['index_bytes_saved'] / 1e6:.1f}MB")
+        # keep a record of what was dropped in favour of what, for spot checks
+        titles = df["Article Title"].tolist()
+        pd.DataFrame(
+            [
+                {
+                    "Dropped Title": titles[dup],
+                    "Kept Title": titles[original],
+                    "Dropped Chunk": texts[dup],
+                }
+                for dup, original in duplicates.items()
+            ]
+        ).to_csv("dropped_duplicates.csv", index=False)
+        df = df.iloc[kept].reset_index(drop=True)
+
         df.to_csv("article_chunks.csv", index=False)
+
+        # Build the BM25 index over the same chunks. Ids match the row index,
+        # which is what upsert_and_embed_pinecone.py uses as the Pinecone id.
+        print("Building lexical index...")
+        metadata = df.fillna("").to_dict("records")
+        BM25Index.build(df.index.astype(str).tolist(), metadata).save(
+            LEXICAL_INDEX_PATH
+        )
@@ -0,0 +1,130 @@
+# This file contains the context assembly stage between query_db and the LLMs.
+# Instead of joining every retrieved chunk into one huge string, we order the
+# matches by score, drop duplicates, optionally keep only the sentences that
+# overlap the query, and stop once the token budget is spent.
+import re
+from typing import List, Optional
+
+from agent_configs import CONTEXT_TOKEN_BUDGET, CONTEXT_EXTRACT_SENTENCES
+from text_utils import SENTENCE_SPLIT
+from usage_ledger import current_ledger, estimate_tokens
+
+WORD = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "the", "and", "for", "are", "with", "that", "this", "what", "how", "which",
+    "from", "into", "does", "can", "should", "use", "find", "test", "tests",
+    "statistical", "related", "they", "able", "answer", "question", "provide",
+}  # fmt: skip
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().split())
+
+
+def _terms(text: str) -> set:
+    return {w for w in WORD.findall(text.lower()) if len(w) > 2} - STOPWORDS
+
+
+def dedupe_chunks(chunks: List[str]) -> List[str]:
+    """
+    Drop exact duplicates and chunks fully contained in one we already kept.
+    Expects chunks in score order, so the better scoring copy survives.
+    """
+    kept, kept_normalized = [], []
+    for chunk in chunks:
+        normalized = _normalize(chunk)
+        if not normalized:
+            continue
+        if any(normalized in other for other in kept_normalized):
+            continue
+        kept.append(chunk)
+        kept_normalized.append(normalized)
+    return kept
+
+
+def extract_relevant_sentences(chunks: List[str], query: str, budget: int):
+    """
+    Rank every sentence by how many query terms it shares (ties go to the
+    better scoring chunk), fill the budget, then put the survivors back in
+    their original order so the text still reads naturally.
+    """
+    query_terms = _terms(query)
+    sentences = []
+    for chunk_rank, chunk in enumerate(chunks):
+        for position, sentence in enumerate(SENTENCE_SPLIT.split(chunk)):
+            overlap = len(query_terms & _terms(sentence))
+            sentences.append((overlap, chunk_rank, position, sentence))
+
+    # sentences with no overlap are only used if nothing else matched
+    ranked = sorted(sentences, key=lambda s: (-s[0], s[1], s[2]))
+    if any(s[0] for s in ranked):
+        ranked = [s for s in ranked if s[0]]
+
+    selected, used = [], 0
+    for sentence in ranked:
+        tokens = estimate_tokens(sentence[3])
+        if used + tokens > budget:
+            continue
+        selected.append(sentence)
+        used += tokens
+
+    selected.sort(key=lambda s: (s[1], s[2]))
+    return [s[3] for s in selected]
+
+
+def trim_to_budget(chunks: List[str], budget: int) -> List[str]:
+    """
+    Keep whole chunks in order until the budget runs out, then cut the next one
+    at a sentence boundary (or a word boundary if it has no sentences).
+    """
+    kept, used = [], 0
+    for chunk in chunks:
+        tokens = estimate_tokens(chunk)
+        if used + tokens <= budget:
+            kept.append(chunk)
+            used += tokens
+            continue
+        remaining = budget - used
+        partial = ""
+        for sentence in SENTENCE_SPLIT.split(chunk):
+            candidate = f"{partial} {sentence}".strip()
+            if estimate_tokens(candidate) > remaining:
+                break
+            partial = candidate
+        if not partial:
+            # a single runaway sentence, cut on words
+            partial = chunk[: remaining * 4].rsplit(" ", 1)[0]
+        if partial:
+            kept.append(partial)
+        break
+    return kept
+
+
+def assemble_context(
+    matches,
+    query: Optional[str] = None,
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    extract_sentences: bool = CONTEXT_EXTRACT_SENTENCES,
+) -> str:
+    """
+    Turn query_db matches into prompt context: order by score, dedupe,
+    optionally extract query-relevant sentences, and trim to the token budget.
+    The before/after token counts go into the current usage ledger.
+    """
+    ordered = sorted(matches, key=lambda item: item["score"], reverse=True)
+    chunks = [item["metadata"]["Chunk Content"] for item in ordered]
+    tokens_before = estimate_tokens(" ".join(chunks))
+
+    chunks = dedupe_chunks(chunks)
+    if extract_sentences and query:
+        chunks = extract_relevant_sentences(chunks, query, budget)
+    else:
+        chunks = trim_to_budget(chunks, budget)
+    context = " ".join(chunks)
+
+    ledger = current_ledger()
+    if ledger is not None:
+        ledger.record_context(
+            tokens_before, estimate_tokens(context), chunks=len(ordered)
+        )
+    return context
@@ -0,0 +1,138 @@
+# This file contains the micro-batcher for query embeddings.
+# Under load every query_db call used to send its own single-input embed
+# request, even though the endpoint takes up to 96 inputs. The batcher holds
+# concurrent requests for a few milliseconds, sends them as one call and
+# scatters the vectors back to the waiting threads.
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from agent_configs import EMBED_BATCH_WINDOW_MS, EMBED_MAX_BATCH, EMBED_BATCH_WORKERS
+from rate_limiter import NORMAL, current_priority
+from telemetry import span
+from usage_ledger import UsageLedger, estimate_tokens, record_call, use_ledger
+
+
+class _Pending:
+    def __init__(self, text: str, level: int):
+        self.text = text
+        self.level = level
+        self.future = Future()
+
+
+class EmbeddingBatcher:
+    """
+    Collects embed requests from many threads into batched calls.
+    embed_fn(texts, priority) does the actual (metered) call and returns one
+    vector per text. A batch goes out at the most urgent priority in it.
+    Each caller records its share of the batch's tokens into its own ledger.
+    """
+
+    def __init__(
+        self,
+        embed_fn: Callable[[List[str], Optional[int]], List[List[float]]],
+        provider="pinecone_inference",
+        window_ms: float = EMBED_BATCH_WINDOW_MS,
+        max_batch: int = EMBED_MAX_BATCH,
+        workers: int = EMBED_BATCH_WORKERS,
+    ):
+        self.embed_fn = embed_fn
+        self.provider = provider
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pool = None
+        self.batches = 0
+        self.inputs = 0
+
+    def _start(self):
+        with self._lock:
+            if self._pool is not None:
+                return
+            self._pool = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="embed-batch"
+            )
+            threading.Thread(target=self._collect, daemon=True).start()
+
+    def embed(self, text: str) -> List[float]:
+        """
+        Embed one text, possibly together with other threads' texts.
+        """
+        if self.window <= 0:
+            return self.embed_fn([text], None)[0]
+        self._start()
+        level = current_priority()
+        pending = _Pending(text, NORMAL if level is None else level)
+        start = time.perf_counter()
+        self._queue.put(pending)
+        vector, share = pending.future.result()
+        record_call(
+            self.provider,
+            "embed_batched",
+            request_bytes=len(text.encode()),
+            wall_time=time.perf_counter() - start,
+            **share,
+        )
+        return vector
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._flush, batch)
+
+    def _flush(self, batch: List[_Pending]):
+        # identical queries (retries, fan-out from one workflow) go out once
+        texts = list(dict.fromkeys(p.text for p in batch))
+        ledger = UsageLedger("embed_batch")
+        try:
+            with span("embed_batch", size=len(texts), waiting=len(batch)):
+                with use_ledger(ledger):
+                    vectors = self.embed_fn(texts, min(p.level for p in batch))
+        except Exception as e:
+            for pending in batch:
+                pending.future.set_exception(e)
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.inputs += len(texts)
+        calls = ledger.report().calls
+        call = calls[-1] if calls else None
+        by_text = dict(zip(texts, vectors))
+        total_chars = sum(len(p.text) for p in batch) or 1
+        for pending in batch:
+            share = {
+                "input_tokens": estimate_tokens(pending.text),
+                "estimated_tokens": True,
+            }
+            if call is not None:
+                # split the batch's real token count by text length
+                share = {
+                    "input_tokens": round(
+                        call.input_tokens * len(pending.text) / total_chars
+                    ),
+                    "retries": call.retries,
+                    "estimated_tokens": call.estimated_tokens,
+                }
+            pending.future.set_result((by_text[pending.text], share))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "inputs": self.inputs,
+                "avg_batch": self.inputs / self.batches if self.batches else 0.0,
+            }
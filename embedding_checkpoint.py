@@ -0,0 +1,104 @@
+# This file contains the on-disk checkpoint for embedding runs.
+# Embedding the corpus is a long, paid run. Instead of holding every vector in
+# a Python list until the end, each batch is written into a memory-mapped
+# float32 file as soon as it comes back, and a small manifest records which
+# row offsets are done. A crashed or rate limited run picks up after the last
+# completed batch.
+import hashlib
+import json
+import os
+from typing import List
+
+import numpy as np
+
+MANIFEST = "manifest.json"
+VECTORS = "vectors.f32"
+
+
+def fingerprint(texts: List[str]) -> str:
+    """
+    Identifies the input, so a checkpoint is never resumed against other chunks.
+    """
+    digest = hashlib.sha256()
+    for text in texts:
+        digest.update(text.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class EmbeddingCheckpoint:
+    """
+    vectors.f32 holds rows x dimension float32s, manifest.json the completed
+    batches as {"offset", "count", "tokens"}. The manifest is only rewritten
+    after the batch's vectors are flushed, so it never points at missing data.
+    """
+
+    def __init__(self, path, rows: int, dimension: int, source: str):
+        self.path = path
+        self.rows = rows
+        self.dimension = dimension
+        self.source = source
+        self.batches = []
+        os.makedirs(path, exist_ok=True)
+
+        manifest = self._read_manifest()
+        resumable = manifest is not None and (
+            manifest["rows"] == rows
+            and manifest["dimension"] == dimension
+            and manifest["source"] == source
+            and os.path.exists(os.path.join(path, VECTORS))
+        )
+        self.vectors = np.memmap(
+            os.path.join(path, VECTORS),
+            dtype=np.float32,
+            mode="r+" if resumable else "w+",
+            shape=(rows, dimension),
+        )
+        if resumable:
+            self.batches = manifest["batches"]
+        else:
+            self._write_manifest()
+
+    @classmethod
+    def open(cls, path, texts: List[str], dimension: int):
+        return cls(path, len(texts), dimension, fingerprint(texts))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_manifest(self):
+        manifest = {
+            "rows": self.rows,
+            "dimension": self.dimension,
+            "source": self.source,
+            "batches": self.batches,
+        }
+        tmp = os.path.join(self.path, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def completed_rows(self) -> int:
+        return sum(batch["count"] for batch in self.batches)
+
+    def is_done(self, offset: int) -> bool:
+        return any(batch["offset"] == offset for batch in self.batches)
+
+    def write_batch(self, offset: int, vectors, tokens: int = 0):
+        """
+        Persist one batch of vectors starting at row offset.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.vectors[offset : offset + len(vectors)] = vectors
+        self.vectors.flush()
+        self.batches.append({"offset": offset, "count": len(vectors), "tokens": tokens})
+        self._write_manifest()
+
+    def complete(self) -> bool:
+        return self.completed_rows() >= self.rows
@@ -1,28 +1,52 @@
 from pinecone import Pinecone
-from typing import Optional, Type, Dict, Any
-import cohere
-from llama_index.llms.cohere import Cohere
-import requests
-import json
+from typing import Optional, Type
+from concurrent.futures import Future
+import contextvars
+from contextlib import contextmanager
+import threading
 from pydantic import ValidationError, BaseModel
 
 # our own stuff
 from stat_structures import TestExample, FindTestResponse
+from usage_ledger import (
+    metered_call,
+    estimate_tokens,
+    pinecone_embed_usage,
+    pinecone_query_usage,
+)
+from telemetry import span, timed
+from context_budget import assemble_context
+from lexical_index import load_lexical_index, rrf_fuse, tokenize
+from retrieval_filters import MetadataFilter, DEFAULT_FILTER
+from local_vector_index import load_local_index
+from rerank import rerank
+from embed_batcher import EmbeddingBatcher
+from stat_catalog import catalog_response
+from llm_backends import get_backend
 
 # agent configs
 from agent_configs import (
     STATWIKI_INDEX,
     EMBEDDING_MODEL,
     TOP_K,
-    COHERE_MODEL,
+    LEXICAL_TOP_K,
+    EXACT_MATCH_TOP_K,
+    FILTER_OVERFETCH,
+    VECTOR_BACKEND,
+    LOCAL_VECTOR_INDEX_PATH,
+    RERANKER,
+    RERANK_CANDIDATES,
+    RERANK_TOP_N,
+    SPECULATIVE_MIN_OVERLAP,
+    ADAPTIVE_RETRIEVAL,
+    RETRIEVAL_PROFILES,
+    PINECONE_HOST,
+    PINECONE_INDEX_HOST,
     COHERE_SYSTEM_PROMPT,
-    BASETEN_MODEL_ID,
     BASETEN_SYSTEM_PROMPT,
     EXAMPLE_TEST_PROMPT,
     FIND_TEST_PROMPT,
     PINECONE_API_KEY,
-    COHERE_API_KEY,
-    BASETEN_API_KEY,
 )
 
 # Load environment variables
@@ -32,182 +56,341 @@ load_dotenv()
 
 # Initialize Pinecone
 
-pc = Pinecone(api_key=PINECONE_API_KEY)
-
+pc = Pinecone(api_key=PINECONE_API_KEY, host=PINECONE_HOST)
 
-# Cohere setup
-# modify tool choice if it doesn't work...
-llm_cohere = Cohere(model="command-r-plus", api_key=COHERE_API_KEY)
-co = cohere.Client(api_key=COHERE_API_KEY)
 
+@timed("get_chat_response")
+def get_chat_response(query, context=None, role="explain"):
+    """
+    A plain text answer from the role's LLM backend (Cohere by default),
+    with the retrieved context alongside the query.
+    """
+    return get_backend(role).chat(query, system=COHERE_SYSTEM_PROMPT, context=context)
 
-# Baseten Setup
 
-# import basemodel
+@timed("get_structured_response")
+def get_structured_response(
+    query: str, context: str, json_structure: Type[BaseModel], role: str
+) -> BaseModel:
+    """
+    Structured generation from the role's LLM backend (Baseten by default),
+    validated against json_structure.
+    This is useful for structured generation of text into our assumptions
+    """
+    return get_backend(role).structured(
+        query, json_structure, system=BASETEN_SYSTEM_PROMPT, context=context
+    )
 
 
-def get_baseten_response(
-    query: str, context: str, json_structure: Type[BaseModel]
-) -> Dict[str, Any]:
+def explain(query, tool="explain"):
     """
-    Get a response from the Baseten API, using a specified json schema.
-    This is useful for structured generation of text into our assumptions
-    This is specifically for only getting structured responses
+    Query the Pinecone DB for information.
+    If the agent can't answer based on query results, return 'I don't know.'
+    Useful for explaining concepts, or providing context for other tools.
+    """
+    # from response, collect the context
+    matches = retrieve(query, tool=tool)
+    context = assemble_context(matches, query=query)
 
+    response = get_chat_response(query, context=context)
 
+    return response
+
+
+def explain_stream(query):
     """
+    Same as explain, but yields the answer text as the model generates it.
+    """
+    matches = retrieve(query, tool="explain")
+    context = assemble_context(matches, query=query)
+    yield from get_backend("explain").chat_stream(
+        query, system=COHERE_SYSTEM_PROMPT, context=context
+    )
 
-    payload = {
-        "messages": [
-            {"role": "system", "content": BASETEN_SYSTEM_PROMPT},
-            (
-                {"role": "user", "content": "The context for the query is: " + context}
-                if context
-                else None
-            ),
-            {"role": "user", "content": query},
-        ],
-        "max_tokens": 8192,
-        "response_format": {
-            "type": "json_schema",
-            "json_schema": {"schema": json_structure.model_json_schema()},
-        },
-    }
-    url = f"https://model-{BASETEN_MODEL_ID}.api.baseten.co/production/predict"
-    headers = {"Authorization": f"Api-Key {BASETEN_API_KEY}"}
-    resp = requests.post(url, json=payload, headers=headers)
-
-    # Add error handling and logging
-    try:
-        resp.raise_for_status()  # This will raise an exception for HTTP errors
 
-        # Print the raw response for debugging
-        # print("Raw API response:", resp.text)
+def _as_match(item):
+    """
+    Plain dict version of a Pinecone match, so vector and lexical hits look alike.
+    """
+    return {"id": item["id"], "score": item["score"], "metadata": item["metadata"]}
 
-        # Try to parse the JSON response
-        json_response = resp.json()
 
-        # Validate the response against the expected structure
-        return json_structure(**json_response)
-    except requests.RequestException as e:
-        print(f"API request failed: {e}")
-        raise
-    except json.JSONDecodeError as e:
-        print(f"Failed to parse JSON response: {e}")
-        print("Raw response content:", resp.text)
-        raise
-    except ValidationError as e:
-        print(f"Response doesn't match expected structure: {e}")
-        raise
+def search_pinecone(
+    query_vector, metadata_filter: Optional[MetadataFilter], top_k: int = TOP_K
+):
+    index = pc.Index(STATWIKI_INDEX, host=PINECONE_INDEX_HOST)
+
+    # exact include/exclude lists run in Pinecone, regexes run here,
+    # so over-fetch when we have to filter on our side
+    server_filter = metadata_filter.to_pinecone_filter() if metadata_filter else None
+    client_side = metadata_filter is not None and metadata_filter.has_regex()
+    response = metered_call(
+        "pinecone_index",
+        "query",
+        index.query,
+        usage_fn=pinecone_query_usage,
+        vector=query_vector,
+        top_k=top_k * FILTER_OVERFETCH if client_side else top_k,
+        filter=server_filter,
+        include_metadata=True,
+    )
+    matches = [_as_match(item) for item in response["matches"]]
+    if client_side:
+        matches = metadata_filter.apply(matches)[:top_k]
+    return matches
 
 
-def get_cohere_response(
-    query, json_structure=None, context=None, enforce_json_structure=False
+def search_local_index(
+    query_vector, metadata_filter: Optional[MetadataFilter], top_k: int = TOP_K
 ):
     """
-    Get a response from the Cohere API, using a specified json schema.
-    This is useful for reformatting responses into specific structures.
+    Search the int8 quantized local index instead of Pinecone.
+    Filters are a precomputed mask, so no over-fetching is needed.
     """
-    system_prompt = COHERE_SYSTEM_PROMPT
-    response_format = {"type": "text"}
-
-    if context:
-        system_prompt += f"The context for the query is: {context}"
-
-    if enforce_json_structure:
-        if json_structure:
-            system_prompt += " You must generate syntactically correct JSON."
-            schema = json_structure.model_json_schema(mode="serialization")
-            # Check the depth of the schema
-            depth = get_json_depth(schema)
-            # console.print(f"[bold blue]Schema Depth:[/bold blue] {depth}")
-            if depth > 5:
-                raise ValueError("JSON schema exceeds the maximum depth of 5 levels")
-            response_format = {"type": "json_object", "schema": schema}
-        else:
-            raise ValueError(
-                "json_structure must be provided when enforce_json_structure is True"
-            )
+    index = load_local_index()
+    if index is None:
+        raise FileNotFoundError(
+            f"No local vector index at {LOCAL_VECTOR_INDEX_PATH}, "
+            "build it with local_vector_index.py"
+        )
+    return index.search(query_vector, top_k, mask=index.mask_for(metadata_filter))
 
-    # Debug print to verify response_format
-    # console.print(f"[bold blue]ResponseFormat:[/bold blue] {response_format}")
 
-    response = co.chat(
-        model=COHERE_MODEL,
-        # replaces Cohere system prompt
-        preamble=system_prompt,
-        message=query,
-        response_format=response_format,
-        temperature=0.1,
+@timed("embed_queries")
+def embed_queries(queries, priority=None):
+    """
+    One embed call for a list of queries, returns one vector per query.
+    """
+    query_embedding = metered_call(
+        "pinecone_inference",
+        "embed",
+        pc.inference.embed,
+        EMBEDDING_MODEL,
+        usage_fn=pinecone_embed_usage,
+        request_bytes=sum(len(q.encode()) for q in queries),
+        input_tokens=sum(estimate_tokens(q) for q in queries),
+        priority=priority,
+        inputs=queries,
+        parameters={"input_type": "query", "truncate": "END"},
     )
+    return [embedding["values"] for embedding in query_embedding]
 
-    response_content = response.text
-    # this allows for rewriting if json structure is invalid.
-    if response_format["type"] == "json_object":
-        if validate_json_structure(response_content, json_structure):
-            return response_content
-        else:
-            raise ValueError("Invalid JSON structure")
-    else:
-        return response_content
 
+# concurrent query_db calls share embed requests, see embed_batcher.py
+query_batcher = EmbeddingBatcher(embed_queries)
 
-def get_json_depth(d, level=1):
+
+def _similarity(match):
+    # fused matches keep the vector similarity as source 0 (see rrf_fuse),
+    # lexical-only hits have none
+    if "source_scores" in match:
+        return match["source_scores"].get(0)
+    return match["score"]
+
+
+def score_gap_cutoff(matches, min_k=1, max_gap=None, score=lambda m: m["score"]):
     """
-    Helper function to determine the depth of a JSON-like dictionary.
+    Keep as many matches as there are scores before the first drop of more
+    than max_gap, but never fewer than min_k. The gaps are measured on the
+    scores sorted best first, so a list in another order (fused, where a
+    lexical hit can sit between two strong vector hits) is cut at the same
+    depth, not at its first out-of-order score. Matches without a score
+    (score returns None, lexical-only hits) don't count toward the depth.
     """
-    if not isinstance(d, dict) or not d:
-        return level
-    return max(get_json_depth(v, level + 1) for v in d.values())
+    if max_gap is None:
+        return matches
+    scores = sorted(
+        (s for s in (score(match) for match in matches) if s is not None),
+        reverse=True,
+    )
+    depth = len(scores)
+    for i in range(max(min_k, 1), len(scores)):
+        if scores[i - 1] - scores[i] > max_gap:
+            depth = i
+            break
+    # unscored matches ride along, the cut falls before the first scored
+    # match past the depth
+    cut, seen = len(matches), 0
+    for i, match in enumerate(matches):
+        if score(match) is not None:
+            seen += 1
+            if seen > depth:
+                cut = i
+                break
+    return matches[: max(cut, min_k)]
+
+
+@timed("query_db")
+def query_db(
+    query,
+    metadata_filter: Optional[MetadataFilter] = DEFAULT_FILTER,
+    top_k: int = TOP_K,
+    min_k: int = 1,
+    max_gap: Optional[float] = None,
+):
+    """
+    Retrieve chunks for a query from Pinecone (and the local lexical index).
+    metadata_filter restricts Article Title / Section Title, by default
+    there is none (ingest already drops template and talk pages).
+    With max_gap set, the results stop where vector similarity drops
+    sharply (see score_gap_cutoff).
+    """
+    speculative = _speculative.get()
+    if speculative is not None:
+        matches = speculative.reuse(query, metadata_filter, top_k)
+        if matches is not None:
+            return {"matches": score_gap_cutoff(matches, min_k, max_gap, _similarity)}
+
+    lexical_matches, title_matches = [], []
+    lexical_index = load_lexical_index()
+    if lexical_index is not None:
+        mask = lexical_index.mask_for(metadata_filter)
+        with span("query_db.lexical"):
+            # a query that is just an article's name ("Fisher's exact test")
+            # is answered from the lexical hit, no embedding or vector search
+            exact = lexical_index.exact_title_matches(
+                query, min(top_k, EXACT_MATCH_TOP_K), mask
+            )
+            if exact:
+                return {"matches": exact}
+            lexical_matches = lexical_index.search(query, LEXICAL_TOP_K, mask)
+            # an article named inside a longer question is boosted in the fusion
+            title_matches = lexical_index.title_matches(query, LEXICAL_TOP_K, mask)
+
+    with span("query_db.embed"):
+        query_vector = query_batcher.embed(query)
+
+    with span("query_db.search"):
+        if VECTOR_BACKEND == "local":
+            matches = search_local_index(query_vector, metadata_filter, top_k)
+        else:
+            matches = search_pinecone(query_vector, metadata_filter, top_k)
 
+    # the vector list stays first, _similarity reads its scores as source 0
+    extra = [found for found in (lexical_matches, title_matches) if found]
+    if extra:
+        matches = rrf_fuse([matches, *extra], top_k)
 
-def validate_json_structure(response, json_structure):
+    return {"matches": score_gap_cutoff(matches, min_k, max_gap, _similarity)}
+
+
+def _query_terms(query):
+    # "tests" and "test" should count as the same word here
+    return {t[:-1] if len(t) > 3 and t.endswith("s") else t for t in tokenize(query)}
+
+
+class SpeculativeRetrieval:
     """
-    Validate a response against a specified json structure.
+    query_db for a workflow's raw query, started alongside the router call
+    before we know which tool runs. Any query_db call inside use_speculative()
+    whose text is close enough (SPECULATIVE_MIN_OVERLAP of the shorter query's
+    words in the other) reuses the result instead of embedding and searching again.
     """
-    try:
-        json_structure.model_validate_json(response)
-        return True
-    except Exception as e:
-        print(e)
-        return False
 
-
-def explain(query):
+    def __init__(self, query, metadata_filter=DEFAULT_FILTER, top_k=None):
+        self.query = query
+        self.terms = _query_terms(query)
+        self.metadata_filter = metadata_filter
+        self.top_k = top_k or (
+            RERANK_CANDIDATES if RERANKER != "none" else max_retrieval_depth()
+        )
+        self.future = Future()
+
+    def start(self):
+        # copy the context so the retrieval records into the caller's ledger
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(self._run,), daemon=True).start()
+        return self
+
+    def _run(self):
+        try:
+            with span("query_db.speculative"):
+                result = query_db(self.query, self.metadata_filter, self.top_k)
+            self.future.set_result(result["matches"])
+        except Exception as e:
+            self.future.set_exception(e)
+
+    def matches(self, query) -> bool:
+        terms = _query_terms(query)
+        if not terms or not self.terms:
+            return False
+        overlap = len(terms & self.terms) / min(len(terms), len(self.terms))
+        return overlap >= SPECULATIVE_MIN_OVERLAP
+
+    def reuse(self, query, metadata_filter, top_k):
+        """
+        The speculative matches if they can stand in for this query_db call,
+        otherwise None (and the caller retrieves as usual).
+        """
+        key = metadata_filter.cache_key() if metadata_filter else None
+        own_key = self.metadata_filter.cache_key() if self.metadata_filter else None
+        if key != own_key or top_k > self.top_k or not self.matches(query):
+            return None
+        with span("query_db.speculative_wait"):
+            try:
+                matches = self.future.result()
+            except Exception:
+                return None
+        return matches[:top_k]
+
+
+_speculative = contextvars.ContextVar("hsage_speculative_retrieval", default=None)
+
+
+@contextmanager
+def use_speculative(speculative: Optional[SpeculativeRetrieval]):
     """
-    Query the Pinecone DB for information.
-    If the agent can't answer based on query results, return 'I don't know.'
-    Useful for explaining concepts, or providing context for other tools.
+    Let query_db calls inside the block reuse a speculative retrieval.
     """
-    # from response, collect the context
-    response = query_db(query)
-    context = " ".join(
-        [item["metadata"]["Chunk Content"] for item in response["matches"]]
-    )
+    token = _speculative.set(speculative)
+    try:
+        yield speculative
+    finally:
+        _speculative.reset(token)
 
-    response = get_cohere_response(query=query, context=context)
 
-    return response
+# benchmark.py turns this off to compare against the fixed depth
+adaptive_retrieval = ADAPTIVE_RETRIEVAL
 
 
-def query_db(query):
-    query_embedding = pc.inference.embed(
-        EMBEDDING_MODEL,
-        inputs=[query],  # Use the query for embedding
-        parameters={"input_type": "query", "truncate": "END"},
-    )
-    query_vector = query_embedding[0]["values"]
-    index = pc.Index(STATWIKI_INDEX)
+def retrieval_profile(tool):
+    """
+    How deep a tool retrieves (see RETRIEVAL_PROFILES). Without adaptive
+    retrieval every tool gets the fixed TOP_K (or RERANK_TOP_N).
+    """
+    if adaptive_retrieval and tool in RETRIEVAL_PROFILES:
+        return RETRIEVAL_PROFILES[tool]
+    top_k = TOP_K if RERANKER == "none" else RERANK_TOP_N
+    return {"top_k": top_k, "min_k": top_k, "max_gap": None, "rerank_max_gap": None}
 
-    # Add metadata filter to exclude Article Titles containing "Template Talk"
-    response = index.query(
-        vector=query_vector,
-        top_k=TOP_K,
-        include_metadata=True,
+
+def max_retrieval_depth():
+    return max(
+        [TOP_K] + [retrieval_profile(tool)["top_k"] for tool in RETRIEVAL_PROFILES]
     )
-    # filter the response to exclude articles with "Template talk" in the title
 
-    return response
+
+def retrieve(query, rerank_query=None, tool="explain"):
+    """
+    query_db, plus the optional rerank stage: with a reranker configured we
+    fetch RERANK_CANDIDATES chunks and keep the most relevant. How many
+    chunks come back depends on the tool's retrieval profile, the score gap
+    cutoff runs on vector similarity (max_gap), or on the rerank scores
+    (rerank_max_gap).
+    Returns the list of matches.
+    """
+    profile = retrieval_profile(tool)
+    if RERANKER == "none":
+        return query_db(
+            query,
+            top_k=profile["top_k"],
+            min_k=profile["min_k"],
+            max_gap=profile["max_gap"],
+        )["matches"]
+    candidates = query_db(query, top_k=RERANK_CANDIDATES)["matches"]
+    ranked = rerank(rerank_query or query, candidates, profile["top_k"])
+    # rerank scores are on the reranker's own scale, not cosine similarity
+    return score_gap_cutoff(ranked, profile["min_k"], profile["rerank_max_gap"])
 
 
 def find_test(situation):
@@ -218,19 +401,27 @@ def find_test(situation):
     and attempts to answer with the tests found.
     """
 
+    # common scenarios are answered from the precomputed test catalog,
+    # Baseten only sees the ones the catalog can't match confidently
+    with span("find_test.catalog"):
+        response = catalog_response(situation)
+    if response is not None:
+        return response
+
     prompt = FIND_TEST_PROMPT.format(situation=situation)
 
     # query the db for tests, and add them to the response
-    tests = query_db(
+    tests = retrieve(
         f"Find statistical tests related to {situation}. \
-        They should be able to answer the question."
+        They should be able to answer the question.",
+        rerank_query=situation,
+        tool="find_test",
     )
-    context = " ".join([item["metadata"]["Chunk Content"] for item in tests["matches"]])
-
-    prompt += f"Here are the tests we found: {context}"
+    # the tests we found only go in once, as the context message
+    context = assemble_context(tests, query=situation)
 
-    response = get_baseten_response(
-        prompt, context=context, json_structure=FindTestResponse
+    response = get_structured_response(
+        prompt, context=context, json_structure=FindTestResponse, role="find_test"
     )
 
     try:
@@ -253,7 +444,7 @@ def test_example(test_name: str, situation: Optional[str] = None):
     """
 
     additional_info = explain(
-        f"Provide context for {test_name}"
+        f"Provide context for {test_name}", tool="test_example"
     )  # Query for additional context
 
     prompt = EXAMPLE_TEST_PROMPT.format(
@@ -262,8 +453,8 @@ def test_example(test_name: str, situation: Optional[str] = None):
         or "A hypothetical scenario where we need to apply the test.",
     )
 
-    response = get_baseten_response(
-        query=prompt, context=additional_info, json_structure=TestExample
+    response = get_structured_response(
+        prompt, context=additional_info, json_structure=TestExample, role="test_example"
     )
 
     try:
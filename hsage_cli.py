@@ -1,34 +1,78 @@
 # This file contains the command line interface for Hypothesis Sage
-from rich.console import Console
+# first, so --profile can report how long the imports below took
+import startup_clock
+import asyncio
+import json
+import time
+from functools import lru_cache
+from rich.console import Console, Group
 from rich.table import Table
 from rich.markdown import Markdown
+from rich.text import Text
 from llama_index.core.tools import FunctionTool
 from llama_index.core.agent import ReActAgent
 from hsage import find_test, test_example, explain, query_db
 from stat_structures import FindTestResponse, TestExample
 import typer
-import os
-import llama_index.core
-from agent_configs import PHOENIX_API_KEY, COHERE_MODEL
-from typing import Optional
+from llm_backends import get_backend
+from rate_limiter import priority, INTERACTIVE
+from telemetry import configure_exporters, setup_phoenix
+from usage_ledger import UsageReport, start_request, finish_request
+from profiler import Profiler, format_summary
+from pydantic import BaseModel
+from typing import Any, Dict, List, Optional
+
+# rich: tables for people, json: one indented document,
+# ndjson: one object per line. Set by --output, the machine readable
+# modes never build a Rich object.
+OUTPUT_MODES = ("rich", "json", "ndjson")
+output_mode = "rich"
+show_stats = False
 
+# Phoenix setup
+# only traces to Phoenix when PHOENIX_API_KEY is set,
+# local metrics exporters are configured in telemetry.py
+setup_phoenix()
 
-# Rich Setup
-# rich setup
-console = Console()
 
-# Phoenix setup
-os.environ["OTEL_EXPORTER_OTLP_HEADERS"] = f"api_key={PHOENIX_API_KEY}"
-llama_index.core.set_global_handler(
-    "arize_phoenix", endpoint="https://llamatrace.com/v1/traces"
-)
+class QueryMatch(BaseModel):
+    id: str
+    score: float
+    metadata: Dict[str, Any]
+
+
+class QueryResult(BaseModel):
+    """
+    The chunks query_db found for a query, as written by --output json.
+    """
+
+    query: str
+    matches: List[QueryMatch]
+
+
+class Explanation(BaseModel):
+    query: str
+    explanation: str
+
+
+class AgentResponse(BaseModel):
+    query: str
+    response: str
+
+
+@lru_cache(maxsize=1)
+def get_console() -> Console:
+    """
+    One Rich console for the process, created the first time something renders.
+    """
+    return Console()
 
 
 def create_console_from_response(response):
     """
     Create a Rich console from a Pinecone Query response. It looks niiiiiice
     """
-    console = Console()
+    console = get_console()
 
     # Extract relevant information from the response
     titles = [item["metadata"]["Article Title"] for item in response["matches"]]
@@ -49,7 +93,7 @@ def create_console_from_response(response):
 
 def pretty_print_example(example: TestExample):
     """Pretty print the TestExample using Rich with markdown support."""
-    console = Console()
+    console = get_console()
 
     # Create a table to display the example details
     table = Table(
@@ -92,15 +136,19 @@ def pretty_print_example(example: TestExample):
     return console, table
 
 
+# None: the assumption wasn't checked (catalog answers)
+ASSUMPTION_MARKS = {True: "✅", False: "❌", None: "❔"}
+
+
 def pretty_print_tests(find_test_response: FindTestResponse):
     """Pretty print the FindTestResponse using Rich."""
-    console = Console()
+    console = get_console()
 
     # Create a table to display the situation
     situation_table = Table(title="Situation")
     situation_table.add_column("Situation", style="cyan")
     situation_table.add_row(find_test_response.situation)
-    console.print(situation_table)
+    tables = [situation_table]
 
     # Create a table for each recommended test
     for test_recommendation in find_test_response.recommended_tests:
@@ -118,7 +166,7 @@ def pretty_print_tests(find_test_response: FindTestResponse):
         ):
             assumptions_str = "\n".join(
                 [
-                    f"{'✅' if pass_status else '❌'} {description}"
+                    f"{ASSUMPTION_MARKS[pass_status]} {description}"
                     for description, pass_status in zip(
                         test_recommendation.assumptions_descriptions,
                         test_recommendation.assumptions_pass_statuses,
@@ -129,14 +177,190 @@ def pretty_print_tests(find_test_response: FindTestResponse):
         else:
             table.add_row("Assumptions", "None")
 
-        console.print(table)
+        tables.append(table)
+
+    return console, Group(*tables)
+
+
+def pretty_print_usage(report: UsageReport):
+    """Pretty print the token, byte, retry and wall time ledger for a request."""
+    console = get_console()
+
+    table = Table(
+        title=f"Usage: {report.command} ({report.wall_time:.2f}s)",
+        show_header=True,
+        header_style="bold magenta",
+    )
+    table.add_column("Provider", style="cyan", no_wrap=True)
+    table.add_column("Calls", justify="right")
+    table.add_column("Input Tokens", justify="right")
+    table.add_column("Output Tokens", justify="right")
+    table.add_column("Bytes Sent", justify="right")
+    table.add_column("Bytes Received", justify="right")
+    table.add_column("Retries", justify="right")
+    table.add_column("Wall Time", justify="right")
+    table.add_column("Cost", justify="right", style="green")
+
+    for totals in report.totals:
+        table.add_row(
+            totals.provider,
+            str(totals.calls),
+            str(totals.input_tokens),
+            str(totals.output_tokens),
+            str(totals.request_bytes),
+            str(totals.response_bytes),
+            str(totals.retries),
+            f"{totals.wall_time:.2f}s",
+            f"${totals.cost:.4f}",
+        )
+
+    captions = []
+    if report.rerank_tokens_before:
+        saved = 1 - report.rerank_tokens_after / report.rerank_tokens_before
+        captions.append(
+            f"Rerank: {report.rerank_tokens_before} -> "
+            f"{report.rerank_tokens_after} candidate tokens ({saved:.0%} smaller)"
+        )
+    if report.context_tokens_before:
+        saved = 1 - report.context_tokens_after / report.context_tokens_before
+        captions.append(
+            f"Context: {report.context_tokens_before} -> "
+            f"{report.context_tokens_after} tokens ({saved:.0%} smaller)"
+        )
+    if report.context_prompts:
+        captions.append(
+            f"Retrieved: {report.context_chunks} chunks over "
+            f"{report.context_prompts} prompts "
+            f"({report.context_chunks / report.context_prompts:.1f} per prompt)"
+        )
+    if report.replayed_steps:
+        captions.append(f"Replayed: {report.replayed_steps} steps from the step store")
+    failed = sum(call.failed for call in report.calls)
+    if failed:
+        captions.append(f"Failed: {failed} calls ran out of retries")
+    if any(call.estimated_tokens for call in report.calls):
+        captions.append("Some token counts are estimated (~4 characters per token)")
+    table.caption = "\n".join(captions) or None
+
+    return console, table
+
+
+def pretty_print_explanation(explanation: Explanation):
+    """Pretty print an explanation, the text itself is printed as is (no markup)."""
+    return get_console(), Group(
+        Text.from_markup("\n[bold green]Explanation:[/bold green]\n"),
+        Text(explanation.explanation + "\n"),
+    )
+
+
+def pretty_print_agent_response(response: AgentResponse):
+    return get_console(), Group(
+        Text.from_markup("\n[bold green]Final Response:[/bold green]"),
+        Markdown(response.response),
+    )
 
-    return console
+
+def pretty_print_query(result: QueryResult):
+    return create_console_from_response(result.model_dump())
+
+
+RENDERERS = {
+    QueryResult: pretty_print_query,
+    Explanation: pretty_print_explanation,
+    TestExample: pretty_print_example,
+    FindTestResponse: pretty_print_tests,
+    AgentResponse: pretty_print_agent_response,
+}
+
+
+def emit(result):
+    """
+    Write a command's result (a pydantic model or a list of them) to stdout
+    in the current output mode.
+    """
+    if output_mode is None:
+        return
+    items = result if isinstance(result, list) else [result]
+    if output_mode == "rich":
+        for item in items:
+            console, renderable = RENDERERS[type(item)](item)
+            console.print(renderable)
+    elif output_mode == "ndjson":
+        for item in items:
+            typer.echo(item.model_dump_json())
+    elif isinstance(result, list):
+        typer.echo(
+            json.dumps([item.model_dump(mode="json") for item in items], indent=2)
+        )
+    else:
+        typer.echo(result.model_dump_json(indent=2))
+
+
+def emit_usage(report: UsageReport):
+    """
+    The --stats ledger: a table in rich mode, otherwise JSON on stderr
+    so stdout stays pure data.
+    """
+    if output_mode == "rich":
+        console, table = pretty_print_usage(report)
+        console.print(table)
+    else:
+        typer.echo(report.model_dump_json(), err=True)
 
 
 app = typer.Typer()
 
 
+@app.callback()
+def main(
+    ctx: typer.Context,
+    stats: bool = typer.Option(
+        False,
+        "--stats",
+        help="Print tokens, bytes, retries and wall time per provider.",
+    ),
+    output: str = typer.Option(
+        "rich",
+        "--output",
+        help="rich (tables), json or ndjson (for scripts and batch runs).",
+    ),
+    profile: bool = typer.Option(
+        False,
+        "--profile",
+        help="Profile the command (cProfile, sampled stacks, spans) "
+        "into HSAGE_PROFILE_DIR and print a summary.",
+    ),
+):
+    """
+    Hypothesis Sage: statistical test recommendations, examples and explanations.
+    """
+    global output_mode, show_stats
+    if output not in OUTPUT_MODES:
+        raise typer.BadParameter(f"--output must be one of {', '.join(OUTPUT_MODES)}")
+    output_mode = output
+    show_stats = stats
+    configure_exporters()
+    command = ctx.invoked_subcommand or "hsage"
+    # workflow runs keep their own ledger and print it themselves
+    ledger = start_request(command) if command != "workflow" else None
+    profiler = None
+    if profile:
+        import_time = time.perf_counter() - startup_clock.STARTED
+        profiler = Profiler(command, import_time=import_time).start()
+
+    def print_stats():
+        if profiler:
+            # stderr, so it never mixes with --output json data
+            typer.echo(format_summary(profiler.stop()), err=True)
+        if ledger is None:
+            return
+        report = finish_request(ledger)
+        if stats:
+            emit_usage(report)
+
+    ctx.call_on_close(print_stats)
+
+
 @app.command()
 def query(q: str):
     """
@@ -146,8 +370,7 @@ def query(q: str):
 
     """
     response = query_db(q)
-    cs, table = create_console_from_response(response)
-    cs.print(table)
+    emit(QueryResult(query=q, matches=response["matches"]))
     return response
 
 
@@ -160,9 +383,7 @@ def make_example(test_name: str, situation: Optional[str] = None):
 
     """
     example = test_example(test_name, situation)
-
-    console, table = pretty_print_example(example)
-    console.print(table)
+    emit(example)
     return example
 
 
@@ -173,10 +394,8 @@ def find_best_test(prompt: str):
     Useful for finding the best test for a given situation.
     """
     test_response = find_test(prompt)
-    console = pretty_print_tests(test_response)
-    console.print()
+    emit(test_response)
     return test_response
-    # typer.echo(test_response)
 
 
 @app.command()
@@ -190,8 +409,7 @@ def explain_this(query: str):
 
     """
     explanation = explain(query)
-    console.print("\n[bold green]Explanation:[/bold green]\n")
-    typer.echo(explanation + "\n")
+    emit(Explanation(query=query, explanation=explanation))
     return explanation
 
 
@@ -204,21 +422,92 @@ find_test_tool = FunctionTool.from_defaults(fn=find_best_test)
 explain_tool = FunctionTool.from_defaults(fn=explain_this)
 
 
-statistics_agent = ReActAgent.from_tools(
-    [query_db_tool, test_example_tool, find_test_tool, explain_tool], llm=COHERE_MODEL
-)
+@lru_cache(maxsize=1)
+def statistics_agent() -> ReActAgent:
+    """
+    Built on first use, only `ask` needs the agent's LLM client.
+    """
+    return ReActAgent.from_tools(
+        [query_db_tool, test_example_tool, find_test_tool, explain_tool],
+        llm=get_backend("agent").llama_index_llm(),
+    )
 
 
 @app.command()
 def ask(query: str):
     """Launch an agentic query."""
-    console = Console()
-    console.print(f"\n[bold blue]Query:[/bold blue] {query}\n")
+    global output_mode
+    mode = output_mode
+    if mode == "rich":
+        get_console().print(f"\n[bold blue]Query:[/bold blue] {query}\n")
+    else:
+        # the agent's tools are the commands above, only the final answer is data
+        output_mode = None
+
+    # agent queries are interactive, so they go ahead of any batch work
+    try:
+        with priority(INTERACTIVE):
+            response = statistics_agent().chat(query)
+    finally:
+        output_mode = mode
 
-    response = statistics_agent.chat(query)
+    emit(AgentResponse(query=query, response=response.response))
+
+
+def workflow_items(query: str, result) -> list:
+    """
+    The models a workflow run produced: query_db and explain return a dict
+    and a string, the other tools already return pydantic models.
+    """
+    items = result if isinstance(result, list) else [result]
+    models = []
+    for item in items:
+        if isinstance(item, BaseModel):
+            models.append(item)
+        elif isinstance(item, dict) and "matches" in item:
+            models.append(QueryResult(query=query, matches=item["matches"]))
+        else:
+            models.append(Explanation(query=query, explanation=str(item)))
+    return models
 
-    console.print("\n[bold green]Final Response:[/bold green]")
-    console.print(Markdown(response.response))
+
+async def _run_workflow(w, **kwargs):
+    # Workflow.run returns a handler that needs a running event loop
+    return await w.run(**kwargs)
+
+
+@app.command()
+def workflow(
+    query: str,
+    resume_id: Optional[str] = typer.Option(
+        None, help="Resume an earlier run by the resume_id it printed."
+    ),
+    fresh: bool = typer.Option(
+        False, help="Re-run every step instead of replaying finished ones."
+    ),
+):
+    """
+    Run the StatisticsWorkflow, which routes the query to a tool
+    (or to generating several examples) and prints the result.
+    The resume_id goes to stderr first: pass it back with --resume-id to replay
+    the steps a timed out or failed run already finished.
+    """
+    from hsage_workflow import StatisticsWorkflow
+    from step_store import new_run_id
+
+    resume_id = resume_id or new_run_id()
+    typer.echo(f"resume_id: {resume_id}", err=True)
+
+    with priority(INTERACTIVE):
+        w = StatisticsWorkflow(timeout=240, verbose=False)
+        result = asyncio.run(
+            _run_workflow(w, query=query, resume_id=resume_id, fresh=fresh)
+        )
+    items = workflow_items(query, result.result)
+    emit(items if isinstance(result.result, list) else items[0])
+    if show_stats:
+        emit_usage(result.usage)
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,240 @@
+# This file contains the HTTP API for Hypothesis Sage.
+# One long-lived ASGI process serves the same tools as hsage_cli.py and runs
+# the StatisticsWorkflow, so the provider clients, local indexes, caches and
+# rate limiters stay warm and are shared across requests.
+#
+# python hsage_server.py            (or: uvicorn hsage_server:app)
+# curl -X POST localhost:8000/explain?stream=true -d '{"query": "what is a p-value?"}'
+import asyncio
+import json
+import threading
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, List, Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+from agent_configs import SERVER_HOST, SERVER_PORT
+from hsage import query_db, explain, explain_stream, find_test, test_example
+from hsage_workflow import StatisticsWorkflow, WorkflowResult
+from job_queue import Job, JobQueue
+from lexical_index import load_lexical_index
+from local_vector_index import load_local_index
+from rate_limiter import priority, INTERACTIVE, RateLimitedError
+from telemetry import configure_exporters
+from stat_catalog import load_catalog
+from usage_ledger import UsageLedger, UsageReport, use_ledger, finish_request
+
+
+class QueryRequest(BaseModel):
+    query: str
+
+
+class FindTestRequest(BaseModel):
+    situation: str
+
+
+class TestExampleRequest(BaseModel):
+    test_name: str
+    situation: Optional[str] = None
+
+
+class WorkflowRequest(BaseModel):
+    query: str
+    # resume an earlier run (see step_store.py), defaults to a new run
+    resume_id: Optional[str] = None
+    fresh: bool = False
+
+
+class JobRequest(BaseModel):
+    kind: str
+    payloads: List[dict]
+
+
+class ToolResult(BaseModel):
+    """
+    A tool's output plus the usage ledger for the request,
+    the same shape a workflow run returns.
+    """
+
+    result: Any
+    usage: UsageReport
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_exporters()
+    # load the local indexes once up front, not on the first request
+    await asyncio.to_thread(load_lexical_index)
+    await asyncio.to_thread(load_local_index)
+    await asyncio.to_thread(load_catalog)
+    yield
+
+
+app = FastAPI(title="Hypothesis Sage", lifespan=lifespan)
+
+
+@app.exception_handler(RateLimitedError)
+async def rate_limited(request: Request, exc: RateLimitedError):
+    return JSONResponse(status_code=429, content={"detail": str(exc)})
+
+
+async def run_tool(command: str, fn, *args) -> ToolResult:
+    """
+    Run a blocking hsage tool on a worker thread with its own usage ledger.
+    HTTP callers are waiting on the answer, so they get interactive priority.
+    """
+    ledger = UsageLedger(command)
+    with use_ledger(ledger), priority(INTERACTIVE):
+        result = await asyncio.to_thread(fn, *args)
+    return ToolResult(result=result, usage=finish_request(ledger))
+
+
+_DONE = object()
+
+
+async def stream_tool(command: str, generator_fn, *args):
+    """
+    Drive a blocking generator on a worker thread and hand its chunks
+    to the event loop as they arrive. If the client disconnects, the producer
+    stops at the next chunk and closes the generator (and its provider stream).
+    """
+    ledger = UsageLedger(command)
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            with use_ledger(ledger), priority(INTERACTIVE):
+                generator = generator_fn(*args)
+                try:
+                    for chunk in generator:
+                        if stop.is_set():
+                            break
+                        loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+                finally:
+                    generator.close()
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, _DONE)
+
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+    # close the ledger once the producer is done, whether or not the client stayed
+    producer.add_done_callback(lambda _: finish_request(ledger))
+    try:
+        while (chunk := await chunks.get()) is not _DONE:
+            yield chunk
+        await producer
+    finally:
+        stop.set()
+
+
+@app.post("/query", response_model=ToolResult)
+async def query(request: QueryRequest):
+    return await run_tool("query", query_db, request.query)
+
+
+@app.post("/explain")
+async def explain_this(request: QueryRequest, stream: bool = False):
+    if stream:
+        return StreamingResponse(
+            stream_tool("explain", explain_stream, request.query),
+            media_type="text/plain",
+        )
+    return await run_tool("explain", explain, request.query)
+
+
+@app.post("/find_test", response_model=ToolResult)
+async def find_best_test(request: FindTestRequest):
+    return await run_tool("find_test", find_test, request.situation)
+
+
+@app.post("/test_example", response_model=ToolResult)
+async def make_example(request: TestExampleRequest):
+    return await run_tool(
+        "test_example", test_example, request.test_name, request.situation
+    )
+
+
+async def _workflow_events(request: WorkflowRequest):
+    """
+    NDJSON: one line per event the workflow streams, then the result.
+    """
+    with priority(INTERACTIVE):
+        handler = StatisticsWorkflow(timeout=240, verbose=False).run(
+            **request.model_dump()
+        )
+    async for event in handler.stream_events():
+        if type(event).__name__ == "StopEvent":
+            continue
+        line = {"event": type(event).__name__, "data": event.model_dump(mode="json")}
+        yield json.dumps(line, default=str) + "\n"
+    result: WorkflowResult = await handler
+    line = {"event": "result", "data": result.model_dump(mode="json")}
+    yield json.dumps(line, default=str) + "\n"
+
+
+@app.post("/workflow")
+async def run_workflow(request: WorkflowRequest, stream: bool = False):
+    if stream:
+        return StreamingResponse(
+            _workflow_events(request), media_type="application/x-ndjson"
+        )
+    workflow = StatisticsWorkflow(timeout=240, verbose=False)
+    with priority(INTERACTIVE):
+        result: WorkflowResult = await workflow.run(**request.model_dump())
+    return result
+
+
+@lru_cache(maxsize=1)
+def job_queue() -> JobQueue:
+    return JobQueue()
+
+
+@app.post("/jobs")
+async def submit_jobs(request: JobRequest):
+    """
+    Queue background jobs for the job_queue.py workers, returns their ids.
+    """
+    try:
+        ids = await asyncio.to_thread(
+            job_queue().submit, request.kind, request.payloads
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"ids": ids}
+
+
+@app.get("/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: int):
+    job = await asyncio.to_thread(job_queue().get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    return job
+
+
+@app.get("/jobs")
+async def finished_jobs(since: int = 0):
+    """
+    NDJSON stream of jobs as they finish, after done_seq `since`.
+    """
+
+    async def events():
+        done_seq = since
+        while True:
+            jobs = await asyncio.to_thread(job_queue().finished_since, done_seq)
+            for job in jobs:
+                done_seq = job.done_seq
+                yield job.model_dump_json() + "\n"
+            if not jobs:
+                await asyncio.sleep(1)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(app, host=SERVER_HOST, port=SERVER_PORT)
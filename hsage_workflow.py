@@ -1,8 +1,4 @@
-from agent_configs import (
-    COHERE_MODEL,
-    COHERE_API_KEY,
-    PHOENIX_API_KEY,
-)
+from agent_configs import SPECULATIVE_RETRIEVAL
 from llama_index.core.tools import FunctionTool
 from llama_index.core.workflow import (
     Event,
@@ -13,26 +9,27 @@ from llama_index.core.workflow import (
     Context,
 )
 from typing import Optional, Any
+from pydantic import BaseModel
 from hsage import (
     query_db,
     find_test,
     test_example,
     explain,
+    SpeculativeRetrieval,
+    use_speculative,
 )
-import cohere
+from llm_backends import ToolCall, get_backend
+from rate_limiter import priority, current_priority, BATCH
+from usage_ledger import UsageLedger, UsageReport, use_ledger, finish_request
+from telemetry import configure_exporters, span, setup_phoenix
+from profiler import Profiler, format_summary
+from step_store import RESULT_MODELS, load_step_store, new_run_id, step_key
 import asyncio
-import llama_index.core
-import os
-from hsage_cli import pretty_print_example, pretty_print_tests
-
+import sys
 
-os.environ["OTEL_EXPORTER_OTLP_HEADERS"] = f"api_key={PHOENIX_API_KEY}"
-llama_index.core.set_global_handler(
-    "arize_phoenix", endpoint="https://llamatrace.com/v1/traces"
-)
-
-# Initialize Cohere client
-co = cohere.Client(api_key=COHERE_API_KEY)
+# only traces to Phoenix when PHOENIX_API_KEY is set,
+# local metrics exporters are configured in telemetry.py
+setup_phoenix()
 
 
 # Define custom events
@@ -44,6 +41,9 @@ class ToolCallEvent(Event):
     tool_name: str
     arguments: dict
     from_longer_workflow: Optional[bool] = False
+    # which of several identical fan-out calls this is, so each gets its own
+    # entry in the step store
+    slot: Optional[int] = None
 
 
 class TestRecommendationEvent(Event):
@@ -71,6 +71,18 @@ class FinalResponseEvent(Event):
     response: str
 
 
+class WorkflowResult(BaseModel):
+    """
+    What a StatisticsWorkflow run returns: the tool output(s),
+    plus the token and cost ledger for the whole run.
+    """
+
+    result: Any
+    usage: UsageReport
+    # pass it back as resume_id to resume this run (see step_store.py)
+    resume_id: Optional[str] = None
+
+
 class HelperEvent(Event):
     """
     Helps pass around tool call results that are not StopEvents
@@ -103,7 +115,9 @@ ASYNC_TOOLS = {
     )
 }
 
-cohere_tools = [
+# tools and workflow "tools" the router picks from,
+# every LLM backend takes them in this shape (see llm_backends.py)
+router_tools = [
     {
         "name": "query_db",
         "description": "Queries a database using an embedding model and \
@@ -193,14 +207,29 @@ cohere_tools = [
 ]
 
 
-def ask_cohere_for_tool_call(query: str, cohere_tools) -> str:
-    # only helper for inteacting with Cohere
+def ask_router_for_tool_call(query: str, tools) -> list[ToolCall]:
+    # only helper for interacting with the router's LLM backend
+    return get_backend("router").tool_call(query, tools)
+
 
-    response = co.chat(message=query, model=COHERE_MODEL, tools=cohere_tools)
+def step_store():
+    """
+    The step store, or None when it's turned off. Router decisions are
+    stored as the events they produced.
+    """
+    return load_step_store(models=RESULT_MODELS + (ToolCallEvent, ExampleCreationEvent))
 
-    # parse the response, and return the name.
 
-    return response.tool_calls
+def run_tool(run_id: str, key: str, tool_name: str, arguments: dict):
+    """
+    Run a tool and store its result right away, from the worker thread,
+    so it's kept even if the run times out while waiting for it.
+    """
+    result = TOOLS[tool_name](**arguments)
+    store = step_store()
+    if store is not None:
+        store.put(run_id, key, tool_name, result)
+    return result
 
 
 def decide_initial_workflow_tool(query: str) -> ToolCallEvent | ExampleCreationEvent:
@@ -218,7 +247,7 @@ def decide_initial_workflow_tool(query: str) -> ToolCallEvent | ExampleCreationE
     string mapping to the event we need.
     """
 
-    tool_result = ask_cohere_for_tool_call(query, cohere_tools)
+    tool_result = ask_router_for_tool_call(query, router_tools)
 
     # TODO: handle multiple tool calls and global message context
 
@@ -234,24 +263,64 @@ def decide_initial_workflow_tool(query: str) -> ToolCallEvent | ExampleCreationE
         return ToolCallEvent(tool_name=tool_name, arguments=tool_args)
 
 
-# import the pretty printing functions from hsage_cli
-
-# create dictionary to map tool names to pretty printing functions
-tool_name_to_pretty_printer = {
-    "test_example": pretty_print_example,
-    "find_test": pretty_print_tests,
-}
-
-
 # Define the workflow
 class StatisticsWorkflow(Workflow):
+    def run(self, *args, profile: bool = False, **kwargs):
+        """
+        profile=True profiles the whole run (see profiler.py) and prints
+        the summary to stderr when it finishes. That returns a coroutine to
+        await rather than the handler, so a profiled run can't be streamed.
+        """
+        if not profile:
+            return super().run(*args, **kwargs)
+        return self._profiled_run(*args, **kwargs)
+
+    async def _profiled_run(self, *args, **kwargs):
+        profiler = Profiler("workflow").start()
+        try:
+            return await super().run(*args, **kwargs)
+        finally:
+            print(format_summary(profiler.stop()), file=sys.stderr)
+
     @step
     async def router(
         self, ctx: Context, ev: StartEvent
     ) -> ToolCallEvent | ExampleCreationEvent:
         # how do I get the LLM to trigger a tool call OR exa
         query = ev.query
-        event = decide_initial_workflow_tool(query)
+        # a resume_id passed back resumes that run, otherwise this is a new one
+        # (not run_id, which Workflow.run keeps for itself);
+        # fresh=True throws away what an earlier attempt finished
+        run_id = ev.get("resume_id") or new_run_id()
+        store = step_store()
+        if store is not None and ev.get("fresh", False):
+            store.forget(run_id)
+        await ctx.store.set("run_id", run_id)
+        # one ledger per run, shared by every tool call the run makes
+        ledger = UsageLedger(command="workflow")
+        await ctx.store.set("ledger", ledger)
+        key = step_key("router", query)
+        found, event = store.get(run_id, key) if store is not None else (False, None)
+        if found:
+            ledger.record_replay()
+            await ctx.store.set("speculative", None)
+        else:
+            # routing is a blocking LLM call that may queue in the rate limiter,
+            # so keep it off the event loop
+            with span("workflow.router"), use_ledger(ledger):
+                # most tools start with query_db on roughly the raw query,
+                # so get retrieval going while the router decides
+                speculative = (
+                    SpeculativeRetrieval(query).start()
+                    if SPECULATIVE_RETRIEVAL
+                    else None
+                )
+                await ctx.store.set("speculative", speculative)
+                event = await asyncio.to_thread(decide_initial_workflow_tool, query)
+            if store is not None:
+                store.put(run_id, key, "router", event)
+        # lets streaming callers (hsage_server.py) see the routing decision
+        ctx.write_event_to_stream(event)
         return event
 
     @step(num_workers=10)
@@ -266,18 +335,34 @@ class StatisticsWorkflow(Workflow):
         """
         tool_name = ev.tool_name
         tool_arguments = ev.arguments
-        tool_result = await asyncio.to_thread(TOOLS[tool_name], **tool_arguments)
-
+        # fan-out calls from make_lots_of_examples queue behind interactive work
+        level = BATCH if ev.from_longer_workflow else current_priority()
+        ledger = await ctx.store.get("ledger")
+        speculative = await ctx.store.get("speculative", default=None)
+        run_id = await ctx.store.get("run_id")
+        store = step_store()
+        key = step_key("tool", tool_name, tool_arguments, ev.slot)
+        found, tool_result = (
+            store.get(run_id, key) if store is not None else (False, None)
+        )
+        if found:
+            ledger.record_replay()
+        else:
+            with span("workflow.tool_calling_step", tool=tool_name):
+                with priority(level), use_ledger(ledger), use_speculative(speculative):
+                    tool_result = await asyncio.to_thread(
+                        run_tool, run_id, key, tool_name, tool_arguments
+                    )
+
+        # steps only return results, callers decide how to print them
+        # (hsage_cli.py renders them with Rich or writes JSON)
         if ev.from_longer_workflow:
             return HelperEvent(result=tool_result)
-        else:
-            if tool_name == "test_example":
-                console, table = pretty_print_example(tool_result)
-                console.print(table)
-            if tool_name == "find_test":
-                console = pretty_print_tests(tool_result)
-                console.print()
-            return StopEvent(result=tool_result)
+        return StopEvent(
+            result=WorkflowResult(
+                result=tool_result, usage=finish_request(ledger), resume_id=run_id
+            )
+        )
 
     @step
     async def example_generation_step(
@@ -303,14 +388,19 @@ class StatisticsWorkflow(Workflow):
         checklist paper: https://arxiv.org/pdf/2410.03608
         modal whitepaper: https://modal.com/blog/llama-human-eval
         """
-        for _ in range(5):
-            ctx.send_event(
-                ToolCallEvent(
-                    tool_name="test_example",
-                    arguments={"test_name": ev.test_name, "situation": ev.situation},
-                    from_longer_workflow=True,
+        with span("workflow.example_generation_step"):
+            for slot in range(5):
+                ctx.send_event(
+                    ToolCallEvent(
+                        tool_name="test_example",
+                        arguments={
+                            "test_name": ev.test_name,
+                            "situation": ev.situation,
+                        },
+                        from_longer_workflow=True,
+                        slot=slot,
+                    )
                 )
-            )
         return None
 
     @step
@@ -323,19 +413,23 @@ class StatisticsWorkflow(Workflow):
         good_examples = []
         if collected_events is None:
             return None
-        good_examples = collected_events[:3]
-
-        for example in good_examples:
-            console, table = pretty_print_example(example.result)
-            console.print(table)
-
-        return StopEvent(result=good_examples)
+        good_examples = [event.result for event in collected_events[:3]]
+
+        ledger = await ctx.store.get("ledger")
+        return StopEvent(
+            result=WorkflowResult(
+                result=good_examples,
+                usage=finish_request(ledger),
+                resume_id=await ctx.store.get("run_id"),
+            )
+        )
 
 
 async def main(query: str):
+    configure_exporters()
     w = StatisticsWorkflow(timeout=240, verbose=False)
     result = await w.run(query=query)
-    print(result)
+    print(result.model_dump_json(indent=2))
 
 
 if __name__ == "__main__":
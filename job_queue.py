@@ -0,0 +1,454 @@
+# This file contains the durable job queue for long-running generation work.
+# Jobs (find_test, test_example, workflow runs) are rows in a SQLite file, so
+# a batch of thousands of scenarios survives the process dying. A pool of
+# worker processes claims jobs under a lease, stores each result as soon as it
+# is done and retries failures with backoff. The configured provider rate
+# limits are split between the workers, so the pool as a whole stays governed.
+#
+# python job_queue.py submit find_test --file scenarios.jsonl
+# python job_queue.py work --workers 4 --drain
+# python job_queue.py results --follow
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional
+
+import typer
+from pydantic import BaseModel
+
+from agent_configs import (
+    JOB_QUEUE_PATH,
+    JOB_WORKERS,
+    JOB_MAX_ATTEMPTS,
+    JOB_LEASE_SECONDS,
+    JOB_RETRY_BACKOFF,
+    JOB_POLL_INTERVAL,
+    PROVIDER_LIMITS,
+    METRICS_EXPORTERS,
+)
+
+JOB_KINDS = ("find_test", "test_example", "workflow")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_until REAL,
+    worker TEXT,
+    result TEXT,
+    error TEXT,
+    usage TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    done_seq INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, available_at, id);
+CREATE INDEX IF NOT EXISTS jobs_done ON jobs (done_seq);
+"""
+
+
+class Job(BaseModel):
+    """
+    One queued unit of work and, once it's done, its result and usage.
+    status is queued, running, done or failed (out of attempts).
+    """
+
+    id: int
+    kind: str
+    payload: dict
+    status: str
+    attempts: int
+    max_attempts: int
+    worker: Optional[str] = None
+    result: Any = None
+    error: Optional[str] = None
+    usage: Optional[dict] = None
+    created: float
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    done_seq: Optional[int] = None
+
+
+def _job(row) -> Job:
+    data = dict(row)
+    for field in ("payload", "result", "usage"):
+        if data[field] is not None:
+            data[field] = json.loads(data[field])
+    return Job(**data)
+
+
+def _to_json(value) -> str:
+    def default(o):
+        if hasattr(o, "model_dump"):
+            return o.model_dump(mode="json")
+        return str(o)
+
+    return json.dumps(value, default=default)
+
+
+class JobQueue:
+    """
+    SQLite-backed queue. Safe to share between threads (one connection behind
+    a lock) and between processes (each opens its own, WAL mode).
+    """
+
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def submit(self, kind: str, payloads: List[dict], max_attempts=JOB_MAX_ATTEMPTS):
+        """
+        Queue one job per payload, returns their ids.
+        """
+        if kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind {kind}, expected one of {JOB_KINDS}")
+        now = time.time()
+        ids = []
+        with self._transaction() as conn:
+            for payload in payloads:
+                cursor = conn.execute(
+                    "INSERT INTO jobs"
+                    " (kind, payload, max_attempts, available_at, created)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (kind, json.dumps(payload), max_attempts, now, now),
+                )
+                ids.append(cursor.lastrowid)
+        return ids
+
+    def claim(self, worker: str, lease=JOB_LEASE_SECONDS) -> Optional[Job]:
+        """
+        Take the oldest available job. Running jobs whose lease ran out
+        (their worker died) count as available again, unless they are out of
+        attempts: a job that keeps killing its worker is marked failed.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    "SELECT id, status, attempts, max_attempts FROM jobs"
+                    " WHERE (status = 'queued' AND available_at <= ?)"
+                    " OR (status = 'running' AND lease_until < ?)"
+                    " ORDER BY id LIMIT 1",
+                    (now, now),
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == "queued" or row["attempts"] < row["max_attempts"]:
+                    break
+                self._finish(
+                    conn,
+                    row["id"],
+                    "failed",
+                    error="Lease expired on the last attempt (worker died?)",
+                )
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker = ?,"
+                " attempts = attempts + 1, started = ?, lease_until = ? WHERE id = ?",
+                (worker, now, now + lease, row["id"]),
+            )
+            return _job(
+                conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+            )
+
+    def extend_lease(self, job_id: int, lease=JOB_LEASE_SECONDS):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                (time.time() + lease, job_id),
+            )
+
+    def _finish(self, conn, job_id, status, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        conn.execute(
+            f"UPDATE jobs SET status = ?, finished = ?, lease_until = NULL, {columns},"
+            " done_seq = (SELECT COALESCE(MAX(done_seq), 0) + 1 FROM jobs)"
+            " WHERE id = ?",
+            (status, time.time(), *fields.values(), job_id),
+        )
+
+    def complete(self, job_id: int, result, usage=None):
+        with self._transaction() as conn:
+            self._finish(
+                conn,
+                job_id,
+                "done",
+                result=_to_json(result),
+                usage=_to_json(usage) if usage is not None else None,
+                error=None,
+            )
+
+    def fail(self, job_id: int, error: str, backoff=JOB_RETRY_BACKOFF):
+        """
+        Requeue with exponential backoff, or mark failed once out of attempts.
+        """
+        with self._transaction() as conn:
+            job = _job(
+                conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            )
+            if job.attempts < job.max_attempts:
+                conn.execute(
+                    "UPDATE jobs SET status = 'queued', error = ?, lease_until = NULL,"
+                    " available_at = ? WHERE id = ?",
+                    (error, time.time() + backoff * 2 ** (job.attempts - 1), job_id),
+                )
+            else:
+                self._finish(conn, job_id, "failed", error=error)
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return _job(row) if row else None
+
+    def next_available(self) -> Optional[float]:
+        """
+        When the next unfinished job can be claimed: a queued job's backoff
+        ending or a running job's lease running out. None once every job is
+        done or failed.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MIN(CASE status WHEN 'queued' THEN available_at"
+                " ELSE lease_until END) AS at FROM jobs"
+                " WHERE status IN ('queued', 'running')"
+            ).fetchone()
+        return row["at"]
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"
+            ).fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def finished_since(self, done_seq: int = 0, limit=1000) -> List[Job]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM jobs WHERE done_seq > ? ORDER BY done_seq LIMIT ?",
+                (done_seq, limit),
+            ).fetchall()
+        return [_job(row) for row in rows]
+
+    def follow(self, done_seq: int = 0, poll=JOB_POLL_INTERVAL) -> Iterator[Job]:
+        """
+        Yield jobs as they finish, oldest first, forever.
+        """
+        while True:
+            jobs = self.finished_since(done_seq)
+            for job in jobs:
+                done_seq = job.done_seq
+                yield job
+            if not jobs:
+                time.sleep(poll)
+
+
+def run_job(job: Job):
+    """
+    Run one job in this process, returns (result, usage report).
+    """
+    import asyncio
+
+    from hsage import find_test, test_example
+    from rate_limiter import priority, BATCH
+    from usage_ledger import request_ledger
+
+    if job.kind == "workflow":
+        from hsage_workflow import StatisticsWorkflow
+
+        with priority(BATCH):
+            workflow = StatisticsWorkflow(timeout=JOB_LEASE_SECONDS, verbose=False)
+            # a retried job resumes the steps its earlier attempts finished
+            resume_id = (
+                job.payload.get("resume_id") or f"job-{job.id}-{job.created:.0f}"
+            )
+
+            async def run():
+                # Workflow.run needs a running event loop for its handler
+                return await workflow.run(
+                    query=job.payload["query"], resume_id=resume_id
+                )
+
+            result = asyncio.run(run())
+        return result.result, result.usage
+
+    tools = {"find_test": find_test, "test_example": test_example}
+    with priority(BATCH), request_ledger(job.kind) as ledger:
+        result = tools[job.kind](**job.payload)
+    return result, ledger.report()
+
+
+def worker_main(worker: str, path=JOB_QUEUE_PATH, drain=False):
+    """
+    Claim and run jobs until no job is left unfinished (drain) or forever.
+    Draining still waits out the backoff of jobs queued for a retry.
+    A heartbeat keeps the lease alive while a long job runs.
+    """
+    from telemetry import configure_exporters
+
+    # one /metrics port per machine, so workers only write JSONL / OTLP
+    configure_exporters([e for e in METRICS_EXPORTERS if e != "prometheus"])
+    queue = JobQueue(path)
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            wait = JOB_POLL_INTERVAL
+            if drain:
+                available = queue.next_available()
+                if available is None:
+                    return
+                wait = min(max(available - time.time(), 0.0), wait)
+            time.sleep(wait)
+            continue
+
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(JOB_LEASE_SECONDS / 3):
+                queue.extend_lease(job.id)
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            result, usage = run_job(job)
+            queue.complete(job.id, result, usage)
+        except Exception as e:
+            queue.fail(job.id, f"{type(e).__name__}: {e}")
+        finally:
+            stop.set()
+
+
+def share_limits(workers: int):
+    """
+    Every worker process has its own rate limiters, so give each one
+    its share of the configured limits (worker processes inherit os.environ).
+    """
+    for provider, limit in PROVIDER_LIMITS.items():
+        prefix = f"HSAGE_{provider.upper()}"
+        os.environ[f"{prefix}_RPS"] = str(limit["rps"] / workers)
+        os.environ[f"{prefix}_BURST"] = str(max(limit["burst"] / workers, 1.0))
+        os.environ[f"{prefix}_CONCURRENCY"] = str(
+            max(limit["concurrency"] // workers, 1)
+        )
+        if limit["tpm"]:
+            os.environ[f"{prefix}_TPM"] = str(limit["tpm"] / workers)
+
+
+def run_workers(workers=JOB_WORKERS, path=JOB_QUEUE_PATH, drain=False):
+    """
+    Start the pool and restart any worker that dies (crashed, OOM killed).
+    Workers that exit cleanly after draining the queue are left alone.
+    """
+    share_limits(workers)
+    context = multiprocessing.get_context("spawn")
+
+    def start(name):
+        process = context.Process(
+            target=worker_main, args=(name, path, drain), daemon=True
+        )
+        process.start()
+        return process
+
+    processes = {f"worker-{i}": None for i in range(workers)}
+    for name in processes:
+        processes[name] = start(name)
+    try:
+        while processes:
+            time.sleep(JOB_POLL_INTERVAL)
+            for name, process in list(processes.items()):
+                if process.is_alive():
+                    continue
+                if process.exitcode == 0:
+                    del processes[name]
+                    continue
+                # its job goes back to the queue when the lease runs out
+                print(
+                    f"{name} exited with {process.exitcode}, restarting",
+                    file=sys.stderr,
+                )
+                processes[name] = start(name)
+    except KeyboardInterrupt:
+        # running jobs go back to the queue when their lease runs out
+        for process in processes.values():
+            process.terminate()
+
+
+app = typer.Typer()
+
+
+@app.command()
+def submit(
+    kind: str,
+    file: Optional[str] = typer.Option(None, help="JSONL file, one payload per line."),
+    payload: Optional[str] = typer.Option(None, help="A single JSON payload."),
+    max_attempts: int = JOB_MAX_ATTEMPTS,
+):
+    """
+    Queue jobs, e.g. submit find_test --payload '{"situation": "..."}'
+    """
+    payloads = []
+    if file:
+        with open(file) as f:
+            payloads = [json.loads(line) for line in f if line.strip()]
+    if payload:
+        payloads.append(json.loads(payload))
+    ids = JobQueue().submit(kind, payloads, max_attempts)
+    typer.echo(
+        f"queued {len(ids)} {kind} jobs" + (f" ({ids[0]}-{ids[-1]})" if ids else "")
+    )
+
+
+@app.command()
+def work(workers: int = JOB_WORKERS, drain: bool = False):
+    """
+    Run a pool of worker processes. --drain exits once the queue is empty.
+    """
+    run_workers(workers, drain=drain)
+
+
+@app.command()
+def status():
+    typer.echo(json.dumps(JobQueue().counts()))
+
+
+@app.command()
+def results(since: int = 0, follow: bool = False):
+    """
+    Print finished jobs as NDJSON. --follow keeps streaming new ones.
+    """
+    queue = JobQueue()
+    # LIMIT -1 is no limit in SQLite
+    jobs = queue.follow(since) if follow else queue.finished_since(since, limit=-1)
+    for job in jobs:
+        typer.echo(job.model_dump_json())
+
+
+if __name__ == "__main__":
+    app()
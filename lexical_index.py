@@ -0,0 +1,226 @@
+# This file contains the local BM25 index over the chunk store.
+# Dense retrieval is good at "what test compares medians?", but bad at
+# "Kruskal–Wallis test", where it often ranks a general article above the exact
+# one. A small inverted index catches those exact-name lookups cheaply, and
+# reciprocal rank fusion merges both result lists in query_db.
+import gzip
+import json
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from agent_configs import LEXICAL_INDEX_PATH
+
+TOKEN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is",
+    "it", "of", "on", "or", "that", "the", "to", "was", "with", "what", "which",
+    "how", "do", "does", "i", "we", "can", "should", "they", "this", "these",
+}  # fmt: skip
+# words that can wrap a bare article name without asking anything more,
+# "explain Fisher's exact test", "how does a t-test work"
+QUERY_FILLER = {
+    "explain", "define", "definition", "describe", "tell", "me", "about",
+    "mean", "means", "meaning", "work", "works", "use", "used", "when",
+}  # fmt: skip
+# title words count this many times, so an article's own name outranks mentions
+TITLE_WEIGHT = 3
+RRF_K = 60
+
+
+def tokenize(text: str, keep_stopwords=False) -> List[str]:
+    """
+    Lowercase, strip accents, split "Kruskal–Wallis" into kruskal/wallis
+    and drop the possessive in "Fisher's".
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r"['’]s\b", "", text)
+    tokens = TOKEN.findall(text)
+    if keep_stopwords:
+        return tokens
+    return [t for t in tokens if t not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    Okapi BM25 over chunk content (plus weighted titles).
+    Doc ids are the same string ids we upsert into Pinecone,
+    so lexical and vector hits line up for fusion.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.ids: List[str] = []
+        self.metadata: List[dict] = []
+        self.doc_lengths: List[int] = []
+        self.postings: Dict[str, List[List[int]]] = {}
+        # normalized article title -> doc indexes, for exact-name lookups
+        self.titles: Dict[str, List[int]] = {}
+        self.avgdl = 0.0
+        # precomputed bitmap masks, one per metadata filter
+        self._masks = {}
+
+    @classmethod
+    def build(cls, ids: List[str], metadata: List[dict]):
+        index = cls()
+        postings = defaultdict(list)
+        titles = defaultdict(list)
+        for doc, (doc_id, meta) in enumerate(zip(ids, metadata)):
+            title = meta.get("Article Title") or ""
+            terms = tokenize(meta.get("Chunk Content") or "")
+            terms += tokenize(title) * TITLE_WEIGHT
+            for term, tf in Counter(terms).items():
+                postings[term].append([doc, tf])
+            index.ids.append(doc_id)
+            index.metadata.append(meta)
+            index.doc_lengths.append(len(terms))
+            titles[" ".join(tokenize(title, keep_stopwords=True))].append(doc)
+        index.postings = dict(postings)
+        index.titles = dict(titles)
+        index.avgdl = sum(index.doc_lengths) / max(len(index.doc_lengths), 1)
+        return index
+
+    def mask_for(self, metadata_filter):
+        """
+        Bitmap of docs the filter allows, computed once per filter.
+        """
+        if metadata_filter is None:
+            return None
+        key = metadata_filter.cache_key()
+        if key not in self._masks:
+            self._masks[key] = metadata_filter.mask(self.metadata)
+        return self._masks[key]
+
+    def idf(self, term: str) -> float:
+        n = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.ids) - n + 0.5) / (n + 0.5))
+
+    def _match(self, doc: int, score: float) -> dict:
+        return {"id": self.ids[doc], "score": score, "metadata": self.metadata[doc]}
+
+    def search(self, query: str, top_k: int, mask=None) -> List[dict]:
+        """
+        Top k chunks by BM25 score, in the same shape as Pinecone matches.
+        mask is an optional list of booleans, one per doc, of docs allowed.
+        """
+        scores = defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for doc, tf in postings:
+                if mask is not None and not mask[doc]:
+                    continue
+                norm = self.k1 * (
+                    1 - self.b + self.b * self.doc_lengths[doc] / self.avgdl
+                )
+                scores[doc] += idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return [self._match(doc, score) for doc, score in best]
+
+    def named_title(self, query: str) -> Optional[str]:
+        """
+        The article title of two or more words the query mentions, if any.
+        One-word titles like "Variance" show up in too many queries to trust.
+        """
+        words = tokenize(query, keep_stopwords=True)
+        padded = f" {' '.join(words)} "
+        named = [
+            title
+            for title in self.titles
+            if len(title.split()) >= 2 and f" {title} " in padded
+        ]
+        # the longest title wins, "kruskal wallis test" over "wallis test"
+        return max(named, key=len, default=None)
+
+    def title_matches(self, query: str, top_k: int, mask=None) -> List[dict]:
+        """
+        Best chunks of the article the query mentions by name, as one more
+        ranked list for fusion. A query that also asks about other things
+        ("ANOVA or a t-test when the standard deviation differs") still gets
+        the other candidates, the named article is boosted, not the answer.
+        """
+        title = self.named_title(query)
+        if title is None:
+            return []
+        return self._article_matches(title, query, top_k, mask)
+
+    def exact_title_matches(self, query: str, top_k: int, mask=None) -> List[dict]:
+        """
+        If the query is just an article title of two or more words
+        ("Fisher's exact test", "explain Fisher's exact test"),
+        return that article's best chunks.
+        """
+        title = self.named_title(query)
+        if title is None or set(tokenize(query)) - QUERY_FILLER != set(tokenize(title)):
+            return []
+        return self._article_matches(title, query, top_k, mask)
+
+    def _article_matches(self, title: str, query: str, top_k: int, mask=None):
+        article = [False] * len(self.ids)
+        for doc in self.titles[title]:
+            article[doc] = mask is None or bool(mask[doc])
+        return self.search(query, top_k, mask=article)
+
+    def save(self, path=LEXICAL_INDEX_PATH):
+        with gzip.open(path, "wt") as f:
+            json.dump(
+                {
+                    "k1": self.k1,
+                    "b": self.b,
+                    "ids": self.ids,
+                    "metadata": self.metadata,
+                    "doc_lengths": self.doc_lengths,
+                    "postings": self.postings,
+                    "titles": self.titles,
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, path=LEXICAL_INDEX_PATH):
+        with gzip.open(path, "rt") as f:
+            data = json.load(f)
+        index = cls(k1=data["k1"], b=data["b"])
+        index.ids = data["ids"]
+        index.metadata = data["metadata"]
+        index.doc_lengths = data["doc_lengths"]
+        index.postings = data["postings"]
+        index.titles = data["titles"]
+        index.avgdl = sum(index.doc_lengths) / max(len(index.doc_lengths), 1)
+        return index
+
+
+@lru_cache(maxsize=1)
+def load_lexical_index(path=LEXICAL_INDEX_PATH) -> Optional[BM25Index]:
+    """
+    Load the index once per process. Returns None if it hasn't been built.
+    """
+    try:
+        return BM25Index.load(path)
+    except FileNotFoundError:
+        return None
+
+
+def rrf_fuse(result_lists: List[List[dict]], top_k: int, k: int = RRF_K):
+    """
+    Reciprocal rank fusion: each list contributes 1 / (k + rank) per match.
+    The fused score replaces the original score, which is kept per source.
+    """
+    fused = {}
+    for source, matches in enumerate(result_lists):
+        for rank, match in enumerate(matches, start=1):
+            entry = fused.setdefault(
+                match["id"],
+                {"id": match["id"], "score": 0.0, "metadata": match["metadata"]},
+            )
+            entry["score"] += 1.0 / (k + rank)
+            entry.setdefault("source_scores", {})[source] = match["score"]
+    ranked = sorted(fused.values(), key=lambda m: m["score"], reverse=True)
+    return ranked[:top_k]
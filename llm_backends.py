@@ -0,0 +1,444 @@
+# This file contains the LLM backends hsage talks to.
+# Every backend does chat, streamed chat, structured JSON and tool calling
+# behind the same methods, so each role (explain, find_test, test_example,
+# the workflow router and the ask agent) can use whichever endpoint is
+# fastest, or the local mock for offline load tests. Clients are built the
+# first time a backend is used, not when hsage is imported.
+import json
+import time
+from abc import ABC, abstractmethod
+from functools import cached_property, lru_cache
+from typing import Iterator, List, Type
+
+from pydantic import BaseModel
+
+from agent_configs import (
+    LLM_BACKENDS,
+    COHERE_MODEL,
+    COHERE_API_KEY,
+    COHERE_BASE_URL,
+    BASETEN_BASE_URL,
+    BASETEN_API_KEY,
+    OPENAI_BASE_URL,
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    MOCK_LLM_LATENCY,
+)
+from mock_llm import mock_json, mock_text, mock_tool_call
+from usage_ledger import (
+    metered_call,
+    metered_stream,
+    record_call,
+    estimate_tokens,
+    cohere_usage,
+    cohere_stream_usage,
+    baseten_usage,
+    openai_stream_usage,
+)
+
+# Cohere rejects response schemas nested deeper than this
+MAX_SCHEMA_DEPTH = 5
+
+
+class ToolCall(BaseModel):
+    """
+    The tool a model picked, and the arguments it wants to call it with.
+    """
+
+    name: str
+    parameters: dict = {}
+
+
+def get_json_depth(d, level=1):
+    """
+    Helper function to determine the depth of a JSON-like dictionary.
+    """
+    if not isinstance(d, dict) or not d:
+        return level
+    return max(get_json_depth(v, level + 1) for v in d.values())
+
+
+class LLMBackend(ABC):
+    """
+    What hsage needs from a model. provider is the rate limiter and usage
+    ledger name the backend's calls are recorded under. Tools are given as
+    {"name", "description", "parameters": JSON schema}.
+    """
+
+    provider = None
+
+    @abstractmethod
+    def chat(self, message: str, system=None, context=None, temperature=0.1) -> str:
+        raise NotImplementedError
+
+    @abstractmethod
+    def chat_stream(
+        self, message: str, system=None, context=None, temperature=0.1
+    ) -> Iterator[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def structured(
+        self, message: str, json_structure: Type[BaseModel], system=None, context=None
+    ) -> BaseModel:
+        raise NotImplementedError
+
+    @abstractmethod
+    def tool_call(self, message: str, tools: List[dict]) -> List[ToolCall]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def llama_index_llm(self):
+        """
+        The same model as a llama_index LLM, for the ReActAgent.
+        """
+        raise NotImplementedError
+
+
+class CohereBackend(LLMBackend):
+    """
+    Cohere chat. Context goes into the preamble, after the system prompt.
+    """
+
+    provider = "cohere"
+
+    def __init__(
+        self, model=COHERE_MODEL, api_key=COHERE_API_KEY, base_url=COHERE_BASE_URL
+    ):
+        self.model = model
+        self.api_key = api_key
+        self.base_url = base_url
+
+    @cached_property
+    def client(self):
+        import cohere
+
+        return cohere.Client(api_key=self.api_key, base_url=self.base_url)
+
+    def _preamble(self, system, context):
+        preamble = system or ""
+        if context:
+            preamble += f"The context for the query is: {context}"
+        return preamble
+
+    def _chat(self, operation, message, preamble, **kwargs):
+        if preamble:
+            kwargs["preamble"] = preamble
+        return metered_call(
+            self.provider,
+            operation,
+            self.client.chat,
+            usage_fn=cohere_usage,
+            request_bytes=len(preamble.encode()) + len(message.encode()),
+            input_tokens=estimate_tokens(preamble + message),
+            model=self.model,
+            message=message,
+            **kwargs,
+        )
+
+    def chat(self, message, system=None, context=None, temperature=0.1):
+        preamble = self._preamble(system, context)
+        response = self._chat(
+            "chat",
+            message,
+            preamble,
+            response_format={"type": "text"},
+            temperature=temperature,
+        )
+        return response.text
+
+    def chat_stream(self, message, system=None, context=None, temperature=0.1):
+        """
+        The rate limiter slot is held while the stream is read,
+        usage is recorded once it ends.
+        """
+        preamble = self._preamble(system, context)
+        events = metered_stream(
+            self.provider,
+            "chat_stream",
+            self.client.chat_stream,
+            usage_fn=cohere_stream_usage,
+            request_bytes=len(preamble.encode()) + len(message.encode()),
+            input_tokens=estimate_tokens(preamble + message),
+            model=self.model,
+            preamble=preamble,
+            message=message,
+            temperature=temperature,
+        )
+        for event in events:
+            if event.event_type == "text-generation":
+                yield event.text
+
+    def structured(self, message, json_structure, system=None, context=None):
+        preamble = self._preamble(system, context)
+        preamble += " You must generate syntactically correct JSON."
+        schema = json_structure.model_json_schema(mode="serialization")
+        if get_json_depth(schema) > MAX_SCHEMA_DEPTH:
+            raise ValueError(
+                f"JSON schema exceeds the maximum depth of {MAX_SCHEMA_DEPTH} levels"
+            )
+        response = self._chat(
+            "chat",
+            message,
+            preamble,
+            response_format={"type": "json_object", "schema": schema},
+            temperature=0.1,
+        )
+        return json_structure.model_validate_json(response.text)
+
+    def tool_call(self, message, tools):
+        response = self._chat("tool_call", message, "", tools=tools)
+        return [
+            ToolCall(name=call.name, parameters=call.parameters or {})
+            for call in response.tool_calls or []
+        ]
+
+    def llama_index_llm(self):
+        from llama_index.llms.cohere import Cohere
+
+        return Cohere(model=self.model, api_key=self.api_key)
+
+
+def _post(url, payload, headers, stream=False):
+    """
+    requests doesn't raise on a 429 by itself, so do it here
+    to let the rate limiter see it and retry.
+    """
+    import requests
+
+    resp = requests.post(url, json=payload, headers=headers, stream=stream)
+    if resp.status_code == 429:
+        resp.raise_for_status()
+    return resp
+
+
+def _stream_chunks(url, payload, headers):
+    """
+    The chat.completion.chunk dicts of a streamed response, read as they arrive.
+    """
+    resp = _post(url, payload, headers, stream=True)
+    resp.raise_for_status()
+    for line in resp.iter_lines():
+        if line.startswith(b"data: ") and line != b"data: [DONE]":
+            yield json.loads(line[len(b"data: ") :])
+
+
+class OpenAICompatibleBackend(LLMBackend):
+    """
+    Any endpoint that takes OpenAI style chat messages: Baseten's predict
+    endpoint, or a /chat/completions endpoint (OpenAI, vLLM, the stand-in
+    server). Context goes in as its own user message, before the query.
+    """
+
+    def __init__(self, provider, url, api_key, model=None, auth_scheme="Bearer"):
+        self.provider = provider
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.auth_scheme = auth_scheme
+
+    def _messages(self, message, system, context):
+        messages = [{"role": "system", "content": system}] if system else []
+        if context:
+            messages.append(
+                {"role": "user", "content": "The context for the query is: " + context}
+            )
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def _payload(self, message, system, context, **fields):
+        payload = {"messages": self._messages(message, system, context), **fields}
+        if self.model:
+            payload["model"] = self.model
+        return payload
+
+    def _complete(self, operation, payload) -> dict:
+        body = json.dumps(payload)
+        headers = {"Authorization": f"{self.auth_scheme} {self.api_key}"}
+        resp = metered_call(
+            self.provider,
+            operation,
+            _post,
+            self.url,
+            payload,
+            headers,
+            usage_fn=baseten_usage,
+            request_bytes=len(body),
+            input_tokens=estimate_tokens(body),
+        )
+        resp.raise_for_status()
+        return resp.json()
+
+    def chat(self, message, system=None, context=None, temperature=0.1):
+        payload = self._payload(message, system, context, temperature=temperature)
+        data = self._complete("chat", payload)
+        return data["choices"][0]["message"]["content"]
+
+    def chat_stream(self, message, system=None, context=None, temperature=0.1):
+        payload = self._payload(
+            message, system, context, temperature=temperature, stream=True
+        )
+        body = json.dumps(payload)
+        headers = {"Authorization": f"{self.auth_scheme} {self.api_key}"}
+        chunks = metered_stream(
+            self.provider,
+            "chat_stream",
+            _stream_chunks,
+            self.url,
+            payload,
+            headers,
+            usage_fn=openai_stream_usage,
+            request_bytes=len(body),
+            input_tokens=estimate_tokens(body),
+        )
+        for chunk in chunks:
+            for choice in chunk.get("choices", []):
+                delta = choice.get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    def structured(self, message, json_structure, system=None, context=None):
+        payload = self._payload(
+            message,
+            system,
+            context,
+            max_tokens=8192,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": json_structure.__name__,
+                    "schema": json_structure.model_json_schema(),
+                },
+            },
+        )
+        data = self._complete("predict", payload)
+        # /chat/completions wraps the JSON in a message,
+        # Baseten's predict endpoint returns the object itself
+        if "choices" in data:
+            return json_structure.model_validate_json(
+                data["choices"][0]["message"]["content"]
+            )
+        return json_structure.model_validate(data)
+
+    def tool_call(self, message, tools):
+        payload = self._payload(
+            message,
+            None,
+            None,
+            tools=[{"type": "function", "function": tool} for tool in tools],
+        )
+        data = self._complete("tool_call", payload)
+        calls = data["choices"][0]["message"].get("tool_calls") or []
+        return [
+            ToolCall(
+                name=call["function"]["name"],
+                parameters=json.loads(call["function"].get("arguments") or "{}"),
+            )
+            for call in calls
+        ]
+
+    def llama_index_llm(self):
+        suffix = "/chat/completions"
+        if not self.url.endswith(suffix):
+            raise ValueError(
+                f"{self.provider} isn't a {suffix} endpoint, "
+                "the agent needs an OpenAI compatible one"
+            )
+        from llama_index.llms.openai_like import OpenAILike
+
+        return OpenAILike(
+            model=self.model,
+            api_base=self.url[: -len(suffix)],
+            api_key=self.api_key,
+            is_chat_model=True,
+        )
+
+
+class MockBackend(LLMBackend):
+    """
+    Answers locally with no network: text echoes the message, structured
+    output fills in the schema, tool calls pick the tool that shares the
+    most words with the message. latency stands in for provider time.
+    """
+
+    provider = "mock"
+
+    def __init__(self, latency=MOCK_LLM_LATENCY):
+        self.latency = latency
+
+    def _record(self, operation, prompt, output, start):
+        if self.latency:
+            time.sleep(self.latency)
+        record_call(
+            self.provider,
+            operation,
+            input_tokens=estimate_tokens(prompt),
+            output_tokens=estimate_tokens(output),
+            request_bytes=len(prompt.encode()),
+            response_bytes=len(output.encode()),
+            estimated_tokens=True,
+            wall_time=time.perf_counter() - start,
+        )
+
+    def chat(self, message, system=None, context=None, temperature=0.1):
+        start = time.perf_counter()
+        text = mock_text(message)
+        self._record("chat", f"{system or ''}{context or ''}{message}", text, start)
+        return text
+
+    def chat_stream(self, message, system=None, context=None, temperature=0.1):
+        words = self.chat(message, system, context, temperature).split(" ")
+        for i in range(0, len(words), 8):
+            yield " ".join(words[i : i + 8]) + (" " if i + 8 < len(words) else "")
+
+    def structured(self, message, json_structure, system=None, context=None):
+        start = time.perf_counter()
+        data = mock_json(json_structure.model_json_schema())
+        prompt = f"{system or ''}{context or ''}{message}"
+        self._record("predict", prompt, json.dumps(data), start)
+        return json_structure.model_validate(data)
+
+    def tool_call(self, message, tools):
+        start = time.perf_counter()
+        call = mock_tool_call(message, tools)
+        self._record("tool_call", message, json.dumps(call), start)
+        return [ToolCall(**call)]
+
+    def llama_index_llm(self):
+        from llama_index.core.llms import MockLLM
+
+        return MockLLM()
+
+
+BACKENDS = {
+    "cohere": CohereBackend,
+    "baseten": lambda: OpenAICompatibleBackend(
+        "baseten",
+        f"{BASETEN_BASE_URL}/production/predict",
+        BASETEN_API_KEY,
+        auth_scheme="Api-Key",
+    ),
+    "openai": lambda: OpenAICompatibleBackend(
+        "openai",
+        f"{OPENAI_BASE_URL}/chat/completions",
+        OPENAI_API_KEY,
+        model=OPENAI_MODEL,
+    ),
+    "mock": MockBackend,
+}
+
+
+@lru_cache(maxsize=None)
+def load_backend(name: str) -> LLMBackend:
+    if name not in BACKENDS:
+        raise ValueError(
+            f"Unknown LLM backend {name}, expected one of {list(BACKENDS)}"
+        )
+    return BACKENDS[name]()
+
+
+def get_backend(role: str) -> LLMBackend:
+    """
+    The backend configured for a role (see LLM_BACKENDS in agent_configs.py).
+    """
+    return load_backend(LLM_BACKENDS[role])
@@ -0,0 +1,191 @@
+# This file contains the load test for the HTTP API in hsage_server.py.
+# It starts the stand-in providers and the API server in this process, then
+# ramps up closed-loop concurrency against one endpoint until p95 latency goes
+# over the target, and reports the best requests/sec that stayed under it.
+#
+# python loadtest.py --target explain --p95 2.0 --duration 10
+import asyncio
+import socket
+import threading
+import time
+from typing import List, Optional
+
+import httpx
+import typer
+from pydantic import BaseModel
+from rich.console import Console
+from rich.table import Table
+
+from benchmark import DEFAULT_LATENCY, QUERIES, use_offline_environment
+from stub_providers import RECORDINGS_PATH, parse_latency, start_stub_server
+
+# endpoint and JSON body per target
+REQUESTS = {
+    "query": ("/query", {"query": QUERIES["query"]}),
+    "explain": ("/explain", {"query": QUERIES["explain"]}),
+    "explain_stream": ("/explain?stream=true", {"query": QUERIES["explain"]}),
+    "find_test": ("/find_test", {"situation": QUERIES["find_test"]}),
+    "test_example": (
+        "/test_example",
+        {
+            "test_name": QUERIES["test_example"][0],
+            "situation": QUERIES["test_example"][1],
+        },
+    ),
+    "workflow": ("/workflow", {"query": QUERIES["workflow"][0]}),
+}
+
+
+class LoadLevel(BaseModel):
+    """
+    What one concurrency level sustained for the duration of the run.
+    """
+
+    concurrency: int
+    requests: int
+    errors: int
+    throughput: float
+    p50: float
+    p95: float
+    p99: float
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_api_server(port: int):
+    """
+    Run hsage_server on a background thread. Imported here, after the
+    offline environment is in place, since agent_configs reads it on import.
+    """
+    import uvicorn
+
+    from hsage_server import app
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def run_level(base_url, target, concurrency, duration) -> LoadLevel:
+    from telemetry import percentile
+
+    path, body = REQUESTS[target]
+    latencies, errors = [], 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(client):
+        nonlocal errors
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                # read the whole body, so streamed responses count until the end
+                async with client.stream("POST", path, json=body) as response:
+                    await response.aread()
+                    response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=300, limits=limits
+    ) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+    return LoadLevel(
+        concurrency=concurrency,
+        requests=len(latencies) + errors,
+        errors=errors,
+        throughput=len(latencies) / elapsed if elapsed else 0.0,
+        p50=percentile(ordered, 0.5),
+        p95=percentile(ordered, 0.95),
+        p99=percentile(ordered, 0.99),
+    )
+
+
+def print_levels(target, levels: List[LoadLevel], p95_target, best):
+    table = Table(title=f"Load test: {target} (p95 target {p95_target:.2f}s)")
+    table.add_column("Concurrency", justify="right")
+    table.add_column("Requests", justify="right")
+    table.add_column("Errors", justify="right", style="red")
+    table.add_column("Req/s", justify="right", style="green")
+    table.add_column("p50", justify="right")
+    table.add_column("p95", justify="right")
+    table.add_column("p99", justify="right")
+    for level in levels:
+        table.add_row(
+            str(level.concurrency),
+            str(level.requests),
+            str(level.errors),
+            f"{level.throughput:.2f}",
+            f"{level.p50:.3f}s",
+            f"{level.p95:.3f}s",
+            f"{level.p99:.3f}s",
+        )
+    if best is None:
+        table.caption = "No level met the p95 target"
+    else:
+        table.caption = (
+            f"{best.throughput:.2f} req/s at p95 {best.p95:.3f}s "
+            f"(concurrency {best.concurrency})"
+        )
+    Console().print(table)
+
+
+def main(
+    target: str = typer.Option("explain", help=", ".join(REQUESTS)),
+    p95: float = typer.Option(2.0, help="Latency target in seconds."),
+    duration: float = typer.Option(10.0, help="Seconds per concurrency level."),
+    max_concurrency: int = typer.Option(256, help="Stop ramping here."),
+    latency: str = typer.Option(
+        DEFAULT_LATENCY, help="Injected seconds per provider, e.g. cohere=0.4"
+    ),
+    jitter: float = typer.Option(0.1, help="+/- fraction of random latency jitter."),
+    recordings: str = RECORDINGS_PATH,
+    governed: bool = typer.Option(
+        True, help="Keep the configured provider rate limits."
+    ),
+    llm: Optional[str] = typer.Option(
+        None, help="LLM backend for every role: cohere, baseten, openai or mock."
+    ),
+):
+    """
+    Find the requests/sec the API sustains at a fixed p95 latency.
+    """
+    if target not in REQUESTS:
+        raise typer.BadParameter(f"target must be one of {', '.join(REQUESTS)}")
+    stub = start_stub_server(0, parse_latency(latency), jitter, recordings)
+    use_offline_environment(stub, governed, llm)
+    port = _free_port()
+    api = start_api_server(port)
+
+    levels, concurrency = [], 1
+    while concurrency <= max_concurrency:
+        level = asyncio.run(
+            run_level(f"http://127.0.0.1:{port}", target, concurrency, duration)
+        )
+        levels.append(level)
+        if level.p95 > p95 or level.errors == level.requests:
+            break
+        concurrency *= 2
+    passing = [level for level in levels if level.p95 <= p95 and level.throughput]
+    best = max(passing, key=lambda level: level.throughput, default=None)
+
+    api.should_exit = True
+    stub.shutdown()
+    print_levels(target, levels, p95, best)
+
+
+if __name__ == "__main__":
+    typer.run(main)
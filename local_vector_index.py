@@ -0,0 +1,241 @@
+# This file contains the in-memory int8 quantized vector index.
+# multilingual-e5-large gives us 1024 float32 dims per chunk, which adds up
+# fast once we go past Wikipedia. Here we keep int8 codes (a quarter of the RAM)
+# in memory and scan them in cache-sized blocks, then rescore the top
+# candidates against the float32 vectors, which stay memory-mapped on disk.
+#
+# python local_vector_index.py build embedded_articles.csv
+# python local_vector_index.py recall --k 10
+import json
+import os
+import time
+from functools import lru_cache
+from typing import List, Optional
+
+import numpy as np
+import typer
+
+from agent_configs import LOCAL_VECTOR_INDEX_PATH, RESCORE_FACTOR
+
+# rows per block when scanning codes, 2048 x 1024 floats is ~8MB
+BLOCK_SIZE = 2048
+
+
+def quantize(vectors: np.ndarray):
+    """
+    Symmetric per-dimension int8 scalar quantization.
+    Returns the codes and the per-dimension scales to undo it.
+    """
+    scales = np.abs(vectors).max(axis=0) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+class QuantizedIndex:
+    """
+    int8 codes in RAM, float32 originals memory-mapped for rescoring.
+    Scores are dot products, which is cosine for the normalized e5 vectors.
+    """
+
+    def __init__(self, ids, metadata, codes, scales, vectors):
+        self.ids = ids
+        self.metadata = metadata
+        self.codes = codes
+        self.scales = scales
+        self.vectors = vectors
+        self._masks = {}
+
+    @classmethod
+    def build(cls, ids: List[str], vectors: np.ndarray, metadata: List[dict], path):
+        """
+        Quantize and write the index to a directory.
+        """
+        os.makedirs(path, exist_ok=True)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        codes, scales = quantize(vectors)
+        np.save(os.path.join(path, "codes.npy"), codes)
+        np.save(os.path.join(path, "scales.npy"), scales)
+        mapped = np.lib.format.open_memmap(
+            os.path.join(path, "vectors.npy"),
+            mode="w+",
+            dtype=np.float32,
+            shape=vectors.shape,
+        )
+        mapped[:] = vectors
+        mapped.flush()
+        with open(os.path.join(path, "ids.json"), "w") as f:
+            json.dump(ids, f)
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump(metadata, f)
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "ids.json")) as f:
+            ids = json.load(f)
+        with open(os.path.join(path, "metadata.json")) as f:
+            metadata = json.load(f)
+        return cls(
+            ids,
+            metadata,
+            np.load(os.path.join(path, "codes.npy")),
+            np.load(os.path.join(path, "scales.npy")),
+            np.load(os.path.join(path, "vectors.npy"), mmap_mode="r"),
+        )
+
+    def memory_bytes(self) -> int:
+        """
+        What the index keeps resident (the float32 vectors stay on disk).
+        """
+        return self.codes.nbytes + self.scales.nbytes
+
+    def mask_for(self, metadata_filter):
+        """
+        Boolean mask of rows the filter allows, computed once per filter.
+        """
+        if metadata_filter is None:
+            return None
+        key = metadata_filter.cache_key()
+        if key not in self._masks:
+            self._masks[key] = np.frombuffer(
+                metadata_filter.mask(self.metadata), dtype=np.uint8
+            ).astype(bool)
+        return self._masks[key]
+
+    def candidates(self, query: np.ndarray, n: int, mask=None) -> np.ndarray:
+        """
+        Approximate top n rows, scanning the int8 codes block by block.
+        Folding the scales into the query means the codes never get dequantized
+        as a whole, each block is converted on the fly and thrown away.
+        """
+        scaled_query = (query * self.scales).astype(np.float32)
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        for start in range(0, len(self.codes), BLOCK_SIZE):
+            block = self.codes[start : start + BLOCK_SIZE]
+            scores[start : start + len(block)] = block.astype(np.float32) @ scaled_query
+        if mask is not None:
+            scores[~mask] = -np.inf
+        n = min(n, len(scores))
+        if n == 0:
+            return np.array([], dtype=np.int64)
+        top = np.argpartition(-scores, n - 1)[:n]
+        return top[np.isfinite(scores[top])]
+
+    def search(
+        self, query, top_k: int, mask=None, rescore_factor: int = RESCORE_FACTOR
+    ) -> List[dict]:
+        """
+        Top k matches in the same shape as Pinecone's. The int8 pass picks
+        top_k * rescore_factor candidates, float32 dot products order them.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        rows = self.candidates(query, top_k * max(rescore_factor, 1), mask)
+        rows.sort()  # sequential reads from the memmap
+        exact = self.vectors[rows] @ query
+        order = np.argsort(-exact)[:top_k]
+        return [
+            {
+                "id": self.ids[rows[i]],
+                "score": float(exact[i]),
+                "metadata": self.metadata[rows[i]],
+            }
+            for i in order
+        ]
+
+    def exact_search(self, query, top_k: int) -> List[str]:
+        """
+        Brute force float32 search, used as ground truth for recall.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        scores = np.empty(len(self.ids), dtype=np.float32)
+        for start in range(0, len(self.ids), BLOCK_SIZE):
+            block = self.vectors[start : start + BLOCK_SIZE]
+            scores[start : start + len(block)] = block @ query
+        top = np.argsort(-scores)[:top_k]
+        return [self.ids[i] for i in top]
+
+
+@lru_cache(maxsize=1)
+def load_local_index(path=LOCAL_VECTOR_INDEX_PATH) -> Optional[QuantizedIndex]:
+    """
+    Load the index once per process. Returns None if it hasn't been built.
+    """
+    if not os.path.exists(os.path.join(path, "codes.npy")):
+        return None
+    return QuantizedIndex.load(path)
+
+
+def evaluate_recall(index: QuantizedIndex, queries: np.ndarray, k: int):
+    """
+    recall@k of the quantized search against exact float32 search,
+    plus average latency of each.
+    """
+    recalls, quantized_time, exact_time = [], 0.0, 0.0
+    for query in queries:
+        start = time.perf_counter()
+        truth = index.exact_search(query, k)
+        exact_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = [m["id"] for m in index.search(query, k)]
+        quantized_time += time.perf_counter() - start
+
+        recalls.append(len(set(truth) & set(found)) / k)
+    return {
+        "k": k,
+        "queries": len(queries),
+        f"recall@{k}": float(np.mean(recalls)),
+        "quantized_ms": 1000 * quantized_time / len(queries),
+        "exact_ms": 1000 * exact_time / len(queries),
+        "resident_mb": index.memory_bytes() / 1e6,
+        "float32_mb": index.vectors.nbytes / 1e6,
+    }
+
+
+app = typer.Typer()
+
+
+@app.command()
+def build(embeddings_csv: str = "embedded_articles.csv"):
+    """
+    Build the local index from the CSV upsert_and_embed_pinecone.py writes.
+    """
+    import ast
+
+    import pandas as pd
+
+    df = pd.read_csv(embeddings_csv)
+    vectors = np.array([json.loads(v) for v in df["values"]], dtype=np.float32)
+    metadata = [ast.literal_eval(m) for m in df["metadata"]]
+    index = QuantizedIndex.build(
+        df["id"].astype(str).tolist(), vectors, metadata, LOCAL_VECTOR_INDEX_PATH
+    )
+    typer.echo(
+        f"{len(index.ids)} vectors, {index.memory_bytes() / 1e6:.1f}MB resident "
+        f"(float32 would be {index.vectors.nbytes / 1e6:.1f}MB)"
+    )
+
+
+@app.command()
+def recall(k: int = 10, queries: int = 200, noise: float = 0.05, seed: int = 0):
+    """
+    Report recall@k against exact search, using perturbed stored vectors
+    as stand-in queries.
+    """
+    index = load_local_index()
+    if index is None:
+        raise typer.BadParameter(f"No index at {LOCAL_VECTOR_INDEX_PATH}, build first")
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(index.ids), size=min(queries, len(index.ids)), replace=False)
+    sample = index.vectors[np.sort(rows)] + rng.normal(
+        0, noise / np.sqrt(index.vectors.shape[1]), (len(rows), index.vectors.shape[1])
+    )
+    sample /= np.linalg.norm(sample, axis=1, keepdims=True)
+    typer.echo(
+        json.dumps(evaluate_recall(index, sample.astype(np.float32), k), indent=2)
+    )
+
+
+if __name__ == "__main__":
+    app()
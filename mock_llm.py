@@ -0,0 +1,60 @@
+# This file contains the canned answers for the mock LLM.
+# The mock backend in llm_backends.py and the stand-in server in
+# stub_providers.py both answer from these, so an offline run gets the same
+# replies whether it goes through HTTP or not.
+from typing import Optional
+
+
+def mock_json(schema: dict, root: Optional[dict] = None):
+    """
+    A small value that fits a JSON schema: one item per array,
+    "mock <field>" for strings. Follows $refs into the root's $defs.
+    """
+    root = root or schema
+    if "$ref" in schema:
+        return mock_json(root["$defs"][schema["$ref"].split("/")[-1]], root)
+    for key in ("anyOf", "oneOf", "allOf"):
+        if key in schema:
+            return mock_json(schema[key][0], root)
+    kind = schema.get("type", "object")
+    if kind == "object":
+        return {
+            name: mock_json({"title": name, **field}, root)
+            for name, field in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return [mock_json(schema.get("items", {}), root)]
+    if kind == "boolean":
+        return True
+    if kind in ("integer", "number"):
+        return 0
+    if kind == "null":
+        return None
+    return f"mock {schema.get('title', 'text')}".lower()
+
+
+def mock_tool_call(message: str, tools: list) -> dict:
+    """
+    Pick the tool whose name and description share the most words with the
+    message, and pass the message as every required string parameter.
+    """
+    words = set(message.lower().replace("_", " ").split())
+
+    def overlap(tool):
+        text = f"{tool['name'].replace('_', ' ')} {tool.get('description', '')}"
+        return len(words & set(text.lower().split()))
+
+    tool = max(tools, key=overlap)
+    parameters = tool.get("parameters", {})
+    return {
+        "name": tool["name"],
+        "parameters": {
+            name: message
+            for name in parameters.get("required", [])
+            if parameters["properties"][name].get("type", "string") == "string"
+        },
+    }
+
+
+def mock_text(message: str) -> str:
+    return f"Mock answer: {' '.join(message.split()[:60])}"
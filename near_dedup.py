@@ -0,0 +1,123 @@
+# This file contains the near-duplicate chunk filter used at ingest.
+# Related Wikipedia statistics articles repeat each other's summaries, so
+# near-identical chunks get embedded, stored and then retrieved together.
+# MinHash signatures over word shingles estimate Jaccard similarity, and LSH
+# banding means we only compare chunks that share at least one band.
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from agent_configs import DEDUP_THRESHOLD, DEDUP_NUM_PERM, DEDUP_BANDS, PROVIDER_PRICES
+
+SHINGLE_WORDS = 5
+# hashes are 32 bit, the permutations work modulo a 31 bit Mersenne prime so
+# a * hash + b stays inside int64
+PRIME = (1 << 31) - 1
+EMBEDDING_DIMENSION = 1024
+
+
+def shingles(text: str, size=SHINGLE_WORDS) -> np.ndarray:
+    words = text.lower().split()
+    if len(words) <= size:
+        grams = [" ".join(words)]
+    else:
+        grams = [" ".join(words[i : i + size]) for i in range(len(words) - size + 1)]
+    return np.array([zlib.crc32(g.encode()) for g in set(grams)], dtype=np.int64)
+
+
+class MinHashLSH:
+    """
+    MinHash signatures with LSH banding. Two chunks become candidates when all
+    rows of any band agree, candidates count as duplicates when their estimated
+    Jaccard similarity is at least threshold.
+    """
+
+    def __init__(
+        self,
+        threshold=DEDUP_THRESHOLD,
+        num_perm=DEDUP_NUM_PERM,
+        bands=DEDUP_BANDS,
+        seed=1,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        rng = np.random.default_rng(seed)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.a = rng.integers(1, PRIME, size=(num_perm, 1), dtype=np.int64)
+        self.b = rng.integers(0, PRIME, size=(num_perm, 1), dtype=np.int64)
+        self.buckets = [defaultdict(list) for _ in range(bands)]
+        self.signatures = []
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = shingles(text) % PRIME
+        return ((self.a * hashes + self.b) % PRIME).min(axis=1)
+
+    def similarity(self, first: int, second: int) -> float:
+        return float(np.mean(self.signatures[first] == self.signatures[second]))
+
+    def add(self, text: str) -> int:
+        """
+        Add a chunk, and return the index of an earlier chunk it duplicates,
+        or -1 if it's new. Duplicates aren't added to the buckets.
+        """
+        signature = self.signature(text)
+        self.signatures.append(signature)
+        position = len(self.signatures) - 1
+        keys = [
+            signature[band * self.rows : (band + 1) * self.rows].tobytes()
+            for band in range(self.bands)
+        ]
+        seen = set()
+        for band, key in enumerate(keys):
+            for other in self.buckets[band].get(key, ()):
+                if other in seen:
+                    continue
+                seen.add(other)
+                if self.similarity(position, other) >= self.threshold:
+                    return other
+        for band, key in enumerate(keys):
+            self.buckets[band][key].append(position)
+        return -1
+
+
+def find_near_duplicates(texts: List[str], **lsh_options) -> Tuple[List[int], Dict]:
+    """
+    Indexes of the chunks to keep (first occurrence wins), and a map of
+    dropped chunk index -> the kept chunk it duplicates.
+    """
+    lsh = MinHashLSH(**lsh_options)
+    kept, duplicates = [], {}
+    for i, text in enumerate(texts):
+        original = lsh.add(text)
+        if original < 0:
+            kept.append(i)
+        else:
+            duplicates[i] = original
+    return kept, duplicates
+
+
+def savings_report(texts: List[str], duplicates: Dict, metadata_bytes=None) -> dict:
+    """
+    What dropping the duplicates saves: chunks, embedding tokens (and cost at
+    the configured Pinecone inference price), and index size (float32 vectors
+    plus metadata).
+    """
+    dropped = list(duplicates)
+    tokens = sum(len(texts[i]) // 4 for i in dropped)
+    price = PROVIDER_PRICES.get("pinecone_inference", {"input": 0})["input"]
+    vector_bytes = len(dropped) * EMBEDDING_DIMENSION * 4
+    meta_bytes = sum(
+        metadata_bytes[i] if metadata_bytes else len(texts[i].encode()) for i in dropped
+    )
+    return {
+        "chunks": len(texts),
+        "dropped": len(dropped),
+        "dropped_share": len(dropped) / len(texts) if texts else 0.0,
+        "embedding_tokens_saved": tokens,
+        "embedding_cost_saved": tokens * price / 1e6,
+        "index_bytes_saved": vector_bytes + meta_bytes,
+    }
@@ -0,0 +1,270 @@
+# This file contains the --profile switch for hsage_cli.py and
+# StatisticsWorkflow.run. One profile combines three things:
+# - cProfile, for the thread that started it
+# - a stack sampler over every thread, since tools and provider calls run on
+#   worker threads and cProfile can't see those
+# - the telemetry spans, one per provider call and workflow step
+# The samples are written in the collapsed stack format that flamegraph.pl and
+# speedscope read, next to the .prof file and a short top-N summary.
+#
+# flamegraph.pl profiles/find_best_test-*.collapsed > flame.svg
+# python -m pstats profiles/find_best_test-*.prof
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel
+
+from agent_configs import PROFILE_DIR, PROFILE_SAMPLE_INTERVAL, PROFILE_TOP_N
+from telemetry import add_span_listener, remove_span_listener
+
+# a sample is attributed to the innermost frame that matches one of these,
+# checked as path segments of the frame's file
+CATEGORIES = {
+    "pinecone": ("pinecone",),
+    "cohere": ("cohere",),
+    "pydantic": ("pydantic", "pydantic_core"),
+    "rich": ("rich",),
+    "llama_index": ("llama_index",),
+    "imports": ("importlib",),
+}
+# Baseten, OpenAI and the other OpenAI compatible endpoints have no client
+# library and share _post, so time under a backend in this file goes to that
+# backend's provider instead
+BACKENDS_FILE = "llm_backends.py"
+# leaf frames of threads that are parked, not working
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("thread.py", "_worker"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+}
+
+
+class SpanTotal(BaseModel):
+    name: str
+    count: int
+    total: float
+
+
+class FunctionStat(BaseModel):
+    function: str
+    calls: int
+    own_time: float
+    cumulative_time: float
+
+
+class ProfileSummary(BaseModel):
+    """
+    Where one profiled command or workflow run spent its time.
+    categories is the share of busy samples per library or LLM provider
+    (or "other").
+    """
+
+    name: str
+    wall_time: float
+    import_time: Optional[float] = None
+    samples: int
+    categories: Dict[str, float]
+    spans: List[SpanTotal]
+    top_functions: List[FunctionStat]
+    files: List[str]
+
+
+def _category(frame) -> str:
+    """
+    The category of the innermost frame that has one, from a sampled thread's
+    current frame outwards.
+    """
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if os.path.basename(filename) == BACKENDS_FILE:
+            provider = getattr(frame.f_locals.get("self"), "provider", None)
+            if provider:
+                return provider
+        parts = filename.replace("\\", "/").split("/")
+        for category, packages in CATEGORIES.items():
+            if any(package in parts for package in packages):
+                return category
+        frame = frame.f_back
+    return "other"
+
+
+def _frames(frame):
+    """
+    (filename, function) pairs from the outermost frame to the innermost.
+    """
+    frames = []
+    while frame is not None:
+        frames.append((frame.f_code.co_filename, frame.f_code.co_name))
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+class Profiler:
+    """
+    start() / stop() around the code to profile, stop() writes the files and
+    returns the summary. import_time is what the caller measured before it
+    could start profiling (hsage_cli.py times its own imports).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        directory=PROFILE_DIR,
+        interval=PROFILE_SAMPLE_INTERVAL,
+        top_n=PROFILE_TOP_N,
+        import_time: Optional[float] = None,
+    ):
+        self.name = name
+        self.directory = directory
+        self.interval = interval
+        self.top_n = top_n
+        self.import_time = import_time
+        self.stacks = Counter()
+        self.categories = Counter()
+        self.spans = []
+        self._profile = cProfile.Profile()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._start = None
+        self.summary = None
+
+    def _record_span(self, record):
+        self.spans.append(record)
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = _frames(frame)
+                collapsed = ";".join(
+                    f"{function} ({os.path.basename(filename)})"
+                    for filename, function in frames
+                )
+                self.stacks[f"{names.get(ident, ident)};{collapsed}"] += 1
+                filename, function = frames[-1]
+                if (os.path.basename(filename), function) not in IDLE_FRAMES:
+                    self.categories[_category(frame)] += 1
+
+    def start(self):
+        self._start = time.perf_counter()
+        add_span_listener(self._record_span)
+        self._sampler = threading.Thread(
+            target=self._sample, name="hsage-profiler", daemon=True
+        )
+        self._sampler.start()
+        self._profile.enable()
+        return self
+
+    def stop(self) -> ProfileSummary:
+        self._profile.disable()
+        wall_time = time.perf_counter() - self._start
+        self._stop.set()
+        self._sampler.join()
+        remove_span_listener(self._record_span)
+        return self._write(wall_time)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.summary = self.stop()
+
+    def _top_functions(self) -> List[FunctionStat]:
+        stats = pstats.Stats(self._profile, stream=io.StringIO())
+        rows = []
+        for (filename, line, function), row in stats.stats.items():
+            _, calls, own, cumulative, _ = row
+            rows.append(
+                FunctionStat(
+                    function=f"{function} ({os.path.basename(filename)}:{line})",
+                    calls=calls,
+                    own_time=own,
+                    cumulative_time=cumulative,
+                )
+            )
+        rows.sort(key=lambda row: row.cumulative_time, reverse=True)
+        return rows[: self.top_n]
+
+    def _span_totals(self) -> List[SpanTotal]:
+        counts, totals = defaultdict(int), defaultdict(float)
+        for record in self.spans:
+            counts[record["name"]] += 1
+            totals[record["name"]] += record["duration"]
+        return sorted(
+            (SpanTotal(name=n, count=counts[n], total=totals[n]) for n in counts),
+            key=lambda total: total.total,
+            reverse=True,
+        )
+
+    def _write(self, wall_time) -> ProfileSummary:
+        os.makedirs(self.directory, exist_ok=True)
+        stem = os.path.join(
+            self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}"
+        )
+        self._profile.dump_stats(stem + ".prof")
+        with open(stem + ".collapsed", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(stem + ".spans.jsonl", "w") as f:
+            for record in self.spans:
+                f.write(json.dumps(record, default=str) + "\n")
+
+        busy = sum(self.categories.values())
+        summary = ProfileSummary(
+            name=self.name,
+            wall_time=wall_time,
+            import_time=self.import_time,
+            samples=sum(self.stacks.values()),
+            categories={
+                category: count / busy
+                for category, count in self.categories.most_common()
+            },
+            spans=self._span_totals(),
+            top_functions=self._top_functions(),
+            files=[stem + ext for ext in (".prof", ".collapsed", ".spans.jsonl")],
+        )
+        with open(stem + ".summary.txt", "w") as f:
+            f.write(format_summary(summary))
+        summary.files.append(stem + ".summary.txt")
+        return summary
+
+
+def format_summary(summary: ProfileSummary) -> str:
+    """
+    The short plain text version, for stderr and the .summary.txt file.
+    """
+    lines = [f"Profile: {summary.name}, {summary.wall_time:.3f}s wall"]
+    if summary.import_time is not None:
+        lines.append(f"  imports before profiling: {summary.import_time:.3f}s")
+    if summary.categories:
+        lines.append("Busy samples by library or provider:")
+        for category, share in summary.categories.items():
+            lines.append(f"  {category:<12} {share:6.1%}")
+    if summary.spans:
+        lines.append("Spans (wall time):")
+        for total in summary.spans[:10]:
+            lines.append(f"  {total.name:<36} {total.count:>4}x {total.total:8.3f}s")
+    lines.append(
+        f"Top {len(summary.top_functions)} functions (cumulative, this thread):"
+    )
+    for row in summary.top_functions:
+        lines.append(
+            f"  {row.cumulative_time:8.3f}s {row.own_time:8.3f}s "
+            f"{row.calls:>7}  {row.function}"
+        )
+    lines.append("Files: " + ", ".join(summary.files))
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,290 @@
+# This file contains the shared concurrency governor for every provider we call.
+# Pinecone, Cohere and Baseten all get their own token bucket, a cap on
+# requests in flight, and a priority queue so interactive calls jump ahead of
+# batch jobs instead of everyone stampeding the API and eating 429s.
+import atexit
+import contextvars
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from agent_configs import PROVIDER_LIMITS, RATE_LIMIT_RETRIES, LIMITER_METRICS_FILE
+
+# Lower numbers are served first
+INTERACTIVE = 0
+NORMAL = 5
+BATCH = 10
+
+_priority = contextvars.ContextVar("hsage_priority", default=NORMAL)
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Run everything inside the block at the given priority.
+    Contextvars are copied into asyncio.to_thread, so this also covers tools
+    the workflow runs in worker threads.
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class RateLimitedError(Exception):
+    """
+    Raised when a provider keeps answering 429 after all of our retries.
+    """
+
+
+class ProviderLimiter:
+    """
+    Token bucket + concurrency cap + priority queue for a single provider.
+
+    Callers queue up by (priority, arrival order). Only the head of the queue
+    may take a slot, and it does so once there is a free concurrency slot,
+    a request token and (optionally) enough tokens in the per-minute token bucket.
+    """
+
+    def __init__(self, name, rps, burst, concurrency, tpm=None):
+        self.name = name
+        self.rate = rps
+        self.burst = max(burst, 1.0)
+        self.max_concurrency = concurrency
+        self.token_rate = tpm / 60.0 if tpm else None
+        self.token_burst = tpm
+
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._counter = itertools.count()
+        self._tokens = self.burst
+        self._llm_tokens = self.token_burst
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+
+        # metrics
+        self.total_acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_queue_depth = 0
+        self.rate_limited = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        if self.token_rate:
+            self._llm_tokens = min(
+                self.token_burst, self._llm_tokens + elapsed * self.token_rate
+            )
+
+    def _time_until_ready(self, tokens):
+        """
+        How long the head of the queue has to sleep before the buckets allow it.
+        """
+        wait = 0.0
+        if self._tokens < 1:
+            wait = (1 - self._tokens) / self.rate
+        if self.token_rate and self._llm_tokens < tokens:
+            wait = max(wait, (tokens - self._llm_tokens) / self.token_rate)
+        return wait
+
+    def acquire(self, tokens=0, priority=None):
+        """
+        Block until this caller may send a request. Returns the time spent queued.
+        """
+        priority = current_priority() if priority is None else priority
+        if self.token_burst:
+            # a single request bigger than the bucket would wait forever
+            tokens = min(tokens, self.token_burst)
+        start = time.monotonic()
+
+        with self._cond:
+            ticket = (priority, next(self._counter))
+            heapq.heappush(self._waiters, ticket)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+            try:
+                while True:
+                    timeout = None
+                    if (
+                        self._waiters[0] == ticket
+                        and self._in_flight < self.max_concurrency
+                    ):
+                        self._refill()
+                        timeout = self._time_until_ready(tokens)
+                        if timeout <= 0:
+                            break
+                    self._cond.wait(timeout)
+            except BaseException:
+                self._waiters.remove(ticket)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+                raise
+
+            heapq.heappop(self._waiters)
+            self._tokens -= 1
+            if self.token_rate:
+                self._llm_tokens -= tokens
+            self._in_flight += 1
+
+            waited = time.monotonic() - start
+            self.total_acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            # the next waiter might be able to go right away
+            self._cond.notify_all()
+
+        return waited
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def penalize(self):
+        """
+        The provider told us to slow down, so drain the request bucket.
+        Everyone queued behind us waits for it to refill instead of piling on.
+        """
+        with self._cond:
+            self.rate_limited += 1
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+    @contextmanager
+    def slot(self, tokens=0, priority=None):
+        self.acquire(tokens=tokens, priority=priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                "provider": self.name,
+                "queue_depth": len(self._waiters),
+                "max_queue_depth": self.max_queue_depth,
+                "in_flight": self._in_flight,
+                "acquired": self.total_acquired,
+                "total_wait_seconds": round(self.total_wait, 6),
+                "avg_wait_seconds": round(
+                    (
+                        self.total_wait / self.total_acquired
+                        if self.total_acquired
+                        else 0.0
+                    ),
+                    6,
+                ),
+                "max_wait_seconds": round(self.max_wait, 6),
+                "rate_limited": self.rate_limited,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str) -> ProviderLimiter:
+    """
+    Return the process-wide limiter for a provider, creating it on first use.
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            if provider not in PROVIDER_LIMITS:
+                raise ValueError(f"No rate limits configured for {provider}")
+            _limiters[provider] = ProviderLimiter(provider, **PROVIDER_LIMITS[provider])
+        return _limiters[provider]
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """
+    The three SDKs all report 429s differently, so check the usual spots.
+    """
+    for attr in ("status_code", "status"):
+        if getattr(e, attr, None) == 429:
+            return True
+    response = getattr(e, "response", None)
+    if response is not None and getattr(response, "status_code", None) == 429:
+        return True
+    return False
+
+
+def call_with_limits(provider: str, fn, *args, tokens=0, priority=None, **kwargs):
+    """
+    Run fn under the provider's limiter, retrying with backoff on 429s.
+    """
+    limiter = get_limiter(provider)
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        with limiter.slot(tokens=tokens, priority=priority):
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e):
+                    raise
+                limiter.penalize()
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise RateLimitedError(
+                        f"{provider} is still rate limiting after "
+                        f"{RATE_LIMIT_RETRIES} retries"
+                    ) from e
+        # back off outside the slot so we don't hold up anyone else
+        time.sleep(min(30.0, (2**attempt) + random.random()))
+
+
+def stream_with_limits(
+    provider: str, fn, *args, tokens=0, priority=None, **kwargs
+) -> Iterator:
+    """
+    call_with_limits for a streamed response: fn returns an iterator, and the
+    slot is held until it's exhausted (or the caller stops reading). A 429 is
+    only retried before the first item, after that it's too late to start over.
+    """
+    limiter = get_limiter(provider)
+    for attempt in range(RATE_LIMIT_RETRIES + 1):
+        started = False
+        with limiter.slot(tokens=tokens, priority=priority):
+            try:
+                for item in fn(*args, **kwargs):
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started or not is_rate_limit_error(e):
+                    raise
+                limiter.penalize()
+                if attempt == RATE_LIMIT_RETRIES:
+                    raise RateLimitedError(
+                        f"{provider} is still rate limiting after "
+                        f"{RATE_LIMIT_RETRIES} retries"
+                    ) from e
+        time.sleep(min(30.0, (2**attempt) + random.random()))
+
+
+def limiter_metrics():
+    """
+    Queue depth and wait time metrics for every limiter used so far.
+    """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return [limiter.snapshot() for limiter in limiters]
+
+
+def _dump_metrics():
+    with open(LIMITER_METRICS_FILE, "w") as f:
+        json.dump(limiter_metrics(), f, indent=2)
+
+
+if LIMITER_METRICS_FILE:
+    atexit.register(_dump_metrics)
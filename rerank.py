@@ -0,0 +1,134 @@
+# This file contains the optional rerank stage after query_db.
+# Retrieval is cheap and LLM context is not, so we fetch a wide set of
+# candidates (RERANK_CANDIDATES), score them against the query with a
+# cross-encoder (local, on CPU) or Cohere rerank, and only keep the best
+# RERANK_TOP_N for the prompt.
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List
+
+from agent_configs import (
+    RERANKER,
+    RERANK_MODEL,
+    RERANK_BATCH_SIZE,
+    RERANK_CACHE_SIZE,
+    COHERE_API_KEY,
+    COHERE_BASE_URL,
+)
+from telemetry import span
+from usage_ledger import (
+    current_ledger,
+    estimate_tokens,
+    metered_call,
+    cohere_rerank_usage,
+)
+
+
+class RerankCache:
+    """
+    LRU of (reranker, query, candidate ids) -> relevance scores,
+    so repeated questions don't pay for the rerank again.
+    """
+
+    def __init__(self, maxsize=RERANK_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, scores):
+        with self._lock:
+            self._entries[key] = scores
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+_cache = RerankCache()
+
+
+@lru_cache(maxsize=1)
+def _cross_encoder():
+    try:
+        from sentence_transformers import CrossEncoder
+    except ImportError as e:
+        raise ImportError(
+            "The cross-encoder reranker needs sentence-transformers installed"
+        ) from e
+    return CrossEncoder(RERANK_MODEL, device="cpu")
+
+
+@lru_cache(maxsize=1)
+def _cohere_client():
+    import cohere
+
+    return cohere.Client(api_key=COHERE_API_KEY, base_url=COHERE_BASE_URL)
+
+
+def cross_encoder_scores(query: str, documents: List[str]) -> List[float]:
+    pairs = [(query, document) for document in documents]
+    scores = _cross_encoder().predict(pairs, batch_size=RERANK_BATCH_SIZE)
+    return [float(score) for score in scores]
+
+
+def cohere_scores(query: str, documents: List[str]) -> List[float]:
+    response = metered_call(
+        "cohere",
+        "rerank",
+        _cohere_client().rerank,
+        usage_fn=cohere_rerank_usage,
+        request_bytes=len(query.encode()) + sum(len(d.encode()) for d in documents),
+        model=RERANK_MODEL,
+        query=query,
+        documents=documents,
+        top_n=len(documents),
+    )
+    scores = [0.0] * len(documents)
+    for result in response.results:
+        scores[result.index] = float(result.relevance_score)
+    return scores
+
+
+SCORERS = {
+    "cross-encoder": cross_encoder_scores,
+    "cohere": cohere_scores,
+}
+
+
+def rerank(query: str, matches: List[dict], top_n: int, reranker: str = RERANKER):
+    """
+    Reorder matches by relevance to the query and keep the top_n.
+    The reranker's score replaces the retrieval score, which is kept as
+    retrieval_score. Token counts before/after go into the usage ledger.
+    """
+    if reranker == "none" or len(matches) <= 1:
+        return matches[:top_n]
+
+    documents = [m["metadata"]["Chunk Content"] for m in matches]
+    key = (reranker, query, tuple(m["id"] for m in matches))
+    scores = _cache.get(key)
+    if scores is None:
+        with span("rerank", reranker=reranker, candidates=len(matches)):
+            scores = SCORERS[reranker](query, documents)
+        _cache.put(key, scores)
+
+    ranked = sorted(zip(scores, matches), key=lambda pair: pair[0], reverse=True)
+    kept = [
+        {**match, "score": score, "retrieval_score": match["score"]}
+        for score, match in ranked[:top_n]
+    ]
+
+    ledger = current_ledger()
+    if ledger is not None:
+        ledger.record_rerank(
+            estimate_tokens(" ".join(documents)),
+            estimate_tokens(" ".join(m["metadata"]["Chunk Content"] for m in kept)),
+        )
+    return kept
@@ -0,0 +1,115 @@
+# This file contains the metadata filters for retrieval.
+# Filters on Article Title / Section Title are pushed into Pinecone where they
+# can be ($in / $nin on exact values). Regexes can't, so those are applied to
+# an over-fetched result set, and as a precomputed bitmap mask over the local
+# lexical index.
+import re
+from functools import lru_cache
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from agent_configs import FILTER_JUNK_AT_QUERY, JUNK_TITLE_REGEX
+
+FIELDS = {"title": "Article Title", "section": "Section Title"}
+
+
+@lru_cache(maxsize=128)
+def _compile(pattern: str):
+    return re.compile(pattern)
+
+
+class MetadataFilter(BaseModel):
+    """
+    Include/exclude lists and regexes on Article Title and Section Title.
+    Empty include lists mean "everything".
+    """
+
+    include_titles: List[str] = []
+    exclude_titles: List[str] = []
+    title_regex: Optional[str] = None
+    exclude_title_regex: Optional[str] = None
+    include_sections: List[str] = []
+    exclude_sections: List[str] = []
+    section_regex: Optional[str] = None
+    exclude_section_regex: Optional[str] = None
+
+    def cache_key(self) -> str:
+        return self.model_dump_json()
+
+    def has_regex(self) -> bool:
+        return any(
+            (
+                self.title_regex,
+                self.exclude_title_regex,
+                self.section_regex,
+                self.exclude_section_regex,
+            )
+        )
+
+    def to_pinecone_filter(self) -> Optional[dict]:
+        """
+        The exact-value part of the filter, in Pinecone's filter language.
+        """
+        clauses = []
+        for field, include, exclude in (
+            ("title", self.include_titles, self.exclude_titles),
+            ("section", self.include_sections, self.exclude_sections),
+        ):
+            if include:
+                clauses.append({FIELDS[field]: {"$in": include}})
+            if exclude:
+                clauses.append({FIELDS[field]: {"$nin": exclude}})
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def allows(self, metadata: dict) -> bool:
+        for field, include, exclude, regex, exclude_regex in (
+            (
+                "title",
+                self.include_titles,
+                self.exclude_titles,
+                self.title_regex,
+                self.exclude_title_regex,
+            ),
+            (
+                "section",
+                self.include_sections,
+                self.exclude_sections,
+                self.section_regex,
+                self.exclude_section_regex,
+            ),
+        ):
+            value = metadata.get(FIELDS[field]) or ""
+            if include and value not in include:
+                return False
+            if value in exclude:
+                return False
+            if regex and not _compile(regex).search(value):
+                return False
+            if exclude_regex and _compile(exclude_regex).search(value):
+                return False
+        return True
+
+    def apply(self, matches: List[dict]) -> List[dict]:
+        return [m for m in matches if self.allows(m["metadata"])]
+
+    def mask(self, metadata: List[dict]) -> bytearray:
+        """
+        One byte per document, 1 if the filter allows it.
+        """
+        return bytearray(1 if self.allows(meta) else 0 for meta in metadata)
+
+
+# What query_db uses unless told otherwise. Ingest already keeps
+# template/talk/etc. pages out of the index, so by default nothing.
+DEFAULT_FILTER = (
+    MetadataFilter(exclude_title_regex=JUNK_TITLE_REGEX)
+    if FILTER_JUNK_AT_QUERY
+    else None
+)
+
+
+def is_junk_title(title: str) -> bool:
+    return bool(_compile(JUNK_TITLE_REGEX).search(title or ""))
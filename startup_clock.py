@@ -0,0 +1,6 @@
+# This file contains the start mark for --profile. hsage_cli.py imports it
+# before anything else, so the time spent importing the rest of the CLI
+# (llama_index, rich, the provider clients) can be reported.
+import time
+
+STARTED = time.perf_counter()
@@ -0,0 +1,369 @@
+# This file contains the precomputed catalog of statistical tests.
+# The set of common tests is small and stable, so instead of a retrieval and
+# a Baseten generation for every find_test call, we extract name, data type,
+# number of groups, paired or not, parametric or not and assumptions from the
+# chunk corpus once, and keep them in an indexed SQLite file. find_test asks the
+# catalog first and only goes to Baseten when the match is weak.
+#
+# python stat_catalog.py build article_chunks.csv
+# python stat_catalog.py lookup "compare the mean weight of two independent groups"
+import json
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import typer
+
+from agent_configs import TEST_CATALOG_PATH, CATALOG_MIN_SCORE
+from stat_structures import FindTestResponse, TestRecommendation
+
+TEST_TITLE = re.compile(
+    r"\btest\b|analysis of variance|\banova\b|correlation coefficient", re.I
+)
+# articles about testing in general, not a test you'd recommend
+GENERIC_TITLES = {
+    "statistical hypothesis test",
+    "statistical hypothesis testing",
+    "test statistic",
+    "exact test",
+    "one- and two-tailed tests",
+    "statistical significance",
+    "multiple comparisons problem",
+}
+ASSUMPTION_SENTENCE = re.compile(r"[^.]*\bassum[^.]*\.", re.I)
+MAX_ASSUMPTIONS = 4
+# the title counts this many times when we tally cues in an article
+TITLE_WEIGHT = 5
+
+# cues in an article describing a test
+ARTICLE_CUES = {
+    "data_type": {
+        "categorical": r"\bcategorical|contingency table|\bproportions?\b|"
+        r"\bfrequencies\b|\bnominal",
+        "ordinal": r"\bordinal|\branks?\b|\branked\b|\bmedians?\b",
+        "continuous": r"\bmeans?\b|normally distributed|\binterval\b|\bcontinuous",
+    },
+    "groups": {
+        "one": r"one[- ]sample|single sample|known (?:value|mean)|"
+        r"hypothesi[sz]ed (?:value|mean)",
+        "two": r"two[- ]sample|two (?:independent )?(?:samples|groups|populations)",
+        "many": r"three or more|more than two|several groups|multiple groups|"
+        r"\bk (?:groups|samples)",
+        "association": r"\bcorrelation|association between|relationship between",
+    },
+    "paired": {
+        "yes": r"\bpaired|\bmatched|repeated measures|related samples|"
+        r"\bdependent samples|before and after",
+        "no": r"independent samples|\bunpaired|independent groups",
+    },
+}
+NONPARAMETRIC = re.compile(r"non-?parametric|distribution-free|\branks?\b", re.I)
+NORMALITY = re.compile(r"normally distributed|normal distribution|normality", re.I)
+
+# cues in a user's scenario
+SCENARIO_CUES = {
+    "data_type": {
+        "categorical": r"categor|proportion|percent|binary|yes/no|\bcounts?\b|"
+        r"frequenc|nominal",
+        "ordinal": r"ordinal|\brank|likert|rating|median",
+        "continuous": r"\bmeans?\b|average|continuous|measurements?\b",
+    },
+    "groups": {
+        "one": r"one[- ]sample|single group|known value|"
+        r"against a (?:target|benchmark|standard|known)",
+        "two": r"\btwo (?:\w+ )?(?:groups|samples|conditions|treatments|variants|"
+        r"populations)|\bversus\b|\bvs\.?\s|\ba/b\b",
+        "many": r"three or more|more than two|several groups|multiple groups|"
+        r"\b(?:three|four|five|six) (?:\w+ )?(?:groups|samples|conditions|treatments)",
+        "association": r"correlat|relationship between|associat",
+    },
+    "paired": {
+        "yes": r"paired|before and after|same (?:subjects|participants|people|"
+        r"patients|users)|repeated|matched|pre-? and post|within[- ]subjects",
+        "no": r"independent (?:groups|samples)|different (?:people|groups|subjects)|"
+        r"between[- ]subjects|unpaired",
+    },
+    "normality": {
+        "non-normal": r"skew|not normal|non-?normal|outliers?|heavy[- ]tail",
+        "normal": r"normally distributed|normal distribution",
+    },
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tests (
+    name TEXT PRIMARY KEY,
+    data_type TEXT,
+    groups TEXT,
+    paired TEXT,
+    parametric INTEGER,
+    assumptions TEXT,
+    summary TEXT
+);
+CREATE INDEX IF NOT EXISTS tests_data_type ON tests (data_type);
+CREATE INDEX IF NOT EXISTS tests_groups ON tests (groups);
+CREATE INDEX IF NOT EXISTS tests_paired ON tests (paired);
+"""
+
+
+def _tally(cues: Dict[str, str], text: str, title: str = "") -> Dict[str, int]:
+    return {
+        value: len(re.findall(pattern, text, re.I))
+        + TITLE_WEIGHT * len(re.findall(pattern, title, re.I))
+        for value, pattern in cues.items()
+    }
+
+
+def _strongest(counts: Dict[str, int]) -> Optional[str]:
+    value, count = max(counts.items(), key=lambda item: item[1])
+    return value if count else None
+
+
+def default_assumptions(entry: dict) -> List[str]:
+    """
+    Textbook assumptions implied by the extracted fields, used when the
+    article doesn't spell any out.
+    """
+    assumptions = [
+        (
+            "Pairs are independent of each other"
+            if entry["paired"] == "yes"
+            else "Observations are independent"
+        )
+    ]
+    if entry["parametric"]:
+        assumptions.append("The data are approximately normally distributed")
+        if entry["groups"] in ("two", "many") and entry["paired"] != "yes":
+            assumptions.append("The groups have similar variances")
+    return assumptions
+
+
+def extract_entry(title: str, text: str) -> Optional[dict]:
+    """
+    Catalog entry for one article, or None if it isn't about a specific test
+    or we can't tell what data it applies to.
+    """
+    if not TEST_TITLE.search(title) or title.lower() in GENERIC_TITLES:
+        return None
+    entry = {
+        field: _strongest(_tally(cues, text, title))
+        for field, cues in ARTICLE_CUES.items()
+    }
+    if entry["data_type"] is None and entry["groups"] is None:
+        return None
+    # articles like Student's t-test cover both the paired and unpaired version
+    paired = _tally(ARTICLE_CUES["paired"], text, title)
+    if paired["yes"] and paired["no"]:
+        entry["paired"] = "both"
+    nonparametric = len(NONPARAMETRIC.findall(text)) + TITLE_WEIGHT * len(
+        NONPARAMETRIC.findall(title)
+    )
+    entry["parametric"] = len(NORMALITY.findall(text)) > nonparametric
+    assumptions = []
+    for sentence in ASSUMPTION_SENTENCE.findall(text):
+        sentence = " ".join(sentence.split())
+        if 20 <= len(sentence) <= 240 and sentence not in assumptions:
+            assumptions.append(sentence)
+    entry["name"] = title
+    entry["assumptions"] = assumptions[:MAX_ASSUMPTIONS] or default_assumptions(entry)
+    entry["summary"] = " ".join(text.split()[:60])
+    return entry
+
+
+def build_catalog(chunks: List[dict], path=TEST_CATALOG_PATH) -> List[dict]:
+    """
+    Extract the catalog from chunk records (Article Title, Chunk Content,
+    Chunk Number, as chunk_wikipedia.py writes them) into a SQLite file.
+    """
+    articles = defaultdict(list)
+    for chunk in chunks:
+        articles[chunk["Article Title"]].append(chunk)
+    entries = []
+    for title, article_chunks in articles.items():
+        article_chunks.sort(key=lambda c: c.get("Chunk Number") or 0)
+        text = " ".join(c["Chunk Content"] or "" for c in article_chunks)
+        entry = extract_entry(title, text)
+        if entry is not None:
+            entries.append(entry)
+
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.executescript("DROP TABLE IF EXISTS tests;" + SCHEMA)
+        connection.executemany(
+            "INSERT INTO tests VALUES (:name, :data_type, :groups, :paired,"
+            " :parametric, :assumptions, :summary)",
+            [{**e, "assumptions": json.dumps(e["assumptions"])} for e in entries],
+        )
+    connection.close()
+    return entries
+
+
+def scenario_features(situation: str) -> Dict[str, str]:
+    """
+    What the scenario says about its data, e.g.
+    {"data_type": "continuous", "groups": "two", "paired": "no"}
+    """
+    features = {}
+    for field, cues in SCENARIO_CUES.items():
+        value = _strongest(_tally(cues, situation))
+        if value is not None:
+            features[field] = value
+    return features
+
+
+def score_entry(entry: dict, features: Dict[str, str]) -> float:
+    """
+    Share of the scenario's features the test agrees with.
+    Unknown fields on the test count half.
+    """
+    points = 0.0
+    for field, value in features.items():
+        if field == "normality":
+            points += entry["parametric"] == (value == "normal")
+        elif entry[field] == "both":
+            points += 1
+        elif entry[field] is None:
+            points += 0.5
+        else:
+            points += entry[field] == value
+    return points / len(features)
+
+
+class TestCatalog:
+    """
+    Read-only view of the catalog. Lookups narrow candidates with the indexed
+    columns, then score them in Python.
+    """
+
+    def __init__(self, path=TEST_CATALOG_PATH):
+        self._connection = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self._connection.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        # opening is lazy, this raises OperationalError if it hasn't been built
+        self._connection.execute("SELECT 1 FROM tests LIMIT 1")
+
+    def candidates(self, features: Dict[str, str]) -> List[dict]:
+        clauses = [
+            f"{field} = :{field}"
+            for field in ("data_type", "groups")
+            if field in features
+        ]
+        if "paired" in features:
+            clauses.append("paired IN (:paired, 'both')")
+        if not clauses:
+            return []
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM tests WHERE " + " OR ".join(clauses), features
+            ).fetchall()
+        return [
+            {**dict(row), "assumptions": json.loads(row["assumptions"])} for row in rows
+        ]
+
+    def lookup(self, situation: str, limit=3, min_score=CATALOG_MIN_SCORE):
+        """
+        Best matching tests with their scores, or [] when the scenario doesn't
+        describe enough of its data (fewer than two features) to trust a match.
+        """
+        features = scenario_features(situation)
+        if len(features) < 2:
+            return []
+        scored = [
+            (score_entry(entry, features), entry) for entry in self.candidates(features)
+        ]
+        scored = [pair for pair in scored if pair[0] >= min_score]
+        scored.sort(key=lambda pair: (-pair[0], pair[1]["name"]))
+        return scored[:limit]
+
+
+_catalogs: Dict[str, TestCatalog] = {}
+_catalogs_lock = threading.Lock()
+
+
+def load_catalog(path=TEST_CATALOG_PATH) -> Optional[TestCatalog]:
+    """
+    Open the catalog once per process. Returns None if it hasn't been built,
+    and looks again on the next call, so a catalog built while a server
+    is running gets picked up.
+    """
+    with _catalogs_lock:
+        if path not in _catalogs:
+            try:
+                _catalogs[path] = TestCatalog(path)
+            except sqlite3.OperationalError:
+                return None
+        return _catalogs[path]
+
+
+def catalog_response(situation: str) -> Optional[FindTestResponse]:
+    """
+    find_test's fast path: a FindTestResponse straight from the catalog,
+    or None if there's no catalog or the match is weak.
+    Nothing about the data is checked here, so assumptions are not evaluated
+    (None), except normality, which fails for a scenario that describes
+    skewed data or outliers.
+    """
+    catalog = load_catalog()
+    if catalog is None:
+        return None
+    matches = catalog.lookup(situation)
+    if not matches:
+        return None
+    non_normal = scenario_features(situation).get("normality") == "non-normal"
+    return FindTestResponse(
+        situation=situation,
+        recommended_tests=[
+            TestRecommendation(
+                test_name=entry["name"],
+                assumptions_descriptions=entry["assumptions"],
+                assumptions_pass_statuses=[
+                    False if non_normal and NORMALITY.search(a) else None
+                    for a in entry["assumptions"]
+                ],
+            )
+            for _, entry in matches
+        ],
+    )
+
+
+app = typer.Typer()
+
+
+@app.command()
+def build(chunks_csv: str = "article_chunks.csv"):
+    """
+    Build the catalog from the CSV chunk_wikipedia.py writes.
+    """
+    import pandas as pd
+
+    chunks = pd.read_csv(chunks_csv).fillna("").to_dict("records")
+    entries = build_catalog(chunks)
+    for entry in entries:
+        typer.echo(
+            f"{entry['name']}: {entry['data_type']}, {entry['groups']} groups, "
+            f"paired={entry['paired']}, parametric={entry['parametric']}"
+        )
+    typer.echo(f"{len(entries)} tests written to {TEST_CATALOG_PATH}")
+
+
+@app.command()
+def lookup(situation: str):
+    """
+    Show how the catalog would answer a scenario, and the features it detected.
+    """
+    catalog = load_catalog()
+    if catalog is None:
+        raise typer.BadParameter(f"No catalog at {TEST_CATALOG_PATH}, build first")
+    typer.echo(f"features: {scenario_features(situation)}")
+    matches = catalog.lookup(situation)
+    if not matches:
+        typer.echo("weak match, find_test would ask Baseten")
+    for score, entry in matches:
+        typer.echo(f"{score:.2f}  {entry['name']}")
+
+
+if __name__ == "__main__":
+    app()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 
 class Assumption(BaseModel):
@@ -39,11 +39,12 @@ class TestRecommendation(BaseModel):
     A test recommendation is a recommendation for a statistical test to apply
     to a situation.
     Contains the test name, the assumptions, and the steps to apply the test.
+    A pass status is None when the assumption wasn't checked against the situation.
     """
 
     test_name: str
     assumptions_descriptions: List[str]
-    assumptions_pass_statuses: List[bool]
+    assumptions_pass_statuses: List[Optional[bool]]
 
 
 class FindTestResponse(BaseModel):
@@ -0,0 +1,199 @@
+# This file contains the persisted step results for StatisticsWorkflow.
+# A workflow run is a router call plus one or more tool calls, and a run that
+# times out used to lose every sub-call that had already finished. Each step's
+# output is written to a SQLite file as soon as it's done, keyed by the run and
+# the step's inputs, so a retried or resumed run replays the finished steps
+# and only re-runs the ones that failed or never finished. A run only replays
+# when its id is passed back: each new run gets a fresh one, and queued jobs
+# use one per job so their retries resume.
+#
+# python step_store.py runs
+# python step_store.py forget <run id>
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import Iterable, Optional, Tuple
+
+import typer
+
+from agent_configs import WORKFLOW_STORE_PATH, WORKFLOW_STORE_TTL
+from stat_structures import FindTestResponse, TestExample
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS steps (
+    run_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    step TEXT NOT NULL,
+    model TEXT,
+    result TEXT NOT NULL,
+    created REAL NOT NULL,
+    PRIMARY KEY (run_id, key)
+);
+"""
+
+# tool results that come back as pydantic models, rebuilt on replay
+RESULT_MODELS = (FindTestResponse, TestExample)
+
+
+def _default(o):
+    # nested models, and numpy scalars in query_db's match scores
+    if hasattr(o, "model_dump"):
+        return o.model_dump(mode="json")
+    if hasattr(o, "item"):
+        return o.item()
+    return str(o)
+
+
+def step_key(*inputs) -> str:
+    """
+    Identifies a step by everything that went into it.
+    """
+    encoded = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode()).hexdigest()
+
+
+def new_run_id() -> str:
+    """
+    A run id for a run the caller didn't name. Every run gets its own, so
+    only a caller (or a job retry) passing an id back replays anything.
+    """
+    return uuid.uuid4().hex[:16]
+
+
+class StepStore:
+    """
+    SQLite-backed step results. Safe to share between threads (one connection
+    behind a lock), since workflow tools finish on worker threads.
+    models are the pydantic classes a stored result can be rebuilt as.
+    """
+
+    def __init__(
+        self,
+        path=WORKFLOW_STORE_PATH,
+        ttl=WORKFLOW_STORE_TTL,
+        models: Iterable[type] = RESULT_MODELS,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.models = {model.__name__: model for model in models}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.executescript(SCHEMA)
+
+    def get(self, run_id: str, key: str) -> Tuple[bool, object]:
+        """
+        (True, result) for a finished step, (False, None) otherwise.
+        None is a valid result, hence the flag.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT model, result FROM steps"
+                " WHERE run_id = ? AND key = ? AND created >= ?",
+                (run_id, key, time.time() - self.ttl),
+            ).fetchone()
+        if row is None:
+            return False, None
+        model, result = row
+        data = json.loads(result)
+        if model is not None:
+            if model not in self.models:
+                # written by a version that had a model this one doesn't
+                return False, None
+            return True, self.models[model](**data)
+        return True, data
+
+    def put(self, run_id: str, key: str, step: str, result):
+        model = None
+        if type(result).__name__ in self.models:
+            model = type(result).__name__
+            result = result.model_dump(mode="json")
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO steps"
+                " (run_id, key, step, model, result, created)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    run_id,
+                    key,
+                    step,
+                    model,
+                    json.dumps(result, default=_default),
+                    time.time(),
+                ),
+            )
+
+    def forget(self, run_id: str) -> int:
+        """
+        Drop a run's steps, so it starts from scratch. Returns how many.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM steps WHERE run_id = ?", (run_id,)
+            )
+        return cursor.rowcount
+
+    def prune(self) -> int:
+        """
+        Delete steps older than the TTL, which get() ignores anyway.
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM steps WHERE created < ?", (time.time() - self.ttl,)
+            )
+        return cursor.rowcount
+
+    def runs(self):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT run_id, COUNT(*), MAX(created) FROM steps"
+                " GROUP BY run_id ORDER BY MAX(created) DESC"
+            ).fetchall()
+        return [
+            {"run_id": run_id, "steps": steps, "updated": updated}
+            for run_id, steps, updated in rows
+        ]
+
+
+@lru_cache(maxsize=None)
+def load_step_store(
+    path=WORKFLOW_STORE_PATH, models: Tuple[type, ...] = RESULT_MODELS
+) -> Optional[StepStore]:
+    """
+    Open the store once per process. Returns None if it's turned off.
+    """
+    if not path:
+        return None
+    return StepStore(path, models=models)
+
+
+app = typer.Typer()
+
+
+@app.command()
+def runs():
+    """
+    Print stored runs as NDJSON, most recent first.
+    """
+    for run in StepStore().runs():
+        typer.echo(json.dumps(run))
+
+
+@app.command()
+def forget(run_id: str):
+    typer.echo(f"forgot {StepStore().forget(run_id)} steps of {run_id}")
+
+
+@app.command()
+def prune():
+    typer.echo(f"pruned {StepStore().prune()} expired steps")
+
+
+if __name__ == "__main__":
+    app()
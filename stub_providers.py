@@ -0,0 +1,393 @@
+# This file contains a local stand-in server for Pinecone, Cohere and Baseten.
+# It replays recorded responses with configurable injected latency, so we can
+# benchmark and load-test hsage without network access. OpenAI compatible
+# /chat/completions requests are answered from their JSON schema or tool list
+# when there's no recording, the same way the mock LLM backend answers.
+#
+# Replay (default):  python stub_providers.py serve --port 8089
+# Record from live:  python stub_providers.py record --port 8089
+# then point the clients at it, e.g.
+#   PINECONE_HOST=http://127.0.0.1:8089 PINECONE_INDEX_HOST=http://127.0.0.1:8089
+#   COHERE_BASE_URL=http://127.0.0.1:8089 BASETEN_BASE_URL=http://127.0.0.1:8089
+#   HSAGE_OPENAI_BASE_URL=http://127.0.0.1:8089/v1
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+import typer
+
+from mock_llm import mock_json, mock_text, mock_tool_call
+
+RECORDINGS_PATH = "bench_recordings.json"
+EMBEDDING_DIMENSION = 1024
+
+# which provider each route belongs to
+ROUTES = {
+    "/embed": "pinecone_inference",
+    "/query": "pinecone_index",
+    "/v1/chat": "cohere",
+    "/v1/rerank": "cohere_rerank",
+    "/production/predict": "baseten",
+    "/chat/completions": "openai",
+}
+
+
+def request_hash(path: str, body: bytes) -> str:
+    return hashlib.sha256(path.encode() + b"\n" + body).hexdigest()
+
+
+def fake_embedding(text: str, dimension=EMBEDDING_DIMENSION):
+    """
+    Deterministic unit vector for a piece of text. The stand-in index returns
+    recorded matches regardless, so the values only need the right shape.
+    """
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    values = [rng.gauss(0, 1) for _ in range(dimension)]
+    norm = sum(v * v for v in values) ** 0.5
+    return [v / norm for v in values]
+
+
+class Recordings:
+    """
+    Recorded responses per provider. Each provider has a list of entries:
+    {"request_hash": ..., "match": [...], "response": {...}}
+    An entry with a request_hash only replays for that exact request,
+    otherwise it replays when every "match" substring is in the request body.
+    The last entry without a hash or match list is the default.
+    """
+
+    def __init__(self, path=RECORDINGS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def find(self, provider: str, path: str, body: bytes) -> Optional[dict]:
+        entries = self.entries.get(provider, [])
+        digest = request_hash(path, body)
+        text = body.decode(errors="ignore")
+        for entry in entries:
+            if entry.get("request_hash") == digest:
+                return entry["response"]
+        for entry in entries:
+            if "request_hash" in entry:
+                continue
+            if all(m in text for m in entry.get("match", [])):
+                return entry["response"]
+        return None
+
+    def add(self, provider: str, path: str, body: bytes, response: dict):
+        with self._lock:
+            self.entries.setdefault(provider, []).insert(
+                0, {"request_hash": request_hash(path, body), "response": response}
+            )
+            with open(self.path, "w") as f:
+                json.dump(self.entries, f, indent=2)
+
+
+def _embed_response(body: dict) -> dict:
+    texts = [i["text"] if isinstance(i, dict) else i for i in body.get("inputs", [])]
+    # current Pinecone clients refuse an embed response without vector_type
+    return {
+        "model": body.get("model", "multilingual-e5-large"),
+        "vector_type": "dense",
+        "data": [{"vector_type": "dense", "values": fake_embedding(t)} for t in texts],
+        "usage": {"total_tokens": sum(len(t) // 4 for t in texts)},
+    }
+
+
+def _rerank_response(body: dict) -> dict:
+    """
+    Stand-in for Cohere rerank: relevance is the share of query words
+    that show up in each document, good enough to exercise the code path.
+    """
+    query_words = set(body.get("query", "").lower().split())
+    documents = [
+        d["text"] if isinstance(d, dict) else d for d in body.get("documents", [])
+    ]
+    results = [
+        {
+            "index": i,
+            "relevance_score": len(query_words & set(d.lower().split()))
+            / max(len(query_words), 1),
+        }
+        for i, d in enumerate(documents)
+    ]
+    results.sort(key=lambda r: r["relevance_score"], reverse=True)
+    return {
+        "id": "stub",
+        "results": results[: body.get("top_n") or len(results)],
+        "meta": {"billed_units": {"search_units": 1}},
+    }
+
+
+def _openai_response(body: dict) -> dict:
+    """
+    Stand-in for an OpenAI compatible chat completion, built from the request.
+    """
+    message = body.get("messages", [{}])[-1].get("content") or ""
+    reply = {"role": "assistant", "content": None}
+    response_format = body.get("response_format") or {}
+    if body.get("tools"):
+        call = mock_tool_call(message, [t["function"] for t in body["tools"]])
+        reply["tool_calls"] = [
+            {
+                "id": "stub",
+                "type": "function",
+                "function": {
+                    "name": call["name"],
+                    "arguments": json.dumps(call["parameters"]),
+                },
+            }
+        ]
+    elif response_format.get("type") == "json_schema":
+        schema = response_format["json_schema"]["schema"]
+        reply["content"] = json.dumps(mock_json(schema))
+    else:
+        reply["content"] = mock_text(message)
+    prompt = sum(len(m.get("content") or "") for m in body.get("messages", []))
+    return {
+        "id": "stub",
+        "object": "chat.completion",
+        "model": body.get("model", "stub"),
+        "choices": [{"index": 0, "message": reply, "finish_reason": "stop"}],
+        "usage": {
+            "prompt_tokens": prompt // 4,
+            "completion_tokens": len(reply["content"] or "") // 4,
+        },
+    }
+
+
+def _openai_stream_events(response: dict) -> bytes:
+    """
+    A chat completion replayed as server-sent chunks, ending with usage.
+    """
+    words = (response["choices"][0]["message"].get("content") or "").split(" ")
+    events = []
+    for i in range(0, len(words), 8):
+        text = " ".join(words[i : i + 8]) + (" " if i + 8 < len(words) else "")
+        events.append({"choices": [{"index": 0, "delta": {"content": text}}]})
+    events.append({"choices": [], "usage": response.get("usage")})
+    lines = [b"data: " + json.dumps(event).encode() + b"\n\n" for event in events]
+    return b"".join(lines) + b"data: [DONE]\n\n"
+
+
+def _chat_stream_events(response: dict) -> bytes:
+    """
+    A recorded Cohere chat response replayed as the newline-delimited
+    events chat_stream expects, a few words per text-generation event.
+    """
+    words = (response.get("text") or "").split(" ")
+    events = [
+        {"event_type": "stream-start", "generation_id": "stub", "is_finished": False}
+    ]
+    for i in range(0, len(words), 8):
+        text = " ".join(words[i : i + 8]) + (" " if i + 8 < len(words) else "")
+        events.append(
+            {"event_type": "text-generation", "text": text, "is_finished": False}
+        )
+    events.append(
+        {
+            "event_type": "stream-end",
+            "finish_reason": "COMPLETE",
+            "response": response,
+            "is_finished": True,
+        }
+    )
+    return b"".join(json.dumps(event).encode() + b"\n" for event in events)
+
+
+def make_handler(
+    recordings: Recordings,
+    latency: Dict[str, float],
+    jitter: float = 0.0,
+    upstreams: Optional[Dict[str, str]] = None,
+):
+    """
+    Build a request handler class bound to a set of recordings.
+    latency is seconds of injected delay per provider (cohere_rerank counts
+    separately from cohere chat), jitter a +/- fraction.
+    With upstreams set, requests are forwarded to the real provider and recorded.
+    """
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            path = self.path.split("?")[0]
+            provider = next(
+                (p for route, p in ROUTES.items() if path.endswith(route)), None
+            )
+            if provider is None:
+                self._send_json(404, {"error": f"no stand-in for {path}"})
+                return
+
+            if upstreams:
+                self._forward(provider, path, body)
+                return
+
+            delay = latency.get(provider, 0.0)
+            if delay:
+                time.sleep(max(0.0, delay * (1 + random.uniform(-jitter, jitter))))
+
+            response = recordings.find(provider, path, body)
+            if response is None and provider == "pinecone_inference":
+                response = _embed_response(json.loads(body or b"{}"))
+            if response is None and provider == "cohere_rerank":
+                response = _rerank_response(json.loads(body or b"{}"))
+            if response is None and provider == "openai":
+                response = _openai_response(json.loads(body or b"{}"))
+            if response is None:
+                self._send_json(404, {"error": f"no recording for {provider}"})
+                return
+            if provider == "cohere" and json.loads(body or b"{}").get("stream"):
+                self._send_stream(_chat_stream_events(response))
+                return
+            if provider == "openai" and json.loads(body or b"{}").get("stream"):
+                self._send_stream(_openai_stream_events(response), "text/event-stream")
+                return
+            self._send_json(200, response)
+
+        def _send_stream(self, data, content_type="application/stream+json"):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _forward(self, provider, path, body):
+            import requests
+
+            headers = {
+                k: v
+                for k, v in self.headers.items()
+                if k.lower() not in ("host", "content-length")
+            }
+            resp = requests.post(upstreams[provider] + path, data=body, headers=headers)
+            if resp.ok:
+                recordings.add(provider, path, body, resp.json())
+            self.send_response(resp.status_code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(resp.content)))
+            self.end_headers()
+            self.wfile.write(resp.content)
+
+    return StubHandler
+
+
+def start_stub_server(
+    port=0,
+    latency: Optional[Dict[str, float]] = None,
+    jitter=0.0,
+    recordings_path=RECORDINGS_PATH,
+    upstreams: Optional[Dict[str, str]] = None,
+):
+    """
+    Start the stand-in server on a daemon thread, and return it.
+    port=0 picks a free port, read it back from server.server_address.
+    """
+    handler = make_handler(
+        Recordings(recordings_path), latency or {}, jitter, upstreams=upstreams
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stub_environment(server) -> Dict[str, str]:
+    """
+    Environment variables that point every hsage client at the stand-in server.
+    """
+    host, port = server.server_address[:2]
+    url = f"http://{host}:{port}"
+    return {
+        "PINECONE_HOST": url,
+        "PINECONE_INDEX_HOST": url,
+        "COHERE_BASE_URL": url,
+        "BASETEN_BASE_URL": url,
+        "HSAGE_OPENAI_BASE_URL": f"{url}/v1",
+    }
+
+
+def parse_latency(latency: str) -> Dict[str, float]:
+    """
+    "cohere=0.4,baseten=1.5" -> {"cohere": 0.4, "baseten": 1.5}
+    """
+    parsed = {}
+    for part in filter(None, (p.strip() for p in latency.split(","))):
+        provider, seconds = part.split("=")
+        parsed[provider.strip()] = float(seconds)
+    return parsed
+
+
+app = typer.Typer()
+
+
+@app.command()
+def serve(
+    port: int = 8089,
+    latency: str = "",
+    jitter: float = 0.0,
+    recordings: str = RECORDINGS_PATH,
+):
+    """
+    Replay recorded responses, e.g. --latency cohere=0.4,baseten=1.5
+    """
+    server = start_stub_server(port, parse_latency(latency), jitter, recordings)
+    for key, value in stub_environment(server).items():
+        typer.echo(f"{key}={value}")
+    threading.Event().wait()
+
+
+@app.command()
+def record(
+    port: int = 8089,
+    recordings: str = RECORDINGS_PATH,
+    pinecone_host: str = typer.Option(..., help="Real Pinecone inference host"),
+    pinecone_index_host: str = typer.Option(..., help="Real Pinecone index host"),
+    baseten_base_url: str = typer.Option(..., help="Real Baseten model URL"),
+    cohere_base_url: str = "https://api.cohere.com",
+    openai_base_url: str = typer.Option(
+        "https://api.openai.com", help="Real OpenAI compatible host, without /v1"
+    ),
+):
+    """
+    Forward to the real providers and save every response for later replay.
+    """
+    upstreams = {
+        "pinecone_inference": pinecone_host,
+        "pinecone_index": pinecone_index_host,
+        "cohere": cohere_base_url,
+        "cohere_rerank": cohere_base_url,
+        "baseten": baseten_base_url,
+        "openai": openai_base_url,
+    }
+    server = start_stub_server(port, recordings_path=recordings, upstreams=upstreams)
+    for key, value in stub_environment(server).items():
+        typer.echo(f"{key}={value}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,338 @@
+# This file contains the timing spans and local metrics exporters.
+# Every provider call and workflow step is wrapped in a span, so we can see
+# embed vs. vector search vs. LLM time without sending anything to a remote
+# tracing service. Spans can go to a JSONL file, a Prometheus text endpoint,
+# or a local OTLP collector.
+import atexit
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from agent_configs import (
+    PHOENIX_API_KEY,
+    PHOENIX_ENDPOINT,
+    METRICS_EXPORTERS,
+    METRICS_JSONL_PATH,
+    PROMETHEUS_PORT,
+    OTLP_ENDPOINT,
+)
+from rate_limiter import limiter_metrics
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def percentile(samples, q):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not samples:
+        return 0.0
+    rank = max(0, math.ceil(q * len(samples)) - 1)
+    return samples[rank]
+
+
+class LatencyRecorder:
+    """
+    Keeps the last max_samples durations per span name,
+    plus running counts and sums so totals stay exact.
+    """
+
+    def __init__(self, max_samples=10000):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=max_samples))
+        self._counts = defaultdict(int)
+        self._sums = defaultdict(float)
+
+    def record(self, name, seconds):
+        with self._lock:
+            self._samples[name].append(seconds)
+            self._counts[name] += 1
+            self._sums[name] += seconds
+
+    def summary(self):
+        """
+        p50/p95/p99 per span name, in seconds.
+        """
+        with self._lock:
+            names = list(self._samples)
+            samples = {name: sorted(self._samples[name]) for name in names}
+            counts = dict(self._counts)
+            sums = dict(self._sums)
+
+        return {
+            name: {
+                "count": counts[name],
+                "sum": sums[name],
+                "p50": percentile(samples[name], 0.5),
+                "p95": percentile(samples[name], 0.95),
+                "p99": percentile(samples[name], 0.99),
+                "max": samples[name][-1] if samples[name] else 0.0,
+            }
+            for name in names
+        }
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+            self._counts.clear()
+            self._sums.clear()
+
+
+recorder = LatencyRecorder()
+_span_listeners = []
+_otel_tracer = None
+
+
+def add_span_listener(fn):
+    """
+    Register a callback that gets every finished span as a dict.
+    """
+    _span_listeners.append(fn)
+
+
+def remove_span_listener(fn):
+    if fn in _span_listeners:
+        _span_listeners.remove(fn)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Time the block and hand the result to the recorder and exporters.
+    """
+    otel_span = (
+        _otel_tracer.start_as_current_span(name, attributes=attributes)
+        if _otel_tracer
+        else None
+    )
+    if otel_span:
+        otel_span.__enter__()
+    start_wall = time.time()
+    start = time.perf_counter()
+    error = None
+    exc_info = (None, None, None)
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        exc_info = (type(e), e, e.__traceback__)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        if otel_span:
+            # lets the OTLP span record the exception and an error status
+            otel_span.__exit__(*exc_info)
+        recorder.record(name, duration)
+        if _span_listeners:
+            record = {
+                "name": name,
+                "start": start_wall,
+                "duration": duration,
+                "attributes": attributes,
+                "error": error,
+            }
+            for listener in _span_listeners:
+                listener(record)
+
+
+def timed(name):
+    """
+    Decorator version of span for plain functions.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def latency_summary():
+    return recorder.summary()
+
+
+# JSONL exporter
+
+
+class JsonlExporter:
+    """
+    Appends one line per span, and a summary line when the process exits.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._file = open(path, "a", buffering=1)
+
+    def __call__(self, record):
+        line = json.dumps({"type": "span", "pid": os.getpid(), **record}, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.write(
+                json.dumps(
+                    {
+                        "type": "summary",
+                        "pid": os.getpid(),
+                        "spans": latency_summary(),
+                        "limiters": limiter_metrics(),
+                    }
+                )
+                + "\n"
+            )
+            self._file.close()
+
+
+# Prometheus exporter
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def render_prometheus():
+    """
+    Render span summaries and limiter metrics in the Prometheus text format.
+    """
+    lines = [
+        "# HELP hsage_span_seconds Wall time per stage.",
+        "# TYPE hsage_span_seconds summary",
+    ]
+    for name, stats in latency_summary().items():
+        stage = _label(name)
+        for q in QUANTILES:
+            key = f"p{int(q * 100)}"
+            lines.append(
+                f'hsage_span_seconds{{stage="{stage}",quantile="{q}"}} {stats[key]}'
+            )
+        lines.append(f'hsage_span_seconds_sum{{stage="{stage}"}} {stats["sum"]}')
+        lines.append(f'hsage_span_seconds_count{{stage="{stage}"}} {stats["count"]}')
+
+    gauges = {
+        "queue_depth": "Callers currently waiting for a slot.",
+        "in_flight": "Requests currently in flight.",
+        "total_wait_seconds": "Total time spent queued in the limiter.",
+        "max_wait_seconds": "Longest single wait in the limiter.",
+        "rate_limited": "Number of 429s seen from the provider.",
+    }
+    limiters = limiter_metrics()
+    for metric, help_text in gauges.items():
+        lines.append(f"# HELP hsage_limiter_{metric} {help_text}")
+        lines.append(f"# TYPE hsage_limiter_{metric} gauge")
+        for snapshot in limiters:
+            provider = _label(snapshot["provider"])
+            lines.append(
+                f'hsage_limiter_{metric}{{provider="{provider}"}} {snapshot[metric]}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # keep scrapes out of the CLI output
+        pass
+
+
+def start_prometheus_server(port=PROMETHEUS_PORT):
+    """
+    Serve /metrics on localhost from a daemon thread. Returns None if the port
+    is taken, e.g. by another hsage process already serving metrics.
+    """
+    try:
+        server = ThreadingHTTPServer(("127.0.0.1", port), _MetricsHandler)
+    except OSError as e:
+        print(f"Not serving Prometheus metrics on port {port}: {e}", file=sys.stderr)
+        return None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+# OTLP exporter
+
+
+def setup_otlp(endpoint=OTLP_ENDPOINT):
+    """
+    Send spans to a local OpenTelemetry collector over OTLP/HTTP.
+    """
+    global _otel_tracer
+    try:
+        from opentelemetry import trace
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+    except ImportError as e:
+        raise ImportError(
+            "The otlp exporter needs opentelemetry-sdk and "
+            "opentelemetry-exporter-otlp-proto-http installed"
+        ) from e
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "hsage"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=endpoint)))
+    trace.set_tracer_provider(provider)
+    _otel_tracer = trace.get_tracer("hsage")
+    atexit.register(provider.shutdown)
+
+
+def setup_phoenix():
+    """
+    Only send llama_index traces to Phoenix when we actually have a key for it.
+    """
+    if not PHOENIX_API_KEY:
+        return
+    import llama_index.core
+
+    os.environ["OTEL_EXPORTER_OTLP_HEADERS"] = f"api_key={PHOENIX_API_KEY}"
+    llama_index.core.set_global_handler("arize_phoenix", endpoint=PHOENIX_ENDPOINT)
+
+
+_configured = False
+
+
+def configure_exporters(exporters=METRICS_EXPORTERS):
+    """
+    Start the configured exporters. Called by entry points (the CLI, the server,
+    job workers), not on import, so library imports never bind a port.
+    Only the first call in a process does anything.
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    for exporter in exporters:
+        if exporter == "jsonl":
+            jsonl = JsonlExporter(METRICS_JSONL_PATH)
+            add_span_listener(jsonl)
+            atexit.register(jsonl.close)
+        elif exporter == "prometheus":
+            start_prometheus_server()
+        elif exporter == "otlp":
+            setup_otlp()
+        else:
+            raise ValueError(f"Unknown metrics exporter: {exporter}")
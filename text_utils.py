@@ -0,0 +1,7 @@
+# This file contains small text helpers shared by the ingest scripts and the
+# runtime retrieval code. It imports nothing from the rest of the project, so
+# ingest scripts can use it without pulling in the provider clients.
+import re
+
+# a sentence ends at . ! or ? followed by whitespace
+SENTENCE_SPLIT = re.compile(r"(?<=[.!?])\s+")
@@ -1,53 +1,160 @@
 # This script will upsert the chunked wikipedia articles into Pinecone.
+import csv
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 from pinecone import Pinecone, ServerlessSpec
 import pandas as pd
 from tqdm import tqdm
-import time
-from agent_configs import STATWIKI_INDEX, PINECONE_API_KEY
-
-pc = Pinecone(api_key=PINECONE_API_KEY)
+from agent_configs import (
+    STATWIKI_INDEX,
+    PINECONE_API_KEY,
+    EMBED_CHECKPOINT_PATH,
+    UPSERT_MAX_BYTES,
+    UPSERT_MAX_VECTORS,
+    UPSERT_WORKERS,
+    UPSERT_GRPC,
+)
+from embedding_checkpoint import EmbeddingCheckpoint
+from rate_limiter import call_with_limits, BATCH
+from retrieval_filters import is_junk_title
+from usage_ledger import metered_call, pinecone_embed_usage, request_ledger
+
+if UPSERT_GRPC:
+    # needs pinecone[grpc], vectors go out as packed floats instead of JSON
+    from pinecone.grpc import PineconeGRPC
+
+    pc = PineconeGRPC(api_key=PINECONE_API_KEY)
+else:
+    pc = Pinecone(api_key=PINECONE_API_KEY)
 
 index_name = STATWIKI_INDEX
 
+METADATA_COLUMNS = ["Article Title", "Section Title", "Chunk Content", "Chunk Number"]
+# rough encoded size of one float, JSON text over REST vs packed over gRPC
+BYTES_PER_FLOAT = 4 if UPSERT_GRPC else 20
+
 
 def count_tokens(text):
     return len(text) / 4
 
 
 # Function to embed chunks in groups of 96
-def embed_chunks_in_batches(data, pc):
-    embeddings = []
+def embed_chunks_in_batches(data, pc, checkpoint_path=EMBED_CHECKPOINT_PATH):
+    """
+    Returns a (len(data), 1024) memory-mapped array of embeddings.
+    Every batch is written to the checkpoint as soon as it comes back,
+    so rerunning after a crash skips the batches already paid for.
+    """
     batch_size = 96
-    total_tokens = 0
+    checkpoint = EmbeddingCheckpoint.open(checkpoint_path, data, dimension=1024)
+    if checkpoint.completed_rows():
+        print(f"Resuming, {checkpoint.completed_rows()} chunks already embedded")
 
-    # Process data in batches of 96, respecting rate limits
+    # Process data in batches of 96. The shared rate limiter takes care of the
+    # request and tokens-per-minute limits, so we just queue up behind it.
     for i in tqdm(range(0, len(data), batch_size), desc="Embedding chunks"):
+        if checkpoint.is_done(i):
+            continue
         batch = data[i : i + batch_size]  # Get the current batch
         batch_tokens = sum(
             count_tokens(d) for d in batch
         )  # Calculate total tokens in batch
-        total_tokens += batch_tokens  # Update total tokens processed
-        # Check if we've exceeded the token limit
-        if total_tokens > 250000:
-            time.sleep(60)  # Wait for a minute to reset the token limit
-            total_tokens = batch_tokens  # Reset total tokens
-        batch_embeddings = pc.inference.embed(
+        batch_embeddings = metered_call(
+            "pinecone_inference",
+            "embed",
+            pc.inference.embed,
             "multilingual-e5-large",
             inputs=batch,  # Use 'Chunk Content' for embedding
             parameters={"input_type": "passage", "truncate": "END"},
+            usage_fn=pinecone_embed_usage,
+            request_bytes=sum(len(d.encode()) for d in batch),
+            input_tokens=int(batch_tokens),
+            tokens=batch_tokens,
+            priority=BATCH,
+        )
+        checkpoint.write_batch(
+            i, [e["values"] for e in batch_embeddings], tokens=int(batch_tokens)
         )
-        embeddings.extend(batch_embeddings)  # Collect the embeddings
-
-        # Check if we've exceeded the request limit
-        if len(embeddings) % 200 == 0:
-            time.sleep(60)  # Wait for a minute to reset the request limit
 
-    return embeddings
+    return checkpoint.vectors
+
+
+def build_metadata(df):
+    """
+    Metadata dicts for every row, built column-wise instead of a row-wise apply.
+    """
+    columns = df[METADATA_COLUMNS].fillna("")
+    return columns.to_dict("records")
+
+
+def upsert_batches(ids, vectors, metadata, max_bytes, max_vectors):
+    """
+    Stream (id, values, metadata) batches, cut by estimated payload size
+    rather than a fixed count, since chunk metadata varies a lot in size.
+    """
+    batch, batch_bytes = [], 0
+    for vector_id, vector, meta in zip(ids, vectors, metadata):
+        size = len(vector_id) + len(vector) * BYTES_PER_FLOAT + len(json.dumps(meta))
+        if batch and (batch_bytes + size > max_bytes or len(batch) >= max_vectors):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append((vector_id, vector.tolist(), meta))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def upsert_batch(index, batch):
+    call_with_limits("pinecone_index", index.upsert, vectors=batch, priority=BATCH)
+    return len(batch)
+
+
+def stream_upsert(
+    index,
+    ids,
+    vectors,
+    metadata,
+    workers=UPSERT_WORKERS,
+    max_bytes=UPSERT_MAX_BYTES,
+    max_vectors=UPSERT_MAX_VECTORS,
+    on_batch=None,
+):
+    """
+    Upsert with up to `workers` requests in flight. Batches are built lazily,
+    so only the batches in flight are ever in memory. on_batch is called with
+    each batch as it's sent. Returns vectors/sec.
+    """
+    start = time.perf_counter()
+    sent = 0
+    in_flight = set()
+    progress = tqdm(total=len(ids), desc="Upserting", unit="vec")
+    with ThreadPoolExecutor(workers) as pool:
+        for batch in upsert_batches(ids, vectors, metadata, max_bytes, max_vectors):
+            if len(in_flight) >= workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    count = future.result()
+                    sent += count
+                    progress.update(count)
+            in_flight.add(pool.submit(upsert_batch, index, batch))
+            if on_batch is not None:
+                on_batch(batch)
+        for future in in_flight:
+            count = future.result()
+            sent += count
+            progress.update(count)
+    progress.close()
+    elapsed = time.perf_counter() - start
+    return sent / elapsed if elapsed else 0.0
 
 
 if __name__ == "__main__":
     # Read the data
     df = pd.read_csv("article_chunks.csv")
+    # older chunk files still have template/talk pages, don't pay to embed them
+    df = df[~df["Article Title"].map(is_junk_title)]
 
     # create index
 
@@ -62,24 +169,28 @@ if __name__ == "__main__":
     index = pc.Index(index_name)
 
     # Embed the chunk content
-    embeddings = embed_chunks_in_batches(df["Chunk Content"].tolist(), pc)
-    embeddings = [e["values"] for e in embeddings]
-
-    # Create a new dataframe with the required format
-    df["values"] = embeddings
-    df["id"] = df.index.astype(str)
-    df.fillna("", inplace=True)
-
-    print(df.head())
-    df["metadata"] = df[
-        ["Article Title", "Section Title", "Chunk Content", "Chunk Number"]
-    ].apply(lambda row: row.to_dict(), axis=1)
-
-    # Select the required columns
-    df = df[["id", "values", "metadata"]]
-    print(df.metadata[0])
-    # write to file
-    df.to_csv("embedded_articles.csv", index=False)
-
-    # Upsert the data into Pinecone
-    index.upsert_from_dataframe(df, batch_size=50)
+    with request_ledger("embed_chunks") as ledger:
+        embeddings = embed_chunks_in_batches(df["Chunk Content"].tolist(), pc)
+    print(ledger.report().totals)
+
+    ids = df.index.astype(str).tolist()
+    metadata = build_metadata(df)
+    print(metadata[0])
+
+    # Upsert the data into Pinecone, straight from the memory-mapped embeddings.
+    # Each batch is appended to embedded_articles.csv as it goes out
+    # (local_vector_index.py builds from it), so that's never all in memory either
+    with open("embedded_articles.csv", "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["id", "values", "metadata"])
+
+        def write_batch(batch):
+            writer.writerows(
+                (vector_id, json.dumps(values), str(meta))
+                for vector_id, values, meta in batch
+            )
+
+        vectors_per_second = stream_upsert(
+            index, ids, embeddings, metadata, on_batch=write_batch
+        )
+    print(f"Upserted {len(ids)} vectors, {vectors_per_second:.0f} vectors/sec")
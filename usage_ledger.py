@@ -0,0 +1,532 @@
+# This file contains the per-request token and cost ledger.
+# Every provider call records tokens, bytes, retries and wall time into the
+# ledger for the request it belongs to, so we can see which commands dominate
+# spend and latency. Finished ledgers can also be logged for batch reports.
+import contextvars
+import json
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from agent_configs import PROVIDER_PRICES, USAGE_LOG_PATH, USAGE_REPORTS_KEPT
+from rate_limiter import call_with_limits, stream_with_limits
+from telemetry import span
+
+
+class ProviderCall(BaseModel):
+    """
+    A single call to Pinecone, Cohere or Baseten.
+    estimated_tokens is set when the provider didn't report token counts
+    and we fell back to the 4 characters per token rule of thumb.
+    failed is set when the call still raised after all its retries.
+    """
+
+    provider: str
+    operation: str
+    input_tokens: int = 0
+    output_tokens: int = 0
+    read_units: int = 0
+    request_bytes: int = 0
+    response_bytes: int = 0
+    retries: int = 0
+    wall_time: float = 0.0
+    estimated_tokens: bool = False
+    failed: bool = False
+    cost: float = 0.0
+
+
+class ProviderTotals(BaseModel):
+    """
+    All calls to one provider within a request (or a batch of requests).
+    """
+
+    provider: str
+    calls: int = 0
+    failures: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    read_units: int = 0
+    request_bytes: int = 0
+    response_bytes: int = 0
+    retries: int = 0
+    wall_time: float = 0.0
+    cost: float = 0.0
+
+
+class UsageReport(BaseModel):
+    """
+    Everything a single request (CLI command or workflow run) spent.
+    """
+
+    command: str
+    wall_time: float
+    calls: List[ProviderCall]
+    totals: List[ProviderTotals]
+    # retrieved context size before and after assembly (see context_budget.py)
+    context_tokens_before: int = 0
+    context_tokens_after: int = 0
+    # prompts built from retrieved chunks, and how many chunks went into them
+    context_prompts: int = 0
+    context_chunks: int = 0
+    # candidate tokens before and after the rerank stage (see rerank.py)
+    rerank_tokens_before: int = 0
+    rerank_tokens_after: int = 0
+    # workflow steps answered from the step store instead of run (see step_store.py)
+    replayed_steps: int = 0
+
+
+class CommandTotals(BaseModel):
+    """
+    Aggregate usage for one command over a batch run.
+    """
+
+    command: str
+    requests: int
+    input_tokens: int
+    output_tokens: int
+    retries: int
+    cost: float
+    wall_time: float
+    avg_wall_time: float
+    providers: List[ProviderTotals]
+    context_tokens_before: int = 0
+    context_tokens_after: int = 0
+    context_prompts: int = 0
+    context_chunks: int = 0
+    rerank_tokens_before: int = 0
+    rerank_tokens_after: int = 0
+    replayed_steps: int = 0
+
+
+def estimate_tokens(text_or_bytes) -> int:
+    return len(text_or_bytes) // 4
+
+
+def call_cost(provider, input_tokens, output_tokens):
+    prices = PROVIDER_PRICES.get(provider, {"input": 0, "output": 0})
+    return (input_tokens * prices["input"] + output_tokens * prices["output"]) / 1e6
+
+
+def _sum_calls(provider, calls) -> ProviderTotals:
+    totals = ProviderTotals(provider=provider)
+    for call in calls:
+        totals.calls += 1
+        totals.failures += call.failed
+        totals.input_tokens += call.input_tokens
+        totals.output_tokens += call.output_tokens
+        totals.read_units += call.read_units
+        totals.request_bytes += call.request_bytes
+        totals.response_bytes += call.response_bytes
+        totals.retries += call.retries
+        totals.wall_time += call.wall_time
+        totals.cost += call.cost
+    return totals
+
+
+class UsageLedger:
+    """
+    Collects ProviderCalls for one request. Thread safe, since workflow tools
+    run in worker threads and can record into the same ledger at once.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._calls = []
+        self._context_before = 0
+        self._context_after = 0
+        self._context_prompts = 0
+        self._context_chunks = 0
+        self._rerank_before = 0
+        self._rerank_after = 0
+        self._replayed_steps = 0
+
+    def record(self, call: ProviderCall):
+        with self._lock:
+            self._calls.append(call)
+
+    def record_context(self, tokens_before: int, tokens_after: int, chunks: int = 0):
+        with self._lock:
+            self._context_before += tokens_before
+            self._context_after += tokens_after
+            self._context_prompts += 1
+            self._context_chunks += chunks
+
+    def record_rerank(self, tokens_before: int, tokens_after: int):
+        with self._lock:
+            self._rerank_before += tokens_before
+            self._rerank_after += tokens_after
+
+    def record_replay(self):
+        with self._lock:
+            self._replayed_steps += 1
+
+    def report(self) -> UsageReport:
+        with self._lock:
+            calls = list(self._calls)
+            context_before, context_after = self._context_before, self._context_after
+            prompts, chunks = self._context_prompts, self._context_chunks
+            rerank_before, rerank_after = self._rerank_before, self._rerank_after
+            replayed = self._replayed_steps
+        providers = sorted({call.provider for call in calls})
+        return UsageReport(
+            command=self.command,
+            wall_time=time.perf_counter() - self.started,
+            calls=calls,
+            totals=[
+                _sum_calls(p, [c for c in calls if c.provider == p]) for p in providers
+            ],
+            context_tokens_before=context_before,
+            context_tokens_after=context_after,
+            context_prompts=prompts,
+            context_chunks=chunks,
+            rerank_tokens_before=rerank_before,
+            rerank_tokens_after=rerank_after,
+            replayed_steps=replayed,
+        )
+
+
+_current_ledger = contextvars.ContextVar("hsage_usage_ledger", default=None)
+_finished_reports = deque(maxlen=USAGE_REPORTS_KEPT)
+_finished_lock = threading.Lock()
+
+
+def current_ledger() -> Optional[UsageLedger]:
+    return _current_ledger.get()
+
+
+@contextmanager
+def use_ledger(ledger: UsageLedger):
+    """
+    Record provider calls made inside the block into an existing ledger.
+    """
+    token = _current_ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _current_ledger.reset(token)
+
+
+def start_request(command: str) -> UsageLedger:
+    """
+    Open a ledger for the rest of the current context, e.g. a CLI command.
+    """
+    ledger = UsageLedger(command)
+    _current_ledger.set(ledger)
+    return ledger
+
+
+def finish_request(ledger: UsageLedger) -> UsageReport:
+    """
+    Close out a ledger: keep it for batch_report() (the last USAGE_REPORTS_KEPT)
+    and log it if configured.
+    """
+    report = ledger.report()
+    with _finished_lock:
+        _finished_reports.append(report)
+        if USAGE_LOG_PATH:
+            with open(USAGE_LOG_PATH, "a") as f:
+                f.write(report.model_dump_json() + "\n")
+    return report
+
+
+@contextmanager
+def request_ledger(command: str):
+    ledger = UsageLedger(command)
+    with use_ledger(ledger):
+        try:
+            yield ledger
+        finally:
+            finish_request(ledger)
+
+
+# usage extractors, one per provider response type
+
+
+def cohere_usage(response):
+    meta = getattr(response, "meta", None)
+    units = getattr(meta, "billed_units", None) or getattr(meta, "tokens", None)
+    text = getattr(response, "text", "") or ""
+    if units is not None and getattr(units, "input_tokens", None) is not None:
+        return {
+            "input_tokens": int(units.input_tokens or 0),
+            "output_tokens": int(units.output_tokens or 0),
+            "response_bytes": len(text.encode()),
+        }
+    return {
+        "output_tokens": estimate_tokens(text),
+        "response_bytes": len(text.encode()),
+        "estimated_tokens": True,
+    }
+
+
+def cohere_stream_usage(events):
+    """
+    Usage of a Cohere chat stream, from its stream-end event when it got that
+    far, otherwise estimated from the text it streamed.
+    """
+    for event in events:
+        if event.event_type == "stream-end":
+            return cohere_usage(event.response)
+    text = "".join(e.text for e in events if e.event_type == "text-generation")
+    return {
+        "output_tokens": estimate_tokens(text),
+        "response_bytes": len(text.encode()),
+        "estimated_tokens": True,
+    }
+
+
+def cohere_rerank_usage(response):
+    meta = getattr(response, "meta", None)
+    units = getattr(meta, "billed_units", None)
+    return {"read_units": int(getattr(units, "search_units", 0) or 0)}
+
+
+def baseten_usage(resp):
+    """
+    The OpenAI compatible endpoints report usage,
+    the structured predict endpoint only gives us the JSON back.
+    """
+    content = resp.content or b""
+    try:
+        usage = resp.json().get("usage")
+    except (ValueError, AttributeError):
+        usage = None
+    if usage:
+        return {
+            "input_tokens": int(usage.get("prompt_tokens", 0)),
+            "output_tokens": int(usage.get("completion_tokens", 0)),
+            "response_bytes": len(content),
+        }
+    return {
+        "output_tokens": estimate_tokens(content),
+        "response_bytes": len(content),
+        "estimated_tokens": True,
+    }
+
+
+def openai_stream_usage(chunks):
+    """
+    Usage of an OpenAI compatible stream of chat.completion.chunk dicts.
+    Only some endpoints send a usage chunk, otherwise it's estimated.
+    """
+    text = "".join(
+        choice.get("delta", {}).get("content") or ""
+        for chunk in chunks
+        for choice in chunk.get("choices", [])
+    )
+    usage = next((c["usage"] for c in reversed(chunks) if c.get("usage")), None)
+    if usage:
+        return {
+            "input_tokens": int(usage.get("prompt_tokens", 0)),
+            "output_tokens": int(usage.get("completion_tokens", 0)),
+            "response_bytes": len(text.encode()),
+        }
+    return {
+        "output_tokens": estimate_tokens(text),
+        "response_bytes": len(text.encode()),
+        "estimated_tokens": True,
+    }
+
+
+def pinecone_embed_usage(response):
+    usage = getattr(response, "usage", None)
+    tokens = getattr(usage, "total_tokens", None)
+    return {"input_tokens": int(tokens or 0), "estimated_tokens": tokens is None}
+
+
+def pinecone_query_usage(response):
+    usage = getattr(response, "usage", None)
+    return {"read_units": int(getattr(usage, "read_units", 0) or 0)}
+
+
+def record_call(provider, operation, **fields):
+    """
+    Record a ProviderCall into the current ledger, if there is one.
+    """
+    ledger = current_ledger()
+    if ledger is None:
+        return
+    call = ProviderCall(provider=provider, operation=operation, **fields)
+    call.cost = call_cost(provider, call.input_tokens, call.output_tokens)
+    ledger.record(call)
+
+
+def metered_call(
+    provider,
+    operation,
+    fn,
+    *args,
+    usage_fn=None,
+    request_bytes=0,
+    input_tokens=0,
+    tokens=0,
+    priority=None,
+    **kwargs,
+):
+    """
+    call_with_limits, plus a ProviderCall recorded into the current ledger.
+    input_tokens is used as an estimate when usage_fn can't find real counts.
+    """
+    attempts = 0
+
+    def counted(*a, **k):
+        nonlocal attempts
+        attempts += 1
+        return fn(*a, **k)
+
+    start = time.perf_counter()
+    try:
+        with span(f"{provider}.{operation}", provider=provider):
+            result = call_with_limits(
+                provider, counted, *args, tokens=tokens, priority=priority, **kwargs
+            )
+    except Exception:
+        # out of retries (or not retryable), the time and retries still count
+        record_call(
+            provider,
+            operation,
+            request_bytes=request_bytes,
+            retries=max(attempts - 1, 0),
+            wall_time=time.perf_counter() - start,
+            failed=True,
+        )
+        raise
+    wall_time = time.perf_counter() - start
+
+    if current_ledger() is not None:
+        usage = usage_fn(result) if usage_fn else {}
+        if not usage.get("input_tokens") and input_tokens:
+            usage["input_tokens"] = input_tokens
+            usage["estimated_tokens"] = True
+        record_call(
+            provider,
+            operation,
+            request_bytes=request_bytes,
+            retries=attempts - 1,
+            wall_time=wall_time,
+            **usage,
+        )
+    return result
+
+
+def metered_stream(
+    provider,
+    operation,
+    fn,
+    *args,
+    usage_fn=None,
+    request_bytes=0,
+    input_tokens=0,
+    tokens=0,
+    priority=None,
+    **kwargs,
+):
+    """
+    metered_call for a streamed response. fn returns an iterator, and this
+    yields its items under the provider's limiter. The ProviderCall is
+    recorded when the stream ends, fails or the caller stops reading;
+    usage_fn gets the items the last attempt streamed.
+    """
+    attempts = 0
+    items = []
+
+    def counted(*a, **k):
+        nonlocal attempts
+        attempts += 1
+        items.clear()
+        return fn(*a, **k)
+
+    start = time.perf_counter()
+    failed = False
+    try:
+        for item in stream_with_limits(
+            provider, counted, *args, tokens=tokens, priority=priority, **kwargs
+        ):
+            items.append(item)
+            yield item
+    except Exception:
+        failed = True
+        raise
+    finally:
+        usage = {}
+        if not failed:
+            usage = usage_fn(items) if usage_fn else {}
+            if not usage.get("input_tokens") and input_tokens:
+                usage["input_tokens"] = input_tokens
+                usage["estimated_tokens"] = True
+        record_call(
+            provider,
+            operation,
+            request_bytes=request_bytes,
+            retries=max(attempts - 1, 0),
+            wall_time=time.perf_counter() - start,
+            failed=failed,
+            **usage,
+        )
+
+
+def aggregate_reports(reports: List[UsageReport]) -> List[CommandTotals]:
+    """
+    Roll a batch of request reports up per command.
+    """
+    commands = sorted({report.command for report in reports})
+    aggregated = []
+    for command in commands:
+        matching = [r for r in reports if r.command == command]
+        calls = [call for r in matching for call in r.calls]
+        providers = sorted({call.provider for call in calls})
+        wall_time = sum(r.wall_time for r in matching)
+        aggregated.append(
+            CommandTotals(
+                command=command,
+                requests=len(matching),
+                input_tokens=sum(c.input_tokens for c in calls),
+                output_tokens=sum(c.output_tokens for c in calls),
+                retries=sum(c.retries for c in calls),
+                cost=sum(c.cost for c in calls),
+                wall_time=wall_time,
+                avg_wall_time=wall_time / len(matching),
+                providers=[
+                    _sum_calls(p, [c for c in calls if c.provider == p])
+                    for p in providers
+                ],
+                context_tokens_before=sum(r.context_tokens_before for r in matching),
+                context_tokens_after=sum(r.context_tokens_after for r in matching),
+                context_prompts=sum(r.context_prompts for r in matching),
+                context_chunks=sum(r.context_chunks for r in matching),
+                rerank_tokens_before=sum(r.rerank_tokens_before for r in matching),
+                rerank_tokens_after=sum(r.rerank_tokens_after for r in matching),
+                replayed_steps=sum(r.replayed_steps for r in matching),
+            )
+        )
+    return aggregated
+
+
+def batch_report() -> List[CommandTotals]:
+    """
+    Aggregate of the requests finished in this process so far
+    (the last USAGE_REPORTS_KEPT of them).
+    """
+    with _finished_lock:
+        reports = list(_finished_reports)
+    return aggregate_reports(reports)
+
+
+def load_reports(path) -> List[UsageReport]:
+    with open(path) as f:
+        return [UsageReport.model_validate_json(line) for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    # aggregate a usage log from a batch run:
+    # python usage_ledger.py hsage_usage.jsonl
+    path = sys.argv[1] if len(sys.argv) > 1 else USAGE_LOG_PATH
+    for totals in aggregate_reports(load_reports(path)):
+        print(json.dumps(totals.model_dump(), indent=2))